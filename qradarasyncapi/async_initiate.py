@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+import dotenv
+from async_producerconsumer import AsyncProducerConsumer
+from mongoclient import MongoDBConnection
+from query_executor import QueryExecutor, pending_tasks, split_task
+from work_scheduler import WorkScheduler
+from utils import attributes
+from utils.limiter import ConsoleLimiter
+from utils.http_client import get_async_client
+from utils.checkpoint import get_checkpoint_store
+from utils.metrics import start_exporter
+from utils.provisioning import (
+    build_deferred_indexes,
+    collection_targets,
+    provision_collections,
+)
+from utils.constants import ADAPTIVE_WINDOWS, SPOOL_RESULTS
+
+dotenv.load_dotenv(Path(__file__).parent.parent / "config" / ".env")
+
+
+async def async_starter():
+    """Runs every (event processor, client, query, window) search from one shared work queue."""
+    attributes_dict = attributes.get_attributes()
+    tasks = QueryExecutor(
+        queries=attributes_dict.queries,
+        history=get_checkpoint_store() if ADAPTIVE_WINDOWS else None,
+    ).create_tasks(attributes_dict.ep_client_list)
+    tasks = pending_tasks(tasks)
+    # Spooled results are only inserted by spool_loader.py, which provisions itself.
+    targets = (
+        []
+        if SPOOL_RESULTS
+        else collection_targets(attributes_dict.ep_client_list, attributes_dict.queries)
+    )
+    await asyncio.to_thread(provision_collections, targets)
+    mongo_client = MongoDBConnection().get_async_client()
+    limiter = ConsoleLimiter()
+    exporter = start_exporter()
+    scheduler = WorkScheduler()
+    try:
+        async with get_async_client() as http_client:
+
+            async def run_search(task):
+                producer_consumer = AsyncProducerConsumer(
+                    query_expression=task.query_expression,
+                    query_name=task.query_name,
+                    client=task.client,
+                    event_processor=task.event_processor,
+                    query_start_time=time.perf_counter(),
+                    query_duration_start=task.query_duration_start,
+                    query_duration_stop=task.query_duration_stop,
+                    http_client=http_client,
+                    mongo_client=mongo_client,
+                    limiter=limiter,
+                    clients=task.clients,
+                )
+                await producer_consumer.run()
+                if producer_consumer.split:
+                    return split_task(task)
+
+            await scheduler.run(tasks, run_search)
+        await asyncio.to_thread(build_deferred_indexes, targets)
+    finally:
+        mongo_client.close()
+        if exporter:
+            exporter.close()
+    # Includes the halves of split searches.
+    logging.info(msg=f"Completed {scheduler.completed} searches")
@@ -0,0 +1,18 @@
+import asyncio
+import logging
+import time
+import async_initiate
+from utils.logger import SetupLogging
+
+
+def main():
+    """Entry point for the asyncio engine."""
+    SetupLogging().setup_logging()
+    start = time.perf_counter()
+    asyncio.run(async_initiate.async_starter())
+    stop = time.perf_counter()
+    logging.info(msg=f"Finished in {(stop - start) / 60 / 60} hours")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,758 @@
+import asyncio
+from datetime import datetime
+from functools import partial
+import os
+import logging
+import time
+from pathlib import Path
+import dotenv
+import httpx
+from utils.enrichment import add_dates
+from utils.limiter import ConsoleLimiter
+from utils.logger import set_log_context
+from utils.polling import PollSchedule
+from utils.retry import RETRIGGER, RetryPolicy, error_details, error_message
+from utils.cursors import is_reusable
+from utils.metrics import SearchMetrics
+from utils.memory import memory_stats
+from utils.spool import Spool
+from utils.batch_queue import AsyncBatchQueue
+from utils.document_ids import DocumentIds
+from utils.windows import should_split
+from mongoclient import database_name
+from utils.bulk_writer import AsyncBulkWriter, AsyncRoutedBulkWriter
+from utils.checkpoint import RangeTracker, checkpoint_key, get_checkpoint_store
+from utils.results import (
+    EventStreamParser,
+    batch_is_full,
+    get_ranges,
+    parse_events,
+    split_batches,
+)
+from utils.constants import (
+    SHORT_DURATION_QUERIES,
+    SHORT_POLL_MAX_INTERVAL,
+    LONG_POLL_MAX_INTERVAL,
+    RESULT_CHUNK_SIZE,
+    ADAPTIVE_WINDOWS,
+    IDEMPOTENT_INSERTS,
+    RESULT_CHUNK_PARALLELISM,
+    RESULT_CHUNK_ATTEMPTS,
+    SPOOL_RESULTS,
+    DELETE_COMPLETED_SEARCHES,
+    REUSE_SEARCHES,
+    REUSE_LOOKUP_MAX,
+)
+
+dotenv.load_dotenv(Path(__file__).parent.parent / "config" / ".env")
+
+
+class AsyncProducerConsumer:
+    """Asyncio version of ProducerConsumer.
+
+    Triggers one Ariel search, polls it until it completes, streams the results and inserts
+    them into MongoDB without blocking the event loop, so hundreds of searches can share one
+    process. The HTTP and Motor clients are owned by the caller and shared between searches.
+    """
+
+    def __init__(
+        self,
+        query_expression,
+        query_name,
+        client,
+        event_processor,
+        query_start_time,
+        query_duration_start,
+        query_duration_stop,
+        http_client: httpx.AsyncClient,
+        mongo_client,
+        limiter: ConsoleLimiter,
+        clients=None,
+    ):
+        self.sec_token = os.environ.get("MONGODB_SEC_TOKEN")
+        self.qradar_console_id = os.environ.get("QRADAR_CONSOLE_ID")
+        self.header = {
+            "SEC": self.sec_token,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Version": "19.0",
+        }
+        self.query_url = f"https://{self.qradar_console_id}/api/ariel/searches"
+        self.http_client = http_client
+        self.mongo_client = mongo_client
+        self.limiter = limiter
+        self.queue = AsyncBatchQueue()
+        self.query_expression = query_expression
+        self.query_name = "raw_" + query_name
+        self.client = client
+        # Clients covered by a batched search, see QueryExecutor.client_groups.
+        self.clients = clients
+        self.event_processor = event_processor.replace(" ", "")
+        # Routes the logs of this search's task to the client's log file.
+        set_log_context(self.event_processor, client)
+        self.metrics = SearchMetrics(self.event_processor, client, query_name)
+        self.retry = RetryPolicy()
+        # Searches this task triggered, the only ones it deletes, see utils/cursors.py.
+        self.owned_cursors = set()
+        # Searches that failed, never reused.
+        self.failed_cursors = set()
+        self.database = self.mongo_client.get_database(database_name(client))
+        self.collection = self.database.get_collection(self.query_name)
+        self.checkpoint = get_checkpoint_store()
+        self.checkpoint_key = checkpoint_key(
+            event_processor,
+            client,
+            query_name,
+            query_duration_start,
+            query_duration_stop,
+        )
+
+        # Logging variables
+        self.post_request_attempt = 1
+        self.max_attempts = 10
+        self.inserted_records = 0
+        self.poll_stats = {}
+        # Set once the search was cancelled to split its window, see utils/windows.py.
+        self.split = False
+        self.query_start_time = query_start_time
+        self.query_duration_start = query_duration_start
+        self.query_duration_stop = query_duration_stop
+
+    def log_extra(self, **fields):
+        extra = {
+            "Log Time": datetime.utcnow(),
+            "Event Processor": self.event_processor,
+            "Client": f"{self.client}",
+            "Query": f"{self.query_name}",
+            "Query Duration Start": f"{self.query_duration_start}",
+            "Query Duration Stop": f"{self.query_duration_stop}",
+            "Attempt": f"{self.post_request_attempt}",
+        }
+        extra.update(fields)
+        return extra
+
+    async def do_post_requests(self, url):
+        """Sends a POST request to QRadar for triggering and polling searches.
+
+        Failed requests are retried as self.retry decides, see utils/retry.py.
+
+        Args:
+            url (str): The Ariel searches URL
+
+        Returns:
+            httpx.Response: None if the request was given up, self.retry.action tells why.
+        """
+        while True:
+            try:
+                await self.limiter.throttle()
+                result = await self.http_client.post(
+                    url=url,
+                    params={"query_expression": self.query_expression},
+                    headers=self.header,
+                    timeout=120,
+                )
+                result.raise_for_status()
+                self.retry.succeeded()
+                return result
+            except httpx.HTTPError as http_err:
+                delay = self.retry.next_delay(http_err)
+                logging.error(
+                    msg=f"{error_message(http_err)}: {http_err}",
+                    extra=self.log_extra(
+                        **{
+                            "Retry Action": f"{self.retry.action}",
+                            "Retry In (in seconds)": (
+                                "given up" if delay is None else f"{delay:.1f}"
+                            ),
+                            **error_details(http_err),
+                        }
+                    ),
+                )
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+
+    async def query_status(self, url: str):
+        """Polls QRadar /ariel/searches/cursor_id until the search completes, see PollSchedule.
+
+        Args:
+            url (str): This url contains the cursor_id received for the ongoing search.
+
+        Returns:
+            tuple: (completed, response_header). completed is False if a new search needs
+            to be triggered. None if the search timed out.
+        """
+        if self.query_name.removeprefix("raw_") in SHORT_DURATION_QUERIES:
+            max_interval = SHORT_POLL_MAX_INTERVAL
+        else:
+            max_interval = LONG_POLL_MAX_INTERVAL
+        schedule = PollSchedule(max_interval=max_interval)
+        while not schedule.expired():
+            self.metrics.polled()
+            result = await self.do_post_requests(url)
+            if result is None:
+                if self.retry.action == RETRIGGER:
+                    # The search is gone from the console.
+                    self.post_request_attempt += 1
+                    return False, {}
+                return None
+            response_header = result.json()
+            completed: bool = response_header.get("completed")
+            error_messages = response_header.get("error_messages")
+            extra = self.log_extra(
+                **{
+                    "Request Type": "Polling",
+                    "Status Code": f"{result.status_code}",
+                    "Search ID": f"{response_header.get('cursor_id')}",
+                    "Progress": f"{response_header.get('progress')}",
+                    "Status": f"{response_header.get('status')}",
+                    "Completed Flag": f"{completed}",
+                    "Records Found": f"{response_header.get('record_count')}",
+                }
+            )
+            if error_messages is None and completed:
+                schedule.complete()
+                self.metrics.completed(schedule.elapsed)
+                self.poll_stats = schedule.stats()
+                logging.info(
+                    msg="Search Completed", extra={**extra, **self.poll_stats}
+                )
+                return True, response_header
+            elif error_messages is None and not completed:
+                if ADAPTIVE_WINDOWS and should_split(
+                    schedule,
+                    response_header.get("record_count"),
+                    response_header.get("progress"),
+                    self.query_duration_start,
+                    self.query_duration_stop,
+                ):
+                    logging.info(
+                        msg="Splitting Search", extra={**extra, **schedule.stats()}
+                    )
+                    cursor_id = response_header.get("cursor_id")
+                    if cursor_id in self.owned_cursors:
+                        self.owned_cursors.discard(cursor_id)
+                        await self.delete_search(cursor_id)
+                    self.checkpoint.split(self.checkpoint_key)
+                    self.split = True
+                    return None
+                sleep = schedule.next_interval(response_header.get("progress"))
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    extra["Next Poll (in seconds)"] = f"{sleep:.1f}"
+                    logging.info(
+                        msg="Checking Search Status",
+                        extra={**extra, **schedule.stats()},
+                    )
+                await asyncio.sleep(sleep)
+            else:
+                self.poll_stats = schedule.stats()
+                extra["QRadar Error Code"] = f"{error_messages[0].get('code')}"
+                extra[
+                    "QRadar Error Message"
+                ] = f"{error_messages[0].get('message')}"
+                logging.error(
+                    msg="Search Error", extra={**extra, **self.poll_stats}
+                )
+                self.post_request_attempt += 1
+                return False, response_header
+        logging.error(
+            msg="Exhausted Attempts",
+            extra=self.log_extra(**schedule.stats()),
+        )
+
+    async def start_producer(self):
+        """Triggers the search and waits for it to complete, re-triggering failed searches.
+
+        Returns:
+            dict: The response header of the completed search, None if attempts are exhausted.
+        """
+        # Time spent waiting for a console search slot.
+        self.metrics.queued(time.perf_counter() - self.query_start_time)
+        while (
+            self.post_request_attempt <= self.max_attempts
+            and not self.retry.expired()
+        ):
+            # Looks for an identical search that is already running before triggering one.
+            reused = await self.find_search() if REUSE_SEARCHES else None
+            result = reused or await self.do_post_requests(self.query_url)
+            if result is None:
+                break
+            response_header = result.json()
+            cursor_id = response_header.get("cursor_id")
+            logging.info(
+                msg="Search Triggered",
+                extra=self.log_extra(
+                    **{
+                        "Request Type": "Trigger",
+                        "Status Code": f"{result.status_code}",
+                        "Search ID": f"{cursor_id}",
+                        "Status": f"{response_header.get('status')}",
+                    }
+                ),
+            )
+            self.checkpoint.triggered(self.checkpoint_key, cursor_id)
+            if reused is None:
+                self.owned_cursors.add(cursor_id)
+            polling_response = await self.query_status(
+                f"{self.query_url}/{cursor_id}"
+            )
+            if polling_response is None:
+                if self.split:
+                    return None
+                break
+            completed, response_header = polling_response
+            if completed:
+                self.record_completion(cursor_id, response_header)
+                return response_header
+            await self.discard_search(cursor_id)
+        logging.error(
+            msg="Exhausted Attempts", extra=self.log_extra(**self.retry.stats())
+        )
+
+    async def reattach(self):
+        """Resumes the search a previous run triggered, using the cursor_id from its checkpoint.
+
+        Returns:
+            dict: The response header of the completed search, None if there's no checkpointed
+            search still available on the console or it didn't complete.
+        """
+        checkpoint = self.checkpoint.get(self.checkpoint_key)
+        if not checkpoint or not checkpoint["cursor_id"]:
+            return None
+        cursor_id = checkpoint["cursor_id"]
+        extra = self.log_extra(
+            **{
+                "Search ID": f"{cursor_id}",
+                "Checkpoint State": f"{checkpoint['state']}",
+            }
+        )
+        try:
+            await self.limiter.throttle()
+            result = await self.http_client.get(
+                url=f"{self.query_url}/{cursor_id}",
+                headers=self.header,
+                timeout=120,
+            )
+        except httpx.HTTPError as http_exp:
+            logging.warning(
+                msg=f"Checkpointed Search unavailable: {http_exp}", extra=extra
+            )
+            return None
+        if result.status_code != 200:
+            logging.info(msg="Checkpointed Search expired", extra=extra)
+            return None
+        logging.info(msg="Re-attaching to Search", extra=extra)
+        polling_response = await self.query_status(f"{self.query_url}/{cursor_id}")
+        if polling_response and polling_response[0]:
+            response_header = polling_response[1]
+            self.record_completion(cursor_id, response_header)
+            return response_header
+
+    async def delete_search(self, cursor_id):
+        """Deletes the search and its results from the console."""
+        try:
+            await self.limiter.throttle()
+            await self.http_client.delete(
+                url=f"{self.query_url}/{cursor_id}", headers=self.header, timeout=120
+            )
+        except httpx.HTTPError as http_exp:
+            logging.warning(
+                msg=f"Failed Deleting Search: {http_exp}",
+                extra=self.log_extra(**{"Search ID": f"{cursor_id}"}),
+            )
+
+    async def find_search(self):
+        """Looks up a search on the console running the same query expression, so that
+        triggering the search doesn't run a duplicate, see utils/cursors.py.
+
+        Returns:
+            httpx.Response: Status of the search to reuse, None if there is none.
+        """
+        try:
+            await self.limiter.throttle()
+            result = await self.http_client.get(
+                url=self.query_url,
+                headers={**self.header, "Range": f"items=0-{REUSE_LOOKUP_MAX - 1}"},
+                timeout=120,
+            )
+            result.raise_for_status()
+            for cursor_id in result.json():
+                if cursor_id in self.failed_cursors:
+                    continue
+                await self.limiter.throttle()
+                status = await self.http_client.get(
+                    url=f"{self.query_url}/{cursor_id}", headers=self.header, timeout=120
+                )
+                if status.status_code == 200 and is_reusable(
+                    status.json(), self.query_expression
+                ):
+                    logging.info(
+                        msg="Reusing Search",
+                        extra=self.log_extra(**{"Search ID": f"{cursor_id}"}),
+                    )
+                    return status
+        except (httpx.HTTPError, ValueError) as exp:
+            logging.warning(
+                msg=f"Failed Looking Up Searches: {exp}", extra=self.log_extra()
+            )
+        return None
+
+    async def discard_search(self, cursor_id):
+        """Deletes a failed search before it is triggered again, it's never reused."""
+        self.failed_cursors.add(cursor_id)
+        if DELETE_COMPLETED_SEARCHES and cursor_id in self.owned_cursors:
+            self.owned_cursors.discard(cursor_id)
+            await self.delete_search(cursor_id)
+
+    async def finish_search(self, cursor_id):
+        """Checkpoints that all results of the search are stored and deletes it from the
+        console, its results are no longer needed."""
+        self.checkpoint.finished(self.checkpoint_key)
+        if DELETE_COMPLETED_SEARCHES and cursor_id in self.owned_cursors:
+            self.owned_cursors.discard(cursor_id)
+            await self.delete_search(cursor_id)
+
+    def record_completion(self, cursor_id, response_header):
+        """Checkpoints the completed search and records its size for planning windows."""
+        record_count = response_header.get("record_count")
+        self.checkpoint.completed(self.checkpoint_key, cursor_id, record_count)
+        if record_count is not None:
+            self.checkpoint.observed(
+                self.client,
+                self.query_name.removeprefix("raw_"),
+                self.query_duration_start,
+                self.query_duration_stop,
+                record_count,
+            )
+
+    def pending_ranges(self, cursor_id, record_count):
+        """Result ranges of the cursor that aren't stored in MongoDB yet, see get_ranges."""
+        done_ranges = self.checkpoint.done_ranges(self.checkpoint_key, cursor_id)
+        return [
+            chunk
+            for chunk in get_ranges(record_count, RESULT_CHUNK_SIZE)
+            if chunk not in done_ranges
+        ]
+
+    async def enqueue(self, cursor_id, record_count, ranges=None):
+        """Streams the search results onto the queue.
+
+        Results with more than RESULT_CHUNK_SIZE rows, or of which only some ranges are still
+        pending after a restart, are downloaded in ranges, see enqueue_ranges. If the stream
+        fails, the rows that weren't queued yet are downloaded with the retries of fetch_range.
+        """
+        all_ranges = get_ranges(record_count, RESULT_CHUNK_SIZE)
+        if ranges is None:
+            ranges = all_ranges
+        if len(all_ranges) > 1 or ranges != all_ranges:
+            return await self.enqueue_ranges(cursor_id, ranges)
+        chunk = all_ranges[0]
+        url = f"{self.query_url}/{cursor_id}/results"
+        parser = EventStreamParser()
+        queued = 0
+        try:
+            await self.limiter.throttle()
+            async with self.http_client.stream(
+                "GET", url=url, headers=self.header, timeout=115
+            ) as query_request:
+                logging.info(
+                    msg="Started Fetching Data",
+                    extra=self.log_extra(
+                        **{
+                            "Request Type": "Fetching",
+                            "Status Code": f"{query_request.status_code}",
+                            "Search ID": f"{cursor_id}",
+                        }
+                    ),
+                )
+                query_request.raise_for_status()
+                batch, nbytes = [], 0
+                received = time.perf_counter()
+                async for data in query_request.aiter_bytes():
+                    parsing = time.perf_counter()
+                    self.metrics.downloaded(len(data), parsing - received)
+                    events = parser.feed(data)
+                    self.metrics.parsed(len(events), time.perf_counter() - parsing)
+                    batch += events
+                    nbytes += len(data)
+                    if batch_is_full(batch, nbytes):
+                        await self.queue_writer(batch, nbytes, chunk)
+                        queued += len(batch)
+                        batch, nbytes = [], 0
+                    received = time.perf_counter()
+                parser.close()
+                if batch:
+                    await self.queue_writer(batch, nbytes, chunk)
+        except (httpx.HTTPError, ValueError) as http_exp:
+            logging.warning(
+                msg=f"Failed Streaming Results: {http_exp}",
+                extra=self.log_extra(
+                    **{
+                        "Search ID": f"{cursor_id}",
+                        "Records Queued": f"{queued}",
+                        **error_details(http_exp),
+                    }
+                ),
+            )
+            # Results are streamed in order, the rows queued so far are kept.
+            start, stop = chunk
+            if start + queued <= stop:
+                await self.fetch_range(url, cursor_id, start + queued, stop, chunk)
+
+    async def enqueue_ranges(self, cursor_id, ranges):
+        """Downloads the given ranges of the results, RESULT_CHUNK_PARALLELISM at a time.
+
+        Chunks are put on the queue in the order they complete.
+        """
+        url = f"{self.query_url}/{cursor_id}/results"
+        semaphore = asyncio.Semaphore(RESULT_CHUNK_PARALLELISM)
+        logging.info(
+            msg="Started Fetching Data",
+            extra=self.log_extra(
+                **{
+                    "Request Type": "Fetching",
+                    "Search ID": f"{cursor_id}",
+                    "Chunks": f"{len(ranges)}",
+                }
+            ),
+        )
+
+        async def fetch(start, stop):
+            async with semaphore:
+                await self.fetch_range(url, cursor_id, start, stop)
+
+        await asyncio.gather(*(fetch(start, stop) for start, stop in ranges))
+
+    async def fetch_range(self, url, cursor_id, start, stop, chunk=None):
+        """Downloads rows start to stop (inclusive) of the results.
+
+        The chunk is only put on the queue once it is complete, so a failed chunk is
+        retried on its own without duplicating rows. Its batches are queued as the result
+        range chunk, (start, stop) unless they complete the range of a failed stream.
+        """
+        retry = RetryPolicy(RESULT_CHUNK_ATTEMPTS, self.retry.deadline)
+        while True:
+            try:
+                await self.limiter.throttle()
+                requested = time.perf_counter()
+                result = await self.http_client.get(
+                    url=url,
+                    headers={**self.header, "Range": f"items={start}-{stop}"},
+                    timeout=115,
+                )
+                result.raise_for_status()
+                parsing = time.perf_counter()
+                self.metrics.downloaded(len(result.content), parsing - requested)
+                events = parse_events(result.content)
+                self.metrics.parsed(len(events), time.perf_counter() - parsing)
+                for batch, nbytes in split_batches(events, len(result.content)):
+                    await self.queue_writer(batch, nbytes, chunk or (start, stop))
+                return
+            except (httpx.HTTPError, ValueError) as http_exp:
+                delay = retry.next_delay(http_exp)
+                logging.warning(
+                    msg=f"Failed Fetching Range: {http_exp}",
+                    extra=self.log_extra(
+                        **{
+                            "Search ID": f"{cursor_id}",
+                            "Range": f"{start}-{stop}",
+                            "Attempt": f"{retry.failures}",
+                            "Retry Action": f"{retry.action}",
+                        }
+                    ),
+                )
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        logging.error(
+            msg="Exhausted Attempts for Range",
+            extra=self.log_extra(
+                **{"Search ID": f"{cursor_id}", "Range": f"{start}-{stop}"}
+            ),
+        )
+
+    async def queue_writer(self, batch, nbytes, chunk):
+        """Queues a batch tagged with the result range it belongs to."""
+        waiting = time.perf_counter()
+        if await self.queue.put((chunk, batch), nbytes):
+            self.metrics.spilled(nbytes)
+        self.metrics.queue_waited(time.perf_counter() - waiting)
+        self.metrics.queue_depth(self.queue)
+
+    async def dequeue(self, response_header, ranges=None):
+        """Inserts the queued batches into MongoDB, checkpointing every result range once stored.
+
+        Args:
+            response_header (dict): Response of the completed search.
+            ranges (list[tuple[int, int]]): Ranges enqueue downloads, all of them if None.
+        """
+        count = response_header.get("record_count")
+        cursor_id = response_header.get("cursor_id")
+        timeout = 120
+        if ranges is None:
+            ranges = get_ranges(count, RESULT_CHUNK_SIZE)
+        remaining = sum(stop - start + 1 for start, stop in ranges)
+        tracker = RangeTracker(self.checkpoint, self.checkpoint_key, cursor_id, ranges)
+        document_ids = (
+            DocumentIds(
+                self.query_name, self.query_duration_start, self.query_duration_stop
+            )
+            if IDEMPOTENT_INSERTS
+            else None
+        )
+        # Batches are inserted in the background while the next one is dequeued.
+        extra = self.log_extra(**{"Search ID": f"{cursor_id}"})
+        if self.clients:
+            writer = AsyncRoutedBulkWriter(
+                lambda client: self.mongo_client.get_database(database_name(client)),
+                self.query_name,
+                extra=extra,
+                metrics=self.metrics,
+            )
+        else:
+            writer = AsyncBulkWriter(
+                self.collection, extra=extra, metrics=self.metrics
+            )
+        try:
+            try:
+                while remaining > 0:
+                    chunk, logs = await asyncio.wait_for(
+                        self.queue.get(), timeout=timeout
+                    )
+                    self.metrics.queue_depth(self.queue)
+                    if document_ids:
+                        document_ids.assign(logs, chunk)
+                    await writer.submit(
+                        add_dates(logs), partial(tracker.inserted, chunk)
+                    )
+                    remaining -= len(logs)
+            finally:
+                await writer.close()
+                self.inserted_records = writer.inserted
+            if tracker.complete():
+                await self.finish_search(cursor_id)
+            self.metrics.finished(time.perf_counter() - self.query_start_time)
+            logging.info(
+                msg="Completed Data Fetching for Query",
+                extra=self.log_extra(
+                    **{
+                        "Search ID": f"{cursor_id}",
+                        "Records Found": f"{count}",
+                        "Time to Complete (in minutes)": f"{(time.perf_counter() - self.query_start_time) / 60}",
+                        **writer.stats.to_dict(),
+                        **self.queue.stats(),
+                        **memory_stats(),
+                    }
+                ),
+            )
+        except asyncio.TimeoutError:
+            logging.error(
+                msg=f"Read timeout - No data received from QRadar for {timeout / 60} minutes",
+                extra=self.log_extra(
+                    **{
+                        "Search ID": f"{cursor_id}",
+                        "Records Found": f"{count}",
+                        "Records Inserted": f"{self.inserted_records}",
+                    }
+                ),
+            )
+
+    async def spool(self, response_header, ranges=None):
+        """Writes the queued batches to the local spool instead of MongoDB, see utils/spool.py.
+
+        Segments are compressed and written in a thread to keep the event loop free.
+        """
+        count = response_header.get("record_count")
+        cursor_id = response_header.get("cursor_id")
+        timeout = 120
+        if ranges is None:
+            ranges = get_ranges(count, RESULT_CHUNK_SIZE)
+        remaining = sum(stop - start + 1 for start, stop in ranges)
+        extra = self.log_extra(
+            **{"Search ID": f"{cursor_id}", "Records Found": f"{count}"}
+        )
+        tracker = RangeTracker(self.checkpoint, self.checkpoint_key, cursor_id, ranges)
+        spool = Spool(
+            self.event_processor,
+            self.client,
+            self.query_name,
+            self.query_duration_start,
+            self.query_duration_stop,
+            cursor_id,
+            ranges,
+            clients=self.clients,
+        )
+        try:
+            while remaining > 0:
+                chunk, logs = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                self.metrics.queue_depth(self.queue)
+                await asyncio.to_thread(spool.write, chunk, logs)
+                tracker.inserted(chunk, len(logs))
+                remaining -= len(logs)
+        except asyncio.TimeoutError:
+            logging.error(
+                msg=f"Read timeout - No data received from QRadar for {timeout / 60} minutes",
+                extra=extra,
+            )
+        except (OSError, ValueError) as spool_error:
+            logging.exception(msg=f"Failed Spooling: {spool_error}", extra=extra)
+        finally:
+            spool.close()
+        if tracker.complete():
+            await self.finish_search(cursor_id)
+        self.metrics.finished(time.perf_counter() - self.query_start_time)
+        logging.info(
+            msg="Completed Spooling for Query",
+            extra={
+                **extra,
+                "Time to Complete (in minutes)": f"{(time.perf_counter() - self.query_start_time) / 60}",
+                **spool.stats(),
+                **self.queue.stats(),
+                **memory_stats(),
+            },
+        )
+
+    async def run(self):
+        """Runs trigger -> poll -> fetch -> insert for this search."""
+        # The search occupies a console search slot until it completes or fails.
+        async with self.limiter.search_slot():
+            response_header = await self.reattach()
+            if not response_header and not self.split:
+                response_header = await self.start_producer()
+        if not response_header:
+            return
+        record_count = response_header.get("record_count")
+        cursor_id = response_header.get("cursor_id")
+        if not record_count:
+            if record_count == 0:
+                await self.finish_search(cursor_id)
+            logging.info(
+                msg="No records found",
+                extra=self.log_extra(
+                    **{
+                        "Search ID": f"{cursor_id}",
+                        "Records Found": f"{record_count}",
+                    }
+                ),
+            )
+            return response_header
+        ranges = self.pending_ranges(cursor_id, record_count)
+        if not ranges:
+            # A previous run stored all of them.
+            await self.finish_search(cursor_id)
+            return response_header
+        consume = self.spool if SPOOL_RESULTS else self.dequeue
+        consumer = asyncio.create_task(consume(response_header, ranges))
+        producer = asyncio.create_task(self.enqueue(cursor_id, record_count, ranges))
+        stages = {producer, consumer}
+        try:
+            # If one stage fails the other one would wait on the queue forever.
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            self.queue.close()
+        for stage in done:
+            stage.result()
+        return response_header
@@ -0,0 +1,302 @@
+"""End-to-end throughput benchmark of both engines against MockAriel and an in-memory MongoDB.
+
+Run from the qradarasyncapi folder:
+
+    python -m benchmarks.end_to_end --engine both --searches 16 --rows 50000
+
+The real code paths run unchanged: initiate.run_search_task for the process pool engine and
+AsyncProducerConsumer on the WorkScheduler for the asyncio engine. Only the HTTP client, the
+MongoDB client and the checkpoint store are swapped for the stand-ins through the per-process
+accessors they are created by. The pool engine's searches run on threads here, as forked
+workers would create real clients of their own.
+
+For every stage (search: trigger and poll, fetch: download and parse, insert: enrich and
+insert) the wall time summed over searches, CPU time and rows/s are reported. CPU time per
+stage is the thread CPU time of the stage, which the asyncio engine doesn't have as all stages
+share one thread, its CPU time is only reported for the whole run. Memory is reported as the
+peak RSS of the run and, with --trace-memory, the highest Python heap growth seen while a
+stage was running (stages of concurrent searches overlap, so it is an upper bound). INFO logs
+are disabled unless --verbose is given. --metrics writes the metrics the run recorded (see
+utils/metrics.py) in the Prometheus text format.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pathlib import Path
+
+os.environ.setdefault("MONGODB_SEC_TOKEN", "benchmark")
+os.environ.setdefault("QRADAR_CONSOLE_ID", "mock-console")
+
+import httpx
+import initiate
+import mongoclient
+from async_producerconsumer import AsyncProducerConsumer
+from benchmarks.memory_mongo import AsyncMemoryMongoClient, MemoryMongoClient
+from benchmarks.mock_ariel import MockAriel
+from producerconsumer import ProducerConsumer
+from query_executor import QueryExecutor
+from work_scheduler import WorkScheduler
+from utils import checkpoint, http_client, limiter, metrics
+from utils.constants import SEARCH_PROCESSES
+
+QUERY = (
+    "SELECT DOMAINNAME(domainId) AS 'domainName', LOGSOURCENAME(logSourceId) AS 'Log Source', "
+    "sourceIP AS 'Source IP', destinationIP AS 'Desitnation IP' FROM events "
+    "WHERE DOMAINNAME(domainId) = @@@@@ START !!!!! STOP $$$$$ "
+    "PARAMETERS REMOTESERVERS=ARIELSERVERS4EPID(#####)"
+)
+
+
+class StageStats:
+    """Wall time, CPU time, rows and heap peak per stage, summed over searches."""
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.wall = defaultdict(float)
+        self.cpu = defaultdict(float)
+        self.rows = defaultdict(int)
+        self.heap_peak = defaultdict(int)
+
+    def record(self, stage, wall, cpu, rows, heap_peak):
+        with self.lock:
+            self.calls[stage] += 1
+            self.wall[stage] += wall
+            self.cpu[stage] += cpu
+            self.rows[stage] += rows
+            self.heap_peak[stage] = max(self.heap_peak[stage], heap_peak)
+
+    def heap(self):
+        return tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+
+    def measure(self, stage, rows):
+        """Decorates a stage method, rows(self, args, result) returns the rows it handled."""
+
+        def decorator(method):
+            if asyncio.iscoroutinefunction(method):
+
+                @wraps(method)
+                async def wrapper(producer_consumer, *args, **kwargs):
+                    start, heap = time.perf_counter(), self.heap()
+                    result = await method(producer_consumer, *args, **kwargs)
+                    self.record(
+                        stage,
+                        time.perf_counter() - start,
+                        0.0,
+                        rows(producer_consumer, args, result),
+                        self.heap_peak_since(heap),
+                    )
+                    return result
+
+            else:
+
+                @wraps(method)
+                def wrapper(producer_consumer, *args, **kwargs):
+                    start, cpu, heap = (
+                        time.perf_counter(),
+                        time.thread_time(),
+                        self.heap(),
+                    )
+                    result = method(producer_consumer, *args, **kwargs)
+                    self.record(
+                        stage,
+                        time.perf_counter() - start,
+                        time.thread_time() - cpu,
+                        rows(producer_consumer, args, result),
+                        self.heap_peak_since(heap),
+                    )
+                    return result
+
+            return wrapper
+
+        return decorator
+
+    def heap_peak_since(self, heap):
+        if not self.trace_memory:
+            return 0
+        return max(tracemalloc.get_traced_memory()[1] - heap, 0)
+
+    def report(self, engine, elapsed, cpu, rows):
+        print(f"\n{engine} engine: {rows} rows in {elapsed:.2f} s, {rows / elapsed:.0f} rows/s")
+        print(
+            f"CPU {cpu:.2f} s ({cpu / max(rows, 1) * 1e6:.2f} us/row), "
+            f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+        )
+        header = f"{'stage':<8}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'rows':>12}{'rows/s':>12}"
+        if self.trace_memory:
+            header += f"{'heap MB':>10}"
+        print(header)
+        for stage in ("search", "fetch", "insert"):
+            wall = self.wall[stage]
+            line = (
+                f"{stage:<8}{self.calls[stage]:>8}{wall:>10.2f}{self.cpu[stage]:>10.2f}"
+                f"{self.rows[stage]:>12}{self.rows[stage] / wall if wall else 0:>12.0f}"
+            )
+            if self.trace_memory:
+                line += f"{self.heap_peak[stage] / 1024 / 1024:>10.1f}"
+            print(line)
+
+
+def search_rows(producer_consumer, args, result):
+    header = result[0] if isinstance(result, tuple) else result
+    return (header or {}).get("record_count") or 0
+
+
+def fetch_rows(producer_consumer, args, result):
+    cursor_id, record_count, *ranges = args
+    ranges = ranges[0] if ranges and ranges[0] is not None else [(0, record_count - 1)]
+    return sum(stop - start + 1 for start, stop in ranges)
+
+
+def insert_rows(producer_consumer, args, result):
+    return producer_consumer.inserted_records
+
+
+def instrument(engine_class, stats):
+    for name, stage, rows in (
+        ("start_producer", "search", search_rows),
+        ("enqueue", "fetch", fetch_rows),
+        ("dequeue", "insert", insert_rows),
+    ):
+        setattr(
+            engine_class,
+            name,
+            stats.measure(stage, rows)(getattr(engine_class, name)),
+        )
+
+
+def create_tasks(args):
+    ep_client_list = {
+        f"{100 + ep}": [
+            f"domainName{ep * args.clients + client}" for client in range(args.clients)
+        ]
+        for ep in range(args.eps)
+    }
+    queries = {f"Query{query}": QUERY for query in range(args.queries)}
+    tasks = QueryExecutor(queries, batch_clients=args.batch_clients).create_tasks(
+        ep_client_list
+    )
+    return tasks[: args.searches] if args.searches else tasks
+
+
+def run_sync(args, mock, tasks, stats):
+    mongo = MemoryMongoClient(insert_seconds=args.insert_seconds)
+    mongoclient._shared_client, mongoclient._shared_client_pid = mongo, os.getpid()
+    http_client._client = httpx.Client(transport=mock.transport())
+    http_client._client_pid = os.getpid()
+    limiter.init_worker(
+        limiter.SharedConsoleLimiter(requests_per_second=args.requests_per_second)
+    )
+    instrument(ProducerConsumer, stats)
+    with ThreadPoolExecutor(SEARCH_PROCESSES) as executor:
+        while tasks:
+            tasks = [
+                half
+                for halves in executor.map(initiate.run_search_task, tasks)
+                for half in halves
+            ]
+    return sum(mongo.documents().values())
+
+
+async def run_async(args, mock, tasks, stats):
+    mongo = AsyncMemoryMongoClient(insert_seconds=args.insert_seconds)
+    console_limiter = limiter.ConsoleLimiter(
+        requests_per_second=args.requests_per_second
+    )
+    instrument(AsyncProducerConsumer, stats)
+    async with httpx.AsyncClient(transport=mock.transport(asynchronous=True)) as client:
+
+        async def run_search(task):
+            producer_consumer = AsyncProducerConsumer(
+                query_expression=task.query_expression,
+                query_name=task.query_name,
+                client=task.client,
+                event_processor=task.event_processor,
+                query_start_time=time.perf_counter(),
+                query_duration_start=task.query_duration_start,
+                query_duration_stop=task.query_duration_stop,
+                http_client=client,
+                mongo_client=mongo,
+                limiter=console_limiter,
+                clients=task.clients,
+            )
+            await producer_consumer.run()
+
+        await WorkScheduler().run(tasks, run_search)
+    return sum(mongo.documents().values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=("sync", "async", "both"), default="both")
+    parser.add_argument("--searches", type=int, default=0, help="0 for all of them")
+    parser.add_argument("--eps", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=4, help="per event processor")
+    parser.add_argument("--queries", type=int, default=1)
+    parser.add_argument("--batch-clients", action="store_true")
+    parser.add_argument("--rows", type=int, default=20000, help="per search")
+    parser.add_argument("--row-bytes", type=int, default=300)
+    parser.add_argument("--search-seconds", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="per API call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--insert-seconds", type=float, default=0.0, help="per batch")
+    parser.add_argument("--requests-per-second", type=float, default=1000)
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep the INFO logs")
+    parser.add_argument("--metrics", help="file to write the recorded metrics to")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    engines = ("sync", "async") if args.engine == "both" else (args.engine,)
+    for engine in engines:
+        with tempfile.TemporaryDirectory() as directory:
+            # A fresh checkpoint database, otherwise the second engine would skip everything.
+            checkpoint._store = checkpoint.CheckpointStore(
+                str(Path(directory) / "searches.sqlite3")
+            )
+            checkpoint._store_pid = os.getpid()
+            mock = MockAriel(
+                rows=args.rows,
+                row_bytes=args.row_bytes,
+                search_seconds=args.search_seconds,
+                latency=args.latency,
+                error_rate=args.error_rate,
+                search_error_rate=args.search_error_rate,
+            )
+            tasks = create_tasks(args)
+            stats = StageStats(args.trace_memory)
+            started, cpu = time.perf_counter(), time.process_time()
+            if engine == "sync":
+                rows = run_sync(args, mock, tasks, stats)
+            else:
+                rows = asyncio.run(run_async(args, mock, tasks, stats))
+            stats.report(
+                engine,
+                time.perf_counter() - started,
+                time.process_time() - cpu,
+                rows,
+            )
+            print(f"{len(tasks)} searches, {mock.calls} API calls")
+    if args.metrics:
+        with open(args.metrics, "w") as file:
+            file.write(metrics.render(metrics.merge([metrics.registry.snapshot()])))
+
+
+if __name__ == "__main__":
+    main()
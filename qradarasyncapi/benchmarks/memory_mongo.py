@@ -0,0 +1,142 @@
+"""In-memory stand-ins for MongoClient and AsyncIOMotorClient.
+
+Only what the insert stage uses is implemented: databases, collections, with_options,
+insert_many and bulk_write of ReplaceOne upserts. Documents aren't kept, only their count and
+_ids, so a benchmark measures the connector rather than the stand-in. Duplicate _ids fail
+with a BulkWriteError like MongoDB does, insert_seconds simulates the time MongoDB takes per
+batch.
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class MemoryCollection:
+    def __init__(self, name, insert_seconds=0.0):
+        self.name = name
+        self.insert_seconds = insert_seconds
+        self.count = 0
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def with_options(self, **kwargs):
+        return self
+
+    def store(self, logs, upsert=False):
+        """Returns (indexes of the inserted documents, matched, write_errors) of a batch."""
+        inserted = []
+        matched = 0
+        write_errors = []
+        with self.lock:
+            for index, log in enumerate(logs):
+                _id = log.get("_id")
+                if _id is None:
+                    inserted.append(index)
+                elif _id not in self.ids:
+                    self.ids.add(_id)
+                    inserted.append(index)
+                elif upsert:
+                    matched += 1
+                else:
+                    write_errors.append(
+                        {
+                            "index": index,
+                            "code": DUPLICATE_KEY_ERROR,
+                            "errmsg": f"E11000 duplicate key error dup key: {_id}",
+                        }
+                    )
+            self.count += len(inserted)
+        return inserted, matched, write_errors
+
+    def insert_many(self, logs, ordered=True):
+        time.sleep(self.insert_seconds)
+        return self.insert_result(logs)
+
+    def bulk_write(self, requests, ordered=True):
+        time.sleep(self.insert_seconds)
+        return self.bulk_write_result(requests)
+
+    def insert_result(self, logs):
+        inserted, _, write_errors = self.store(logs)
+        if write_errors:
+            raise BulkWriteError(
+                {"writeErrors": write_errors, "nInserted": len(inserted)}
+            )
+        return SimpleNamespace(inserted_ids=[None] * len(inserted))
+
+    def bulk_write_result(self, requests):
+        documents = [request._doc for request in requests]
+        inserted, matched, _ = self.store(documents, upsert=True)
+        return SimpleNamespace(
+            upserted_count=len(inserted),
+            matched_count=matched,
+            upserted_ids={index: documents[index]["_id"] for index in inserted},
+        )
+
+
+class AsyncMemoryCollection(MemoryCollection):
+    async def insert_many(self, logs, ordered=True):
+        await asyncio.sleep(self.insert_seconds)
+        return self.insert_result(logs)
+
+    async def bulk_write(self, requests, ordered=True):
+        await asyncio.sleep(self.insert_seconds)
+        return self.bulk_write_result(requests)
+
+
+class MemoryDatabase:
+    def __init__(self, name, collection_class, insert_seconds):
+        self.name = name
+        self.collections = {}
+        self.collection_class = collection_class
+        self.insert_seconds = insert_seconds
+        self.lock = threading.Lock()
+
+    def get_collection(self, name, **kwargs):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = self.collection_class(
+                    name, self.insert_seconds
+                )
+            return self.collections[name]
+
+    __getitem__ = get_collection
+
+
+class MemoryMongoClient:
+    collection_class = MemoryCollection
+
+    def __init__(self, insert_seconds=0.0):
+        self.insert_seconds = insert_seconds
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def get_database(self, name, **kwargs):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = MemoryDatabase(
+                    name, self.collection_class, self.insert_seconds
+                )
+            return self.databases[name]
+
+    __getitem__ = get_database
+
+    def documents(self):
+        """Documents stored per database and collection."""
+        return {
+            (database.name, collection.name): collection.count
+            for database in self.databases.values()
+            for collection in database.collections.values()
+        }
+
+    def close(self):
+        pass
+
+
+class AsyncMemoryMongoClient(MemoryMongoClient):
+    collection_class = AsyncMemoryCollection
@@ -0,0 +1,230 @@
+"""In-process stand-in for the QRadar Ariel API.
+
+MockAriel answers the calls the connector makes, served through an httpx transport so the
+real clients can be pointed at it without a console, TLS or network:
+
+    POST   /api/ariel/searches                  triggers a search
+    GET    /api/ariel/searches                  cursor_ids of the searches, honouring Range
+    GET    /api/ariel/searches/{cursor_id}      search status (POST polls the same way)
+    DELETE /api/ariel/searches/{cursor_id}      deletes the search
+    GET    /api/ariel/searches/{cursor_id}/results
+                                                streams the events in the {  "events":[...]}
+                                                format QRadar uses, honouring Range: items=x-y
+
+A search runs for search_seconds, its progress and record_count grow linearly until then.
+Events are synthetic, their domainName is taken from the DOMAINNAME(domainId) filter of the
+query (a single client or an IN list) and their Start Time from its START clause. Every call
+fails with a 503 with probability error_rate and every search fails with error_messages with
+probability search_error_rate.
+"""
+
+import asyncio
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+import httpx
+import orjson
+
+SEARCH_PATH = re.compile(r"^/api/ariel/searches(?:/([^/]+))?(/results)?$")
+DOMAIN_FILTER = re.compile(
+    r"DOMAINNAME\(domainId\)\s*(?:=\s*'([^']*)'|IN\s*\(([^)]*)\))", re.IGNORECASE
+)
+START_CLAUSE = re.compile(r"START\s+'([^']+)'", re.IGNORECASE)
+
+
+class EventStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Results body generated chunk by chunk, readable by sync and async clients."""
+
+    def __init__(self, search, start, stop, chunk_rows):
+        self.search = search
+        self.start = start
+        self.stop = stop
+        self.chunk_rows = chunk_rows
+
+    def __iter__(self):
+        yield b'{  "events":['
+        for first in range(self.start, self.stop + 1, self.chunk_rows):
+            last = min(first + self.chunk_rows - 1, self.stop)
+            chunk = b",\n".join(
+                orjson.dumps(self.search.event(index)) for index in range(first, last + 1)
+            )
+            yield chunk if first == self.start else b",\n" + chunk
+        yield b"]}"
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+
+class MockSearch:
+    def __init__(self, cursor_id, query_expression, record_count, row_bytes, failed):
+        self.cursor_id = cursor_id
+        self.query_expression = query_expression
+        self.record_count = record_count
+        self.row_bytes = row_bytes
+        self.failed = failed
+        self.started = time.monotonic()
+        domains = DOMAIN_FILTER.search(query_expression)
+        if domains and domains.group(1) is not None:
+            self.domains = [domains.group(1)]
+        elif domains:
+            self.domains = re.findall(r"'([^']*)'", domains.group(2))
+        else:
+            self.domains = ["domainName1"]
+        start = START_CLAUSE.search(query_expression)
+        self.start_time = int(
+            (
+                datetime.fromisoformat(start.group(1)) if start else datetime.now()
+            ).timestamp()
+            * 1000
+        )
+        self.padding = "x" * max(row_bytes - 160, 0)
+
+    def event(self, index):
+        return {
+            "domainName": self.domains[index % len(self.domains)],
+            "Log Source": f"Log Source {index % 500}",
+            "Source IP": f"10.0.{index // 256 % 256}.{index % 256}",
+            "Desitnation IP": f"192.168.{index // 256 % 256}.{index % 256}",
+            "Start Time": self.start_time + index * 10,
+            "Payload": self.padding,
+        }
+
+
+class MockAriel:
+    """Simulated Ariel API, see the module docstring.
+
+    Args:
+        rows (int): record_count of every search.
+        row_bytes (int): Approximate size of an event in the results.
+        search_seconds (float): Time a search takes to complete.
+        latency (float): Seconds added to every call.
+        error_rate (float): Probability of a call failing with a 503.
+        search_error_rate (float): Probability of a search failing with error_messages.
+        chunk_rows (int): Events per chunk of the streamed results.
+    """
+
+    def __init__(
+        self,
+        rows=10000,
+        row_bytes=300,
+        search_seconds=1.0,
+        latency=0.0,
+        error_rate=0.0,
+        search_error_rate=0.0,
+        chunk_rows=500,
+        seed=0,
+    ):
+        self.rows = rows
+        self.row_bytes = row_bytes
+        self.search_seconds = search_seconds
+        self.latency = latency
+        self.error_rate = error_rate
+        self.search_error_rate = search_error_rate
+        self.chunk_rows = chunk_rows
+        self.random = random.Random(seed)
+        self.searches = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.triggers = 0
+
+    def transport(self, asynchronous=False):
+        if asynchronous:
+            return httpx.MockTransport(self.handle_async)
+        return httpx.MockTransport(self.handle_sync)
+
+    def handle_sync(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.handle(request)
+
+    async def handle_async(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.handle(request)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        with self.lock:
+            self.calls += 1
+            failed = self.random.random() < self.error_rate
+        if failed:
+            return httpx.Response(503, json={"message": "Service Unavailable"})
+        match = SEARCH_PATH.match(request.url.path)
+        if match is None:
+            return httpx.Response(404, json={"message": "Not Found"})
+        cursor_id, results = match.groups()
+        if cursor_id is None:
+            if request.method == "GET":
+                return self.list_searches(request)
+            if request.method != "POST":
+                return httpx.Response(405, json={"message": "Method Not Allowed"})
+            return self.trigger(request)
+        search = self.searches.get(cursor_id)
+        if search is None:
+            return httpx.Response(404, json={"message": "Search not found"})
+        if results:
+            return self.results(request, search)
+        if request.method == "DELETE":
+            del self.searches[cursor_id]
+            return httpx.Response(202, json=self.status(search))
+        return httpx.Response(200, json=self.status(search))
+
+    def trigger(self, request):
+        query_expression = request.url.params.get("query_expression", "")
+        with self.lock:
+            self.triggers += 1
+            failed = self.random.random() < self.search_error_rate
+        search = MockSearch(
+            str(uuid.uuid4()), query_expression, self.rows, self.row_bytes, failed
+        )
+        self.searches[search.cursor_id] = search
+        return httpx.Response(201, json=self.status(search))
+
+    def list_searches(self, request):
+        cursor_ids = list(self.searches)
+        range_header = request.headers.get("Range")
+        if range_header:
+            match = re.match(r"items=(\d+)-(\d+)", range_header)
+            if match is None:
+                return httpx.Response(416, json={"message": "Invalid Range"})
+            cursor_ids = cursor_ids[int(match.group(1)) : int(match.group(2)) + 1]
+        return httpx.Response(200, json=cursor_ids)
+
+    def status(self, search):
+        elapsed = time.monotonic() - search.started
+        progress = min(100, int(100 * elapsed / max(self.search_seconds, 1e-9)))
+        status = {
+            "cursor_id": search.cursor_id,
+            "progress": progress,
+            "completed": progress == 100,
+            "status": "COMPLETED" if progress == 100 else "EXECUTE",
+            "record_count": search.record_count * progress // 100,
+            "query_string": search.query_expression,
+        }
+        if search.failed and progress >= 50:
+            status["completed"] = False
+            status["status"] = "ERROR"
+            status["error_messages"] = [
+                {"code": "mock", "message": "Search failed (simulated)"}
+            ]
+        return status
+
+    def results(self, request, search):
+        if not self.status(search)["completed"]:
+            return httpx.Response(404, json={"message": "Search not completed"})
+        start, stop = 0, search.record_count - 1
+        range_header = request.headers.get("Range")
+        if range_header:
+            match = re.match(r"items=(\d+)-(\d+)", range_header)
+            if match is None:
+                return httpx.Response(416, json={"message": "Invalid Range"})
+            start = int(match.group(1))
+            stop = min(int(match.group(2)), search.record_count - 1)
+        return httpx.Response(
+            200,
+            headers={"Content-Type": "application/json"},
+            stream=EventStream(search, start, stop, self.chunk_rows),
+        )
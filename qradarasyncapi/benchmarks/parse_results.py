@@ -0,0 +1,105 @@
+"""Benchmark of the results parsing: "},\n" delimiter splitting vs EventStreamParser.
+
+Run from the qradarasyncapi folder:
+
+    python -m benchmarks.parse_results --size-mb 2048
+
+The fixture is generated once in the same {  "events":[...]} format QRadar streams and
+reused on later runs with the same --fixture path.
+"""
+
+import argparse
+import json
+import random
+import tempfile
+import time
+from json import JSONDecoder
+from pathlib import Path
+from utils.results import EventStreamParser
+
+CHUNK_SIZE = 64 * 1024
+
+
+def write_fixture(path: Path, size_mb: int):
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, "w", encoding="utf-8") as fixture:
+        fixture.write('{  "events":[')
+        first = True
+        while written < target:
+            event = {
+                "domainName": "domainName1",
+                "Log Source": f"Log Source {random.randint(0, 500)}",
+                "Source IP": f"10.0.{random.randint(0, 255)}.{random.randint(0, 255)}",
+                "Desitnation IP": f"192.168.{random.randint(0, 255)}.{random.randint(0, 255)}",
+                "Start Time": 1700000000000 + random.randint(0, 86400000),
+            }
+            line = ("" if first else ",\n") + json.dumps(event)
+            written += fixture.write(line)
+            first = False
+        fixture.write("]}")
+
+
+def read_chunks(path: Path):
+    with open(path, "rb") as fixture:
+        while chunk := fixture.read(CHUNK_SIZE):
+            yield chunk
+
+
+def legacy_parse(path: Path):
+    """The former enqueue -> queue_writer -> dequeue string handling, without the queue."""
+    decoder = JSONDecoder()
+    rows = 0
+    buffer = ""
+    for chunk in read_chunks(path):
+        buffer += chunk.decode("utf-8")
+        *lines, buffer = buffer.split("},\n")
+        for line in lines:
+            line = line.replace("\n", "").removeprefix('{  "events":[') + "}"
+            line = line.removeprefix(",").replace("\n", "") + "}"
+            decoder.raw_decode(line)
+            rows += 1
+    if buffer:
+        decoder.raw_decode(buffer.replace("\n", "") + "}")
+        rows += 1
+    return rows
+
+
+def stream_parse(path: Path):
+    parser = EventStreamParser()
+    rows = 0
+    for chunk in read_chunks(path):
+        rows += len(parser.feed(chunk))
+    parser.close()
+    return rows
+
+
+def run(name, function, path: Path):
+    size_mb = path.stat().st_size / 1024 / 1024
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    rows = function(path)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    print(
+        f"{name:<10} {rows:>12,} rows {wall:8.2f} s {size_mb / wall:8.1f} MB/s "
+        f"{rows / wall:12,.0f} rows/s {cpu / rows * 1e6:8.2f} us CPU/row"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument(
+        "--fixture",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "ariel_results_fixture.json",
+    )
+    args = parser.parse_args()
+    if not args.fixture.exists():
+        print(f"Writing {args.size_mb} MB fixture to {args.fixture}")
+        write_fixture(args.fixture, args.size_mb)
+    run("legacy", legacy_parse, args.fixture)
+    run("stream", stream_parse, args.fixture)
+
+
+if __name__ == "__main__":
+    main()
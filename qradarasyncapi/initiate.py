@@ -1,13 +1,26 @@
 import logging
+import time
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
 from utils.logger import SetupLogging
 from producerconsumer import ProducerConsumer
 from queue import Queue
-from query_executor import QueryExecutor
+from query_executor import QueryExecutor, pending_tasks, split_task
 from datetime import datetime
 from utils import attributes
+from utils.constants import ADAPTIVE_WINDOWS, SEARCH_PROCESSES, SPOOL_RESULTS
+from utils.limiter import SharedConsoleLimiter, init_worker
+from utils.http_client import close_client
+from utils.checkpoint import get_checkpoint_store
+from utils.metrics import init_worker_metrics, publish, start_exporter
+from utils.provisioning import (
+    build_deferred_indexes,
+    collection_targets,
+    provision_collections,
+)
+from mongoclient import close_shared_client
 import multiprocessing as mp
+from multiprocessing.util import Finalize
 import dotenv
 
 # TODO: Handle exceptions properly by removing the generic "Exception"
@@ -22,10 +35,16 @@ def initiate_producerconsumer(
     query_start_time,
     query_duration_start,
     query_duration_stop,
+    clients=None,
 ):
-    # Init Logger
+    """Runs one search from trigger to insert.
+
+    Returns:
+        bool: True if the search was cancelled to split its window, see utils/windows.py.
+    """
+    # Routes the logs of this worker to the client's log file.
     SetupLogging().setup_logging(
-        event_processor=event_processor, client=client
+        event_processor=event_processor.replace(" ", ""), client=client
     )
     producer_consumer = ProducerConsumer(
         query_name=query_name,
@@ -35,9 +54,16 @@ def initiate_producerconsumer(
         query_start_time=query_start_time,
         query_duration_start=query_duration_start,
         query_duration_stop=query_duration_stop,
+        clients=clients,
     )
     try:
-        producer_consumer_response = producer_consumer.start_producer()
+        # The search occupies a console search slot until it completes or fails.
+        with producer_consumer.limiter.search_slot():
+            producer_consumer_response = producer_consumer.reattach()
+            if not producer_consumer_response and not producer_consumer.split:
+                producer_consumer_response = producer_consumer.start_producer()
+        if producer_consumer.split:
+            return True
         if producer_consumer_response:
             (
                 response_header,
@@ -50,6 +76,8 @@ def initiate_producerconsumer(
                 request_status = response_header.get("status")
                 progress = response_header.get("progress")
                 if record_count == 0 or record_count is None:
+                    if record_count == 0:
+                        producer_consumer.finish_search(cursor_id)
                     logging.info(
                         msg="No records found",
                         extra={
@@ -88,13 +116,31 @@ def initiate_producerconsumer(
                         },
                     )
                 else:
-                    with ThreadPoolExecutor(
-                        max_workers=2,
-                    ) as executor:
-                        executor.submit(
-                            producer_consumer.dequeue, response_header
-                        )
-                        executor.submit(producer_consumer.enqueue, cursor_id)
+                    ranges = producer_consumer.pending_ranges(cursor_id, record_count)
+                    if not ranges:
+                        # A previous run stored all of them.
+                        producer_consumer.finish_search(cursor_id)
+                        return
+                    try:
+                        with ThreadPoolExecutor(
+                            max_workers=2,
+                        ) as executor:
+                            # Results go to MongoDB, or to the local spool, see utils/spool.py.
+                            executor.submit(
+                                producer_consumer.spool
+                                if SPOOL_RESULTS
+                                else producer_consumer.dequeue,
+                                response_header,
+                                ranges,
+                            )
+                            executor.submit(
+                                producer_consumer.enqueue,
+                                cursor_id,
+                                record_count,
+                                ranges,
+                            )
+                    finally:
+                        producer_consumer.queue.close()
             else:
                 pass
     except TypeError as type_error:
@@ -119,19 +165,84 @@ def initiate_producerconsumer(
         )
 
 
+def run_search_task(task):
+    """Pool worker: runs a single SearchTask and returns once its results are stored.
+
+    Returns:
+        list[SearchTask]: The halves of the window if the search was split, to be run next.
+    """
+    split = initiate_producerconsumer(
+        query_expression=task.query_expression,
+        query_name=task.query_name,
+        client=task.client,
+        event_processor=task.event_processor,
+        query_start_time=time.perf_counter(),
+        query_duration_start=task.query_duration_start,
+        query_duration_stop=task.query_duration_stop,
+        clients=task.clients,
+    )
+    publish(force=True)
+    return split_task(task) if split else []
+
+
+def init_search_worker(limiter):
+    """Pool initializer: installs the shared limiter and closes this worker's clients on exit."""
+    SetupLogging().setup_logging()
+    init_worker(limiter)
+    init_worker_metrics()
+    Finalize(None, close_shared_client, exitpriority=10)
+    Finalize(None, close_client, exitpriority=10)
+
+
 def starter():
-    """_summary_"""
+    """Flattens all searches into one work queue drained by a pool of worker processes.
+
+    Each worker picks up the next search as soon as it finishes the previous one, so an
+    event processor with many clients no longer keeps a single worker busy on its own.
+    """
     SetupLogging().setup_logging()
     attributes_dict = attributes.get_attributes()
+    exporter = start_exporter()
     try:
-        with mp.Pool(processes=8) as pool:
-            query = QueryExecutor(queries=attributes_dict.queries)
-            pool.starmap(
-                query.query_creator,
-                zip(
-                    list(attributes_dict.ep_client_list.keys()),
-                    list(attributes_dict.ep_client_list.values()),
-                ),
+        tasks = QueryExecutor(
+            queries=attributes_dict.queries,
+            history=get_checkpoint_store() if ADAPTIVE_WINDOWS else None,
+        ).create_tasks(attributes_dict.ep_client_list)
+        tasks = pending_tasks(tasks)
+        # Spooled results are only inserted by spool_loader.py, which provisions itself.
+        targets = (
+            []
+            if SPOOL_RESULTS
+            else collection_targets(
+                attributes_dict.ep_client_list, attributes_dict.queries
             )
+        )
+        provision_collections(targets)
+        limiter = SharedConsoleLimiter()
+        with mp.Pool(
+            processes=SEARCH_PROCESSES,
+            initializer=init_search_worker,
+            initargs=(limiter,),
+        ) as pool:
+            # Searches split because they were too big come back as two halves, which are
+            # run once the current round is done.
+            while tasks:
+                tasks = [
+                    half
+                    for halves in pool.imap_unordered(
+                        run_search_task, tasks, chunksize=1
+                    )
+                    for half in halves
+                ]
+            # Let the workers exit on their own so that their finalizers close the clients,
+            # leaving the with block terminates them.
+            pool.close()
+            pool.join()
+        build_deferred_indexes(targets)
     except Exception as my_generic_exp:
         logging.exception(f"Generic Exception: {my_generic_exp}")
+    finally:
+        close_shared_client()
+        close_client()
+        if exporter:
+            exporter.close()
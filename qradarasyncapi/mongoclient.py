@@ -5,6 +5,14 @@ import urllib.parse
 import dotenv
 from pathlib import Path
 from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from utils.constants import (
+    MONGO_MAX_POOL_SIZE,
+    MONGO_COMPRESSORS,
+    MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS,
+)
 
 dotenv.load_dotenv(Path(__file__).parent.parent / "config" / ".env")
 
@@ -17,14 +25,61 @@ class MongoDBConnection(object):
         self.port = int(os.environ.get("MONGO_PORT"))
         self.username = os.environ.get("MONGO_USERNAME")
         self.pwd = urllib.parse.quote_plus(os.environ.get("MONGO_PWD"))
+        self.uri = f"mongodb://{self.username}:{self.pwd}@{self.host0}:{self.port},{self.host1}:{self.port},{self.host2}:{self.port}/?authMechanism=SCRAM-SHA-1&authSource=admin"
+        self.options = {
+            "maxPoolSize": MONGO_MAX_POOL_SIZE,
+            "compressors": MONGO_COMPRESSORS,
+            "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+            "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        }
 
-    def get_client(self) -> MongoClient:
+    def get_client(self, **options) -> MongoClient:
+        """Returns a new MongoClient, options override the default client options."""
         try:
-            client: MongoClient = MongoClient(
-                f"mongodb://{self.username}:{self.pwd}@{self.host0}:{self.port},{self.host1}:{self.port},{self.host2}:{self.port}/?authMechanism=SCRAM-SHA-1&authSource=admin"
-            )
+            client: MongoClient = MongoClient(self.uri, **{**self.options, **options})
             return client
         except Exception as my_generic_exp:
             logging.warning(
                 "Exception in MyMongoClient __init__(): %s", my_generic_exp
             )
+
+    def get_async_client(self) -> AsyncIOMotorClient:
+        """Motor client for the asyncio engine. Must be created inside the running event loop."""
+        try:
+            client: AsyncIOMotorClient = AsyncIOMotorClient(
+                self.uri, **self.options
+            )
+            return client
+        except Exception as my_generic_exp:
+            logging.warning(
+                "Exception in MyMongoClient get_async_client(): %s",
+                my_generic_exp,
+            )
+
+
+# One MongoClient per process: its connection pool, authentication and monitor threads are
+# shared by every search the process runs. MongoClient isn't fork-safe, so a forked worker
+# creates its own on first use.
+_shared_client = None
+_shared_client_pid = None
+
+
+def get_shared_client() -> MongoClient:
+    global _shared_client, _shared_client_pid
+    if _shared_client is None or _shared_client_pid != os.getpid():
+        _shared_client = MongoDBConnection().get_client()
+        _shared_client_pid = os.getpid()
+    return _shared_client
+
+
+def close_shared_client():
+    global _shared_client
+    if _shared_client is not None and _shared_client_pid == os.getpid():
+        _shared_client.close()
+    _shared_client = None
+
+
+def database_name(client):
+    """Database of a client, MongoDB doesn't accept " " and "." in database names."""
+    return client.replace(" ", "").replace(".", "")
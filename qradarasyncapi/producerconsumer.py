@@ -1,24 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from queue import Queue, Empty
-from json import JSONDecoder
+from functools import partial
+from queue import Empty, Full
 import os
 import logging
 import time
 from pathlib import Path
 import dotenv
-import requests
+import httpx
 import json
-from mongoclient import MongoDBConnection
-from utils.logger import SetupLogging
-from dateutil.relativedelta import relativedelta, SA
-import urllib3
+from mongoclient import database_name, get_shared_client
+from utils.enrichment import add_date, add_dates
+from utils.limiter import get_shared_limiter
+from utils.http_client import get_client
+from utils.batch_queue import BatchQueue
+from utils.document_ids import DocumentIds
+from utils.windows import should_split
+from utils.bulk_writer import BulkWriter, RoutedBulkWriter
+from utils.results import (
+    EventStreamParser,
+    batch_is_full,
+    get_ranges,
+    parse_events,
+    split_batches,
+)
+from utils.polling import PollSchedule
+from utils.retry import RETRIGGER, RetryPolicy, error_details, error_message
+from utils.cursors import is_reusable
+from utils.metrics import SearchMetrics
+from utils.memory import memory_stats
+from utils.spool import Spool
+from utils.checkpoint import (
+    RangeTracker,
+    checkpoint_key,
+    get_checkpoint_store,
+)
 from utils.constants import (
     SHORT_DURATION_QUERIES,
-    SHORT_SEARCH_DURATION,
-    LONG_SEARCH_DURATION,
+    SHORT_POLL_MAX_INTERVAL,
+    LONG_POLL_MAX_INTERVAL,
+    RESULT_CHUNK_SIZE,
+    ADAPTIVE_WINDOWS,
+    IDEMPOTENT_INSERTS,
+    RESULT_CHUNK_PARALLELISM,
+    RESULT_CHUNK_ATTEMPTS,
+    DELETE_COMPLETED_SEARCHES,
+    REUSE_SEARCHES,
+    REUSE_LOOKUP_MAX,
 )
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # TODO: Handle exceptions properly by removing the generic "Exception"
 dotenv.load_dotenv(Path(__file__).parent.parent / "config" / ".env")
 
@@ -35,6 +65,7 @@ class ProducerConsumer:
         query_start_time,
         query_duration_start,
         query_duration_stop,
+        clients=None,
     ):
         self.sec_token = os.environ.get("MONGODB_SEC_TOKEN")
         self.qradar_console_id = os.environ.get("QRADAR_CONSOLE_ID")
@@ -45,14 +76,34 @@ class ProducerConsumer:
             "Version": "19.0",
         }
         self.query_url = f"https://{self.qradar_console_id}/api/ariel/searches"
-        self.mongo_client = MongoDBConnection().get_client()
-        self.queue = Queue(maxsize=20000)
+        self.mongo_client = get_shared_client()
+        self.limiter = get_shared_limiter()
+        self.http_client = get_client()
+        self.checkpoint = get_checkpoint_store()
+        self.checkpoint_key = checkpoint_key(
+            event_processor,
+            client,
+            query_name,
+            query_duration_start,
+            query_duration_stop,
+        )
+        self.queue = BatchQueue()
         # Command Line Arguments as parameters start
         self.query_expression = query_expression
         self.query_name = "raw_" + query_name
         self.client = client
+        self.original_client_name = client
+        # Clients covered by a batched search, see QueryExecutor.client_groups.
+        self.clients = clients
         self.event_processor = event_processor.replace(" ", "")
         # Command Line Arguments as parameters end
+        self.metrics = SearchMetrics(self.event_processor, client, query_name)
+        self.triggered = False
+        self.retry = RetryPolicy()
+        # Searches this task triggered, the only ones it deletes, see utils/cursors.py.
+        self.owned_cursors = set()
+        # Searches that failed, never reused.
+        self.failed_cursors = set()
         self.database = None
         self.collection = None
 
@@ -61,122 +112,79 @@ class ProducerConsumer:
         self.post_request_attempt = 1
         self.max_attempts = 10
         self.inserted_records = 0
+        self.poll_stats = {}
+        # Set once the search was cancelled to split its window, see utils/windows.py.
+        self.split = False
         self.query_start_time = query_start_time
         self.query_duration_start = query_duration_start
         self.query_duration_stop = query_duration_stop
-        SetupLogging().setup_logging(
-            event_processor=self.event_processor, client=self.client
-        )
-        print(
-            f"INSIDE INIT - EP: {self.event_processor}, Client: {self.client} - Query: {self.query_name} \t\t\t\t "
-        )
 
     def do_post_requests(self, url):
         """Method of sending Post requests to QRadar for triggering and polling searches.
 
+        Failed requests are retried as self.retry decides, see utils/retry.py.
+
         Args:
             url (str): The Ariel searches URL
 
         Returns:
-            _type_: _description_
+            httpx.Response: None if the request was given up, self.retry.action tells why.
         """
-        session = requests.Session()
-        try:
-            result = session.post(
-                url=url,
-                params={"query_expression": self.query_expression},
-                headers=self.header,
-                verify=False,
-                timeout=120,
-            )
-            result.raise_for_status()
-            return result
-        except requests.exceptions.HTTPError as http_err:
-            error_response = http_err.response.json()
-            if http_err.response.status_code in [500, 501, 502, 503, 504]:
-                logging.error(
-                    msg=f"Server Error",
-                    extra={
-                        "Event Processor": f"{self.event_processor}",
-                        "Attempt": f"{self.post_request_attempt}",
-                        "Client": f"{self.client}",
-                        "Query": f"{self.query_name}",
-                        "Query Duration Start": f"{self.query_duration_start}",
-                        "Query Duration Stop": f"{self.query_duration_stop}",
-                        "QRadar Error Code": f"{error_response.get('http_response').get('code')}",
-                        "QRadar Error Message": f"{error_response.get('http_response').get('message')} - {error_response.get('message')}",
-                    },
+        while True:
+            try:
+                self.limiter.throttle()
+                result = self.http_client.post(
+                    url=url,
+                    params={"query_expression": self.query_expression},
+                    headers=self.header,
+                    timeout=120,
                 )
-                time.sleep(300)
-            elif http_err.response.status_code in [402, 404, 422]:
-                # self.post_request_attempt += 1
-                error_response = http_err.response.json()
+                result.raise_for_status()
+                self.retry.succeeded()
+                return result
+            except httpx.HTTPError as http_err:
+                delay = self.retry.next_delay(http_err)
                 logging.error(
-                    msg=f"Client Error",
+                    msg=f"{error_message(http_err)}: {http_err}",
                     extra={
+                        "Log Time": datetime.utcnow(),
                         "Event Processor": f"{self.event_processor}",
                         "Attempt": f"{self.post_request_attempt}",
-                        "QRadar Error Code": f"{error_response.get('http_response').get('code')}",
-                        "QRadar Error Message": f"{error_response.get('http_response').get('message')} - {error_response.get('message')}",
                         "Client": f"{self.client}",
                         "Query": f"{self.query_name}",
                         "Query Duration Start": f"{self.query_duration_start}",
                         "Query Duration Stop": f"{self.query_duration_stop}",
+                        "Retry Action": f"{self.retry.action}",
+                        "Retry In (in seconds)": (
+                            "given up" if delay is None else f"{delay:.1f}"
+                        ),
+                        **error_details(http_err),
                     },
                 )
-        except requests.exceptions.ConnectionError as conn_err:
-            error_response = conn_err.response.json()
-            # self.post_request_attempt += 1
-            logging.error(
-                msg=f"Connection Refused",
-                extra={
-                    "Event Processor": f"{self.event_processor}",
-                    "Attempt": f"{self.post_request_attempt}",
-                    "Client": f"{self.client}",
-                    "Query": f"{self.query_name}",
-                    "Query Duration Start": f"{self.query_duration_start}",
-                    "Query Duration Stop": f"{self.query_duration_stop}",
-                    "QRadar Error Code": f"{error_response.get('http_response').get('code')}",
-                    "QRadar Error Message": f"{error_response.get('http_response').get('message')} - {error_response.get('message')}",
-                },
-            )
-            time.sleep(30)
-        except requests.exceptions.Timeout as timeout_err:
-            error_response = http_err.response.json()
-            # self.post_request_attempt += 1
-            logging.error(
-                msg=f"Read timed out",
-                extra={
-                    "Event Processor": f"{self.event_processor}",
-                    "Attempt": f"{self.post_request_attempt}",
-                    "Client": f"{self.client}",
-                    "Query": f"{self.query_name}",
-                    "Query Duration Start": f"{self.query_duration_start}",
-                    "Query Duration Stop": f"{self.query_duration_stop}",
-                    "QRadar Error Code": f"{error_response.get('http_response').get('code')}",
-                    "QRadar Error Message": f"{error_response.get('http_response').get('message')} - {error_response.get('message')}",
-                },
-            )
-            time.sleep(30)
-        except requests.exceptions.RequestException as requests_exp:
-            logging.exception(
-                msg=f"Generic Exception: {requests_exp}",
-                extra={
-                    "Log Time": datetime.utcnow(),
-                    "Event Processor": self.event_processor,
-                    "Client": f"{self.client}",
-                    "Query": f"{self.query_name}",
-                    "Query Duration Start": f"{self.query_duration_start}",
-                    "Query Duration Stop": f"{self.query_duration_stop}",
-                },
-            )
-            time.sleep(30)
+                if delay is None:
+                    return None
+                time.sleep(delay)
 
-    def poller(
-        self, regular_sleep, deployment_sleep, error_server_io_sleep, url
-    ):
+    def poller(self, schedule, url):
+        """Polls the search once and waits before the next poll if it is still running.
+
+        Args:
+            schedule (PollSchedule): Polling schedule of this search.
+            url (str): This url contains the cursor_id received for the ongoing search.
+
+        Returns:
+            tuple: (True, response_header) once the search completed, (False, response_header)
+            if the search failed and needs to be triggered again, None if it is still running.
+        """
         try:
+            self.metrics.polled()
             result = self.do_post_requests(url)
+            if result is None:
+                if self.retry.action == RETRIGGER:
+                    # The search is gone from the console.
+                    self.post_request_attempt = self.post_request_attempt + 1
+                    return False, {}
+                return None
             status_code = result.status_code
             response_header = result.json()
             completed: bool = response_header.get("completed")
@@ -187,6 +195,9 @@ class ProducerConsumer:
             error_messages = response_header.get("error_messages")
             # Success Condition:
             if error_messages is None and completed:
+                schedule.complete()
+                self.metrics.completed(schedule.elapsed)
+                self.poll_stats = schedule.stats()
                 logging.info(
                     msg="Search Completed",
                     extra={
@@ -205,46 +216,55 @@ class ProducerConsumer:
                         "Completed Flag": f"{completed}",
                         "Records Found": f"{record_count}",
                         "Response Header": f"{response_header}",
+                        **self.poll_stats,
                     },
                 )
                 return True, response_header
-                # Normal Retry Condition
+            # Normal Retry Condition
             elif error_messages is None and not completed:
-                logging.info(
-                    msg="Checking Search Status",
-                    extra={
-                        "Log Time": datetime.utcnow(),
-                        "Request Type": "Polling",
-                        "Status Code": f"{status_code}",
-                        "Query Duration Start": f"{self.query_duration_start}",
-                        "Query Duration Stop": f"{self.query_duration_stop}",
-                        "Search ID": f"{cursor_id}",
-                        "Event Processor": self.event_processor,
-                        "Client": f"{self.client}",
-                        "Query": f"{self.query_name}",
-                        "Attempt": f"{self.post_request_attempt}",
-                        "Progress": f"{progress}",
-                        "Status": f"{request_status}",
-                        "Completed Flag": f"{completed}",
-                        "Records Found": f"{record_count}",
-                        "Response Header": f"{response_header}",
-                    },
-                )
-                print(
-                    f"Attempt {self.post_request_attempt} - Process: {os.getpid()} Sleeping for {regular_sleep/60} minutes"
-                )
-                time.sleep(regular_sleep)
-                self.post_request_attempt = self.post_request_attempt + 1
-                return self.query_status(url)
+                if ADAPTIVE_WINDOWS and should_split(
+                    schedule,
+                    record_count,
+                    progress,
+                    self.query_duration_start,
+                    self.query_duration_stop,
+                ):
+                    self.split_search(cursor_id, record_count, progress, schedule)
+                    return None
+                sleep = schedule.next_interval(progress)
+                # Logged on every poll, the extra fields are only built when INFO is enabled.
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info(
+                        msg="Checking Search Status",
+                        extra={
+                            "Log Time": datetime.utcnow(),
+                            "Request Type": "Polling",
+                            "Status Code": f"{status_code}",
+                            "Query Duration Start": f"{self.query_duration_start}",
+                            "Query Duration Stop": f"{self.query_duration_stop}",
+                            "Search ID": f"{cursor_id}",
+                            "Event Processor": self.event_processor,
+                            "Client": f"{self.client}",
+                            "Query": f"{self.query_name}",
+                            "Attempt": f"{self.post_request_attempt}",
+                            "Progress": f"{progress}",
+                            "Status": f"{request_status}",
+                            "Completed Flag": f"{completed}",
+                            "Records Found": f"{record_count}",
+                            "Response Header": f"{response_header}",
+                            "Next Poll (in seconds)": f"{sleep:.1f}",
+                            **schedule.stats(),
+                        },
+                    )
+                time.sleep(sleep)
+                return None
             # Abnormal Retry Condition
             else:
-                print(
-                    f"Attempt {self.post_request_attempt} - Process: {os.getpid()} Sleeping for {regular_sleep / 60} minutes"
-                )
                 error_messages_code = error_messages[0].get("code")
                 error_messages_message = error_messages[0].get("message")
+                self.poll_stats = schedule.stats()
                 logging.error(
-                    msg=f"Search Error {regular_sleep / 60} minutes",
+                    msg="Search Error",
                     extra={
                         "Log Time": datetime.utcnow(),
                         "Request Type": "Polling",
@@ -263,43 +283,15 @@ class ProducerConsumer:
                         "QRadar Error Code": f"{error_messages_code}",
                         "QRadar Error Message": f"{error_messages_message}",
                         "Response Header": f"{response_header}",
+                        **self.poll_stats,
                     },
                 )
-                time.sleep(regular_sleep)
                 self.post_request_attempt = self.post_request_attempt + 1
-                # Adding a return False condition here to trigger a completely new API request.
+                # Returning False here to trigger a completely new API request.
                 return False, response_header
-
-            # if self.post_request_attempt == self.max_attempts:
-            #     logging.info(
-            #         msg=f"Exhausted Attempts",
-            #         extra={
-            #             "Log Time": datetime.utcnow(),
-            #             "Request Type": "Polling",
-            #             "Status Code": f"{status_code}",
-            #             "Query Duration Start": f"{self.query_duration_start}",
-            #             "Query Duration Stop": f"{self.query_duration_stop}",
-            #             "Search ID": f"{cursor_id}",
-            #             "Event Processor": self.event_processor,
-            #             "Client": f"{self.client}",
-            #             "Query": f"{self.query_name}",
-            #             "Attempt": f"{self.post_request_attempt}",
-            #             "Progress": f"{progress}",
-            #             "Status": f"{request_status}",
-            #             "Completed Flag": f"{completed}",
-            #             "Records Found": f"{record_count}",
-            #             "Response Header": f"{response_header}",
-            #         },
-            #     )
-            #     time.sleep(regular_sleep)
-            #     self.post_request_attempt += 1
-            #     return self.query_status(url)
-            # self.query_status(url)
-            return True, None
-        except Exception as my_generic_exp:
-            peint("I am here")
+        except ValueError as value_error:
             logging.exception(
-                msg=f"Generic Exception: {my_generic_exp}",
+                msg=f"Invalid JSON: {value_error}",
                 extra={
                     "Log Time": datetime.utcnow(),
                     "Event Processor": self.event_processor,
@@ -309,103 +301,241 @@ class ProducerConsumer:
                     "Query Duration Stop": f"{self.query_duration_stop}",
                 },
             )
+            time.sleep(schedule.next_interval())
 
     def query_status(self, url: str):
         """Polls QRadar /airel/searches/cursor_id endpoint to retrieve the status of the search.
-        Polling interval is set at 90 seconds for SHORT_DURATION_QUERIES -> Authentication Failure, Authentication Success, Allowed Traffic and to 300 seconds for other queries.
-        It polls to check for a completed status max_attempts number of times.
+        Polling starts every few seconds and backs off towards 90 seconds for SHORT_DURATION_QUERIES
+        and 180 seconds for other queries, never waiting past the completion time estimated from
+        the search progress. See PollSchedule.
+        It gives up once the search hasn't completed within POLL_TIMEOUT seconds.
 
         Args:
             self (ProducerConsumer): Object of type ProducerConsumer.
             url (str): This url contains the cursor_id received for the ongoing search.
 
         Returns:
-            any: Returns None if the the number of attempts are exhausted, otherwise returns a boolean.
-            Returns False if a new search needs to be triggered, otherwise returns True.
+            any: Returns None if the search timed out, otherwise returns a tuple (completed, response_header).
+            completed is False if a new search needs to be triggered.
 
         """
-        if self.query_name in SHORT_DURATION_QUERIES:
-            regular_sleep = 90  # 1.5 minutes
+        if self.query_name.removeprefix("raw_") in SHORT_DURATION_QUERIES:
+            max_interval = SHORT_POLL_MAX_INTERVAL
         else:
-            regular_sleep = 180  # 3 minutes
-        deployment_sleep = 10800  # 3 hours
-        error_server_io_sleep = 1800  # 30 minutes
+            max_interval = LONG_POLL_MAX_INTERVAL
+        schedule = PollSchedule(max_interval=max_interval)
+        while not schedule.expired():
+            polling_response = self.poller(schedule, url)
+            if polling_response:
+                return polling_response
+            if self.split or self.retry.given_up:
+                return None
+        logging.error(
+            msg=f"Exhausted Attempts",
+            extra={
+                "Log Time": datetime.utcnow(),
+                "Event Processor": self.event_processor,
+                "Client": f"{self.client}",
+                "Query": f"{self.query_name}",
+                "Query Duration Start": f"{self.query_duration_start}",
+                "Query Duration Stop": f"{self.query_duration_stop}",
+                **schedule.stats(),
+            },
+        )
+
+    def start_check(self, cursor_id):
+        polling_response = self.query_status(
+            f"https://{self.qradar_console_id}/api/ariel/searches/{cursor_id}",
+        )
+        if polling_response:
+            return polling_response[0], polling_response[1]
+
+    def reattach(self):
+        """Resumes the search a previous run triggered, using the cursor_id from its checkpoint.
+
+        Returns:
+            tuple: Same as start_producer, None if there's no checkpointed search still
+            available on the console or it didn't complete.
+        """
+        checkpoint = self.checkpoint.get(self.checkpoint_key)
+        if not checkpoint or not checkpoint["cursor_id"]:
+            return None
+        cursor_id = checkpoint["cursor_id"]
+        extra = {
+            "Log Time": datetime.utcnow(),
+            "Search ID": f"{cursor_id}",
+            "Event Processor": self.event_processor,
+            "Client": f"{self.client}",
+            "Query": f"{self.query_name}",
+            "Query Duration Start": f"{self.query_duration_start}",
+            "Query Duration Stop": f"{self.query_duration_stop}",
+            "Checkpoint State": f"{checkpoint['state']}",
+        }
         try:
-            while self.post_request_attempt <= self.max_attempts:
-                print("\n\n", self.post_request_attempt, "\n\n")
-                polling_response = self.poller(
-                    regular_sleep, deployment_sleep, error_server_io_sleep, url
-                )
-                if polling_response:
-                    completed = polling_response[0]
-                    response_header = polling_response[1]
-                    if completed and response_header:
-                        return completed, response_header
+            self.limiter.throttle()
+            result = self.http_client.get(
+                url=f"{self.query_url}/{cursor_id}",
+                headers=self.header,
+                timeout=120,
+            )
+        except httpx.HTTPError as http_exp:
+            logging.warning(msg=f"Checkpointed Search unavailable: {http_exp}", extra=extra)
+            return None
+        if result.status_code != 200:
+            logging.info(msg="Checkpointed Search expired", extra=extra)
+            return None
+        logging.info(msg="Re-attaching to Search", extra=extra)
+        polling_response = self.start_check(cursor_id)
+        if polling_response and polling_response[0]:
+            response_header = polling_response[1]
+            self.record_completion(cursor_id, response_header)
+            return response_header, True, self.post_request_attempt
 
-        except Exception as my_generic_exp:
-            logging.exception(
-                msg=f"Exhausted Attempts",
+    def split_search(self, cursor_id, record_count, progress, schedule):
+        """Cancels a search that is too big for its window, the caller triggers both halves."""
+        logging.info(
+            msg="Splitting Search",
+            extra={
+                "Log Time": datetime.utcnow(),
+                "Search ID": f"{cursor_id}",
+                "Event Processor": self.event_processor,
+                "Client": f"{self.client}",
+                "Query": f"{self.query_name}",
+                "Query Duration Start": f"{self.query_duration_start}",
+                "Query Duration Stop": f"{self.query_duration_stop}",
+                "Progress": f"{progress}",
+                "Records Found": f"{record_count}",
+                **schedule.stats(),
+            },
+        )
+        if cursor_id in self.owned_cursors:
+            self.owned_cursors.discard(cursor_id)
+            self.delete_search(cursor_id)
+        self.checkpoint.split(self.checkpoint_key)
+        self.split = True
+
+    def delete_search(self, cursor_id):
+        """Deletes the search and its results from the console."""
+        try:
+            self.limiter.throttle()
+            self.http_client.delete(
+                url=f"{self.query_url}/{cursor_id}", headers=self.header, timeout=120
+            )
+        except httpx.HTTPError as http_exp:
+            logging.warning(
+                msg=f"Failed Deleting Search: {http_exp}",
                 extra={
                     "Log Time": datetime.utcnow(),
+                    "Search ID": f"{cursor_id}",
                     "Event Processor": self.event_processor,
                     "Client": f"{self.client}",
                     "Query": f"{self.query_name}",
-                    "Query Duration Start": f"{self.query_duration_start}",
-                    "Query Duration Stop": f"{self.query_duration_stop}",
                 },
             )
 
-    def start_check(self, cursor_id):
-        polling_response = self.query_status(
-            f"https://{self.qradar_console_id}/api/ariel/searches/{cursor_id}",
-        )
-        if polling_response:
-            return polling_response[0], polling_response[1]
+    def find_search(self):
+        """Looks up a search on the console running the same query expression, so that
+        triggering the search doesn't run a duplicate, see utils/cursors.py.
 
-    def start_producer(self):
+        Returns:
+            httpx.Response: Status of the search to reuse, None if there is none.
+        """
+        extra = {
+            "Log Time": datetime.utcnow(),
+            "Event Processor": self.event_processor,
+            "Client": f"{self.client}",
+            "Query": f"{self.query_name}",
+            "Query Duration Start": f"{self.query_duration_start}",
+            "Query Duration Stop": f"{self.query_duration_stop}",
+            "Attempt": f"{self.post_request_attempt}",
+        }
         try:
-            result = self.do_post_requests(self.query_url)
-            if result:
-                response_header = result.json()
-                cursor_id = response_header.get("cursor_id")
-                record_count = response_header.get("record_count")
-                logging.info(
-                    msg=f"Search Triggered",
-                    extra={
-                        "Log Time": datetime.utcnow(),
-                        "Request Type": "Trigger",
-                        "Status Code": f"{result.status_code}",
-                        "Query Duration Start": f"{self.query_duration_start}",
-                        "Query Duration Stop": f"{self.query_duration_stop}",
-                        "Search ID": f"{cursor_id}",
-                        "Event Processor": self.event_processor,
-                        "Client": f"{self.client}",
-                        "Query": f"{self.query_name}",
-                        "Attempt": f"{self.post_request_attempt}",
-                        "Progress": f"{response_header.get('progress')}",
-                        "Status": f"{response_header.get('status')}",
-                        "Completed Flag": f"{response_header.get('completed')}",
-                        "Records Found": f"{response_header.get('record_count')}",
-                        "Response Header": f"{response_header}",
-                    },
+            self.limiter.throttle()
+            result = self.http_client.get(
+                url=self.query_url,
+                headers={**self.header, "Range": f"items=0-{REUSE_LOOKUP_MAX - 1}"},
+                timeout=120,
+            )
+            result.raise_for_status()
+            for cursor_id in result.json():
+                if cursor_id in self.failed_cursors:
+                    continue
+                self.limiter.throttle()
+                status = self.http_client.get(
+                    url=f"{self.query_url}/{cursor_id}", headers=self.header, timeout=120
                 )
-                polling_response = self.start_check(cursor_id)
-                if polling_response:
-                    completed = polling_response[0]
-                    response_header = polling_response[1]
-                    if completed:
-                        print("\n\nSearch Completed\n\n", response_header)
-                        return (
-                            response_header,
-                            completed,
-                            self.post_request_attempt,
-                        )
-                    else:
-                        print("\n\nSearch not completed\n\n", response_header)
-                        self.start_producer()
-                else:
+                if status.status_code == 200 and is_reusable(
+                    status.json(), self.query_expression
+                ):
                     logging.info(
-                        msg=f"Exhausted Attempts",
+                        msg="Reusing Search",
+                        extra={**extra, "Search ID": f"{cursor_id}"},
+                    )
+                    return status
+        except (httpx.HTTPError, ValueError) as exp:
+            logging.warning(msg=f"Failed Looking Up Searches: {exp}", extra=extra)
+        return None
+
+    def discard_search(self, cursor_id):
+        """Deletes a failed search before it is triggered again, it's never reused."""
+        self.failed_cursors.add(cursor_id)
+        if DELETE_COMPLETED_SEARCHES and cursor_id in self.owned_cursors:
+            self.owned_cursors.discard(cursor_id)
+            self.delete_search(cursor_id)
+
+    def finish_search(self, cursor_id):
+        """Checkpoints that all results of the search are stored and deletes it from the
+        console, its results are no longer needed."""
+        self.checkpoint.finished(self.checkpoint_key)
+        if DELETE_COMPLETED_SEARCHES and cursor_id in self.owned_cursors:
+            self.owned_cursors.discard(cursor_id)
+            self.delete_search(cursor_id)
+
+    def record_completion(self, cursor_id, response_header):
+        """Checkpoints the completed search and records its size for planning windows."""
+        record_count = response_header.get("record_count")
+        self.checkpoint.completed(self.checkpoint_key, cursor_id, record_count)
+        if record_count is not None:
+            self.checkpoint.observed(
+                self.original_client_name,
+                self.query_name.removeprefix("raw_"),
+                self.query_duration_start,
+                self.query_duration_stop,
+                record_count,
+            )
+
+    def pending_ranges(self, cursor_id, record_count):
+        """Result ranges of the cursor that aren't stored in MongoDB yet, see get_ranges."""
+        done_ranges = self.checkpoint.done_ranges(self.checkpoint_key, cursor_id)
+        return [
+            chunk
+            for chunk in get_ranges(record_count, RESULT_CHUNK_SIZE)
+            if chunk not in done_ranges
+        ]
+
+    def start_producer(self):
+        """Triggers the search and waits for it to complete, re-triggering failed searches up
+        to max_attempts times and until the retry deadline.
+
+        Returns:
+            tuple: (response_header, completed, attempt) of the completed search, None if it
+            didn't complete.
+        """
+        if not self.triggered:
+            # Time spent waiting for a console search slot, re-triggers don't count.
+            self.triggered = True
+            self.metrics.queued(time.perf_counter() - self.query_start_time)
+        try:
+            while self.post_request_attempt <= self.max_attempts:
+                # Looks for an identical search that is already running before triggering one.
+                reused = self.find_search() if REUSE_SEARCHES else None
+                result = reused or self.do_post_requests(self.query_url)
+                if result:
+                    response_header = result.json()
+                    cursor_id = response_header.get("cursor_id")
+                    record_count = response_header.get("record_count")
+                    logging.info(
+                        msg=f"Search Triggered",
                         extra={
                             "Log Time": datetime.utcnow(),
                             "Request Type": "Trigger",
@@ -424,8 +554,73 @@ class ProducerConsumer:
                             "Response Header": f"{response_header}",
                         },
                     )
-            else:
-                pass
+                    self.checkpoint.triggered(self.checkpoint_key, cursor_id)
+                    if reused is None:
+                        self.owned_cursors.add(cursor_id)
+                    polling_response = self.start_check(cursor_id)
+                    if polling_response:
+                        completed = polling_response[0]
+                        response_header = polling_response[1]
+                        if completed:
+                            self.record_completion(cursor_id, response_header)
+                            return (
+                                response_header,
+                                completed,
+                                self.post_request_attempt,
+                            )
+                        self.discard_search(cursor_id)
+                        if self.retry.expired():
+                            logging.error(
+                                msg="Retry Deadline Exceeded",
+                                extra={
+                                    "Log Time": datetime.utcnow(),
+                                    "Search ID": f"{cursor_id}",
+                                    "Event Processor": self.event_processor,
+                                    "Client": f"{self.client}",
+                                    "Query": f"{self.query_name}",
+                                    "Query Duration Start": f"{self.query_duration_start}",
+                                    "Query Duration Stop": f"{self.query_duration_stop}",
+                                    "Attempt": f"{self.post_request_attempt}",
+                                    **self.retry.stats(),
+                                },
+                            )
+                            return None
+                        continue
+                    elif not self.split:
+                        logging.info(
+                            msg=f"Exhausted Attempts",
+                            extra={
+                                "Log Time": datetime.utcnow(),
+                                "Request Type": "Trigger",
+                                "Status Code": f"{result.status_code}",
+                                "Query Duration Start": f"{self.query_duration_start}",
+                                "Query Duration Stop": f"{self.query_duration_stop}",
+                                "Search ID": f"{cursor_id}",
+                                "Event Processor": self.event_processor,
+                                "Client": f"{self.client}",
+                                "Query": f"{self.query_name}",
+                                "Attempt": f"{self.post_request_attempt}",
+                                "Progress": f"{response_header.get('progress')}",
+                                "Status": f"{response_header.get('status')}",
+                                "Completed Flag": f"{response_header.get('completed')}",
+                                "Records Found": f"{response_header.get('record_count')}",
+                                "Response Header": f"{response_header}",
+                            },
+                        )
+                return None
+            logging.error(
+                msg="Exhausted Attempts",
+                extra={
+                    "Log Time": datetime.utcnow(),
+                    "Event Processor": self.event_processor,
+                    "Client": f"{self.client}",
+                    "Query": f"{self.query_name}",
+                    "Query Duration Start": f"{self.query_duration_start}",
+                    "Query Duration Stop": f"{self.query_duration_stop}",
+                    "Attempt": f"{self.post_request_attempt}",
+                    **self.retry.stats(),
+                },
+            )
         except ValueError as value_error:
             logging.exception(
                 msg=f"Invalid JSON",
@@ -438,8 +633,7 @@ class ProducerConsumer:
                     "Query Duration Stop": f"{self.query_duration_stop}",
                 },
             )
-        except AttributeError as attr_error:
-            print(attr_error.args)
+        except AttributeError:
             logging.exception(
                 msg=f"Response Header invalid",
                 extra={
@@ -476,9 +670,25 @@ class ProducerConsumer:
                 },
             )
 
-    def enqueue(self, cursor_id):
+    def enqueue(self, cursor_id, record_count, ranges=None):
+        """Downloads the search results onto the queue.
+
+        Results with more than RESULT_CHUNK_SIZE rows, or of which only some ranges are still
+        pending after a restart, are downloaded in ranges, see enqueue_ranges. If the stream
+        fails, the rows that weren't queued yet are downloaded with the retries of fetch_range.
+
+        Args:
+            cursor_id (str): Search ID.
+            record_count (int): Number of rows in the results.
+            ranges (list[tuple[int, int]]): Ranges to download, all of them if None.
+        """
+        all_ranges = get_ranges(record_count, RESULT_CHUNK_SIZE)
+        if ranges is None:
+            ranges = all_ranges
+        if len(all_ranges) > 1 or ranges != all_ranges:
+            return self.enqueue_ranges(cursor_id, ranges)
+        chunk = all_ranges[0]
         url = f"https://{self.qradar_console_id}/api/ariel/searches/{cursor_id}/results"
-        session = requests.Session()
         get_request_error_response = {
             "http_response": {
                 "code": 500,
@@ -489,15 +699,13 @@ class ProducerConsumer:
             "details": {},
             "message": 'Invocation was successful, but transformation to content type "APPLICATION_JSON" failed',
         }
-        get_requests_error_message = (
-            '"code":500,"message":"Unexpected internal server error"'
-        )
+        queued = 0
         try:
-            with session.get(
+            self.limiter.throttle()
+            with self.http_client.stream(
+                "GET",
                 url=url,
                 headers=self.header,
-                stream=True,
-                verify=False,
                 timeout=115,
             ) as query_request:
                 logging.info(
@@ -514,30 +722,44 @@ class ProducerConsumer:
                         "Query": f"{self.query_name}",
                     },
                 )
-                lines = query_request.iter_lines(
-                    decode_unicode=True, delimiter="},\n"
-                )
-                for line in lines:
-                    if line is not None and line != "" and line:
-                        self.queue_writer(line)
-                    else:
-                        continue
-        except requests.exceptions.HTTPError:
-            logging.exception(
-                msg="Internal Server Error",
+                query_request.raise_for_status()
+                parser = EventStreamParser()
+                batch, nbytes = [], 0
+                received = time.perf_counter()
+                for data in query_request.iter_bytes():
+                    parsing = time.perf_counter()
+                    self.metrics.downloaded(len(data), parsing - received)
+                    events = parser.feed(data)
+                    self.metrics.parsed(len(events), time.perf_counter() - parsing)
+                    batch += events
+                    nbytes += len(data)
+                    if batch_is_full(batch, nbytes):
+                        self.queue_writer(batch, nbytes, chunk)
+                        queued += len(batch)
+                        batch, nbytes = [], 0
+                    received = time.perf_counter()
+                parser.close()
+                if batch:
+                    self.queue_writer(batch, nbytes, chunk)
+        except (httpx.HTTPError, ValueError) as http_exp:
+            logging.warning(
+                msg=f"Failed Streaming Results: {http_exp}",
                 extra={
                     "Log Time": datetime.utcnow(),
+                    "Search ID": f"{cursor_id}",
                     "Event Processor": self.event_processor,
                     "Client": f"{self.original_client_name}",
                     "Query": f"{self.query_name}",
                     "Query Duration Start": f"{self.query_duration_start}",
                     "Query Duration Stop": f"{self.query_duration_stop}",
-                    "QRadar Error Code": get_request_error_response.get(
-                        "http_response"
-                    ).get("code"),
-                    "QRadar Error Message": f"""{get_request_error_response.get("message")}""",
+                    "Records Queued": f"{queued}",
+                    **error_details(http_exp),
                 },
             )
+            # Results are streamed in order, the rows queued so far are kept.
+            start, stop = chunk
+            if start + queued <= stop:
+                self.fetch_range(url, cursor_id, start + queued, stop, chunk)
         except Exception as _my_generic_exp:
             logging.exception(
                 msg="Generic Exception - Internal Server Error",
@@ -555,42 +777,141 @@ class ProducerConsumer:
                 },
             )
 
-    def queue_writer(self, line):
-        line = line.replace("\n", "").removeprefix('{  "events":[') + "}"
-        self.queue.put(line, timeout=120, block=True)
+    def enqueue_ranges(self, cursor_id, ranges):
+        """Downloads the given result ranges, RESULT_CHUNK_PARALLELISM at a time.
 
-    def insert_data(self, logs):
-        try:
-            result = self.collection.insert_many(logs)
-            return result
-        except Exception as my_generic_exp:
-            logging.exception(
-                msg=f"Generic Exception: {my_generic_exp}",
-                extra={
-                    "Log Time": datetime.utcnow(),
-                    "Event Processor": self.event_processor,
-                    "Client": f"{self.original_client_name}",
-                    "Collection": f"{self.query_name}",
-                    "Query": f"{self.query_name}",
-                    "Query Duration Start": f"{self.query_duration_start}",
-                    "Query Duration Stop": f"{self.query_duration_stop}",
-                },
-            )
+        Chunks are put on the queue in the order they complete.
+        """
+        url = f"https://{self.qradar_console_id}/api/ariel/searches/{cursor_id}/results"
+        logging.info(
+            msg="Started Fetching Data",
+            extra={
+                "Log Time": datetime.utcnow(),
+                "Request Type": "Fetching",
+                "Query Duration Start": f"{self.query_duration_start}",
+                "Query Duration Stop": f"{self.query_duration_stop}",
+                "Search ID": f"{cursor_id}",
+                "Event Processor": self.event_processor,
+                "Client": f"{self.original_client_name}",
+                "Query": f"{self.query_name}",
+                "Chunks": f"{len(ranges)}",
+            },
+        )
+        with ThreadPoolExecutor(
+            max_workers=RESULT_CHUNK_PARALLELISM
+        ) as executor:
+            futures = {
+                executor.submit(self.fetch_range, url, cursor_id, start, stop): (
+                    start,
+                    stop,
+                )
+                for start, stop in ranges
+            }
+            # fetch_range handles the errors of QRadar, e.g. queue.Full ends up here. The
+            # range stays pending in the checkpoint and is downloaded again on restart.
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    start, stop = futures[future]
+                    logging.error(
+                        msg=f"Failed Fetching Range: {future.exception()!r}",
+                        exc_info=future.exception(),
+                        extra={
+                            "Log Time": datetime.utcnow(),
+                            "Search ID": f"{cursor_id}",
+                            "Event Processor": self.event_processor,
+                            "Client": f"{self.original_client_name}",
+                            "Query": f"{self.query_name}",
+                            "Query Duration Start": f"{self.query_duration_start}",
+                            "Query Duration Stop": f"{self.query_duration_stop}",
+                            "Range": f"{start}-{stop}",
+                        },
+                    )
 
-    def dequeue(self, response_header):
+    def fetch_range(self, url, cursor_id, start, stop, chunk=None):
+        """Downloads rows start to stop (inclusive) of the results.
+
+        The chunk is only put on the queue once it is complete, so a failed chunk is
+        retried on its own without duplicating rows. Its batches are queued as the result
+        range chunk, (start, stop) unless they complete the range of a failed stream.
+        """
+        retry = RetryPolicy(RESULT_CHUNK_ATTEMPTS, self.retry.deadline)
+        while True:
+            try:
+                self.limiter.throttle()
+                requested = time.perf_counter()
+                result = self.http_client.get(
+                    url=url,
+                    headers={**self.header, "Range": f"items={start}-{stop}"},
+                    timeout=115,
+                )
+                result.raise_for_status()
+                parsing = time.perf_counter()
+                self.metrics.downloaded(len(result.content), parsing - requested)
+                events = parse_events(result.content)
+                self.metrics.parsed(len(events), time.perf_counter() - parsing)
+                for batch, nbytes in split_batches(events, len(result.content)):
+                    self.queue_writer(batch, nbytes, chunk or (start, stop))
+                return
+            except (httpx.HTTPError, ValueError) as http_exp:
+                delay = retry.next_delay(http_exp)
+                logging.warning(
+                    msg=f"Failed Fetching Range: {http_exp}",
+                    extra={
+                        "Log Time": datetime.utcnow(),
+                        "Search ID": f"{cursor_id}",
+                        "Event Processor": self.event_processor,
+                        "Client": f"{self.original_client_name}",
+                        "Query": f"{self.query_name}",
+                        "Query Duration Start": f"{self.query_duration_start}",
+                        "Query Duration Stop": f"{self.query_duration_stop}",
+                        "Range": f"{start}-{stop}",
+                        "Attempt": f"{retry.failures}",
+                        "Retry Action": f"{retry.action}",
+                    },
+                )
+                if delay is None:
+                    break
+                time.sleep(delay)
+        logging.error(
+            msg="Exhausted Attempts for Range",
+            extra={
+                "Log Time": datetime.utcnow(),
+                "Search ID": f"{cursor_id}",
+                "Event Processor": self.event_processor,
+                "Client": f"{self.original_client_name}",
+                "Query": f"{self.query_name}",
+                "Query Duration Start": f"{self.query_duration_start}",
+                "Query Duration Stop": f"{self.query_duration_stop}",
+                "Range": f"{start}-{stop}",
+            },
+        )
+
+    def queue_writer(self, batch, nbytes, chunk):
+        """Queues a batch of events belonging to the result range chunk."""
+        waiting = time.perf_counter()
+        if self.queue.put((chunk, batch), nbytes, timeout=120):
+            self.metrics.spilled(nbytes)
+        self.metrics.queue_waited(time.perf_counter() - waiting)
+        self.metrics.queue_depth(self.queue)
+
+    def dequeue(self, response_header, ranges=None):
+        """Inserts the queued batches into MongoDB, checkpointing every result range once stored.
+
+        Args:
+            response_header (dict): Response of the completed search.
+            ranges (list[tuple[int, int]]): Ranges enqueue downloads, all of them if None.
+        """
         count = response_header.get("record_count")
-        print(f"Count is: {count}")
         cursor_id = response_header.get("cursor_id")
         request_status = response_header.get("status")
         progress = response_header.get("progress")
         completed: bool = response_header.get("completed")
-        record_count = count
-        decoder = JSONDecoder()
+        if ranges is None:
+            ranges = get_ranges(count, RESULT_CHUNK_SIZE)
+        record_count = sum(stop - start + 1 for start, stop in ranges)
         timeout = 120
-        logs = []
-        line = ""
         self.original_client_name = self.client
-        self.client = self.client.replace(" ", "").replace(".", "")
+        self.client = database_name(self.client)
         self.database = self.mongo_client.get_database(self.client)
         self.collection = self.database.get_collection(self.query_name)
         get_request_error_response = {
@@ -605,34 +926,56 @@ class ProducerConsumer:
         }
         try:
             if count > 0:
-                while record_count >= 1000:
-                    line = self.queue.get(block=True, timeout=timeout)
-                    line = line.removeprefix(",").replace("\n", "") + "}"
-                    line_json, _idx = decoder.raw_decode(line)
-                    line_json = self.add_date(line_json)
-                    logs.append(line_json)
-                    if len(logs) == 1000:
-                        result = self.insert_data(
-                            logs=logs,
+                # Batches are inserted by the writer's threads while the next one is dequeued.
+                extra = {
+                    "Search ID": f"{cursor_id}",
+                    "Event Processor": self.event_processor,
+                    "Client": f"{self.original_client_name}",
+                    "Query": f"{self.query_name}",
+                    "Query Duration Start": f"{self.query_duration_start}",
+                    "Query Duration Stop": f"{self.query_duration_stop}",
+                }
+                if self.clients:
+                    writer = RoutedBulkWriter(
+                        lambda client: self.mongo_client.get_database(
+                            database_name(client)
+                        ),
+                        self.query_name,
+                        extra=extra,
+                        metrics=self.metrics,
+                    )
+                else:
+                    writer = BulkWriter(
+                        self.collection, extra=extra, metrics=self.metrics
+                    )
+                tracker = RangeTracker(
+                    self.checkpoint, self.checkpoint_key, cursor_id, ranges
+                )
+                document_ids = (
+                    DocumentIds(
+                        self.query_name,
+                        self.query_duration_start,
+                        self.query_duration_stop,
+                    )
+                    if IDEMPOTENT_INSERTS
+                    else None
+                )
+                try:
+                    while record_count > 0:
+                        chunk, logs = self.queue.get(timeout=timeout)
+                        self.metrics.queue_depth(self.queue)
+                        if document_ids:
+                            document_ids.assign(logs, chunk)
+                        writer.submit(
+                            add_dates(logs), partial(tracker.inserted, chunk)
                         )
-                        self.inserted_records += len(result.inserted_ids)
                         record_count -= len(logs)
-                        del logs[0:]
-                    else:
-                        continue
-
-                if record_count < 1000:
-                    while record_count != 0:
-                        line = self.queue.get(block=True, timeout=timeout)
-                        line = line.removeprefix(",").replace("\n", "") + "}"
-                        line_json, _idx = decoder.raw_decode(line)
-                        line_json = self.add_date(line_json)
-                        logs.append(line_json)
-                        record_count -= 1
-                    result = self.insert_data(
-                        logs=logs,
-                    )
-                    self.inserted_records += len(result.inserted_ids)
+                finally:
+                    writer.close()
+                    self.inserted_records = writer.inserted
+                if tracker.complete():
+                    self.finish_search(cursor_id)
+                self.metrics.finished(time.perf_counter() - self.query_start_time)
                 logging.info(
                     msg="Completed Data Fetching for Query",
                     extra={
@@ -648,17 +991,19 @@ class ProducerConsumer:
                         "Status": f"{request_status}",
                         "Completed Flag": f"{completed}",
                         "Records Found": f"{count}",
-                        "Records Inserted": f"{self.inserted_records}",
                         "Time to Complete (in minutes)": f"{(time.perf_counter() - self.query_start_time) / 60}",
                         "Response Header": f"{response_header}",
+                        **writer.stats.to_dict(),
+                        **self.queue.stats(),
+                        **memory_stats(),
                     },
                 )
             else:
                 pass
-        except ValueError as _value_error:
-            print(_value_error.args)
-            logging.error(
-                msg=f"Internal Server Error",
+        except ValueError as value_error:
+            # Raised while preparing the batches here, not by QRadar.
+            logging.exception(
+                msg=f"Failed Inserting Results: {value_error}",
                 extra={
                     "Log Time": datetime.utcnow(),
                     "Search ID": f"{cursor_id}",
@@ -732,21 +1077,69 @@ class ProducerConsumer:
                 },
             )
 
-    def add_date(self, line_json):
-        query_date_epoch = line_json.get("Start Time")
-        if query_date_epoch is not None:
-            query_timestamp, ms = divmod(query_date_epoch, 1000)
-            report_date = datetime.fromtimestamp(query_timestamp).strftime(
-                "%d/%m/%Y"
-            )
-            prev_saturday = (
-                datetime.fromtimestamp(query_timestamp)
-                + relativedelta(weekday=SA(-1))
-            ).strftime("%d/%m/%Y")
-            line_json["Start Time ISO"] = datetime.utcfromtimestamp(
-                query_timestamp
+    def spool(self, response_header, ranges=None):
+        """Writes the queued batches to the local spool instead of MongoDB, see utils/spool.py.
+
+        Args:
+            response_header (dict): Response of the completed search.
+            ranges (list[tuple[int, int]]): Ranges enqueue downloads, all of them if None.
+        """
+        count = response_header.get("record_count")
+        cursor_id = response_header.get("cursor_id")
+        if ranges is None:
+            ranges = get_ranges(count, RESULT_CHUNK_SIZE)
+        record_count = sum(stop - start + 1 for start, stop in ranges)
+        timeout = 120
+        extra = {
+            "Log Time": datetime.utcnow(),
+            "Search ID": f"{cursor_id}",
+            "Query Duration Start": f"{self.query_duration_start}",
+            "Query Duration Stop": f"{self.query_duration_stop}",
+            "Event Processor": self.event_processor,
+            "Client": f"{self.original_client_name}",
+            "Query": f"{self.query_name}",
+            "Records Found": f"{count}",
+        }
+        tracker = RangeTracker(self.checkpoint, self.checkpoint_key, cursor_id, ranges)
+        spool = Spool(
+            self.event_processor,
+            self.original_client_name,
+            self.query_name,
+            self.query_duration_start,
+            self.query_duration_stop,
+            cursor_id,
+            ranges,
+            clients=self.clients,
+        )
+        try:
+            while record_count > 0:
+                chunk, logs = self.queue.get(timeout=timeout)
+                self.metrics.queue_depth(self.queue)
+                spool.write(chunk, logs)
+                tracker.inserted(chunk, len(logs))
+                record_count -= len(logs)
+        except Empty:
+            logging.error(
+                msg=f"Read timeout - No data received from QRadar for {timeout / 60} minutes",
+                extra=extra,
             )
-            line_json["WeekFrom"] = prev_saturday
-            line_json["ReportDate"] = report_date
-        line_json["createdAt"] = datetime.utcnow()
-        return line_json
+        except (OSError, ValueError) as spool_error:
+            logging.exception(msg=f"Failed Spooling: {spool_error}", extra=extra)
+        finally:
+            spool.close()
+        if tracker.complete():
+            self.finish_search(cursor_id)
+        self.metrics.finished(time.perf_counter() - self.query_start_time)
+        logging.info(
+            msg="Completed Spooling for Query",
+            extra={
+                **extra,
+                "Time to Complete (in minutes)": f"{(time.perf_counter() - self.query_start_time) / 60}",
+                **spool.stats(),
+                **self.queue.stats(),
+                **memory_stats(),
+            },
+        )
+
+    def add_date(self, line_json):
+        return add_date(line_json)
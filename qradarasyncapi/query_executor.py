@@ -1,101 +1,186 @@
+import hashlib
 import logging
-import time
+import re
 from datetime import date, datetime, timedelta
-import initiate
-from utils.logger import SetupLogging
+from itertools import zip_longest
+from prodict import Prodict
 from utils.constants import (
     SHORT_DURATION_QUERIES,
     SHORT_SEARCH_DURATION,
     LONG_SEARCH_DURATION,
+    BATCH_CLIENTS,
+    BATCH_CLIENTS_MAX,
 )
+from utils.checkpoint import (
+    DONE,
+    SPLIT,
+    get_checkpoint_store,
+    task_checkpoint_key,
+)
+from utils.windows import plan_duration, split_window
+
+
+class SearchTask(Prodict):
+    """One Ariel search: a single client, query and time window on one event processor.
+
+    A batched search covers several clients of the event processor at once, client is then
+    only a label used for logs and checkpoints, see batch_label.
+    """
+
+    event_processor: str
+    client: str
+    # Clients covered by a batched search, None for a single client.
+    clients: list
+    query_name: str
+    query_expression: str
+    # query_expression before the placeholders were replaced, used to split the window.
+    query_template: str
+    query_duration_start: str
+    query_duration_stop: str
 
 
 class QueryExecutor:
-    """_summary_"""
+    """Expands the configured event processors, clients and queries into SearchTasks."""
 
-    def __init__(self, queries):
+    def __init__(self, queries, history=None, batch_clients=BATCH_CLIENTS):
+        """
+        Args:
+            queries (dict): Query name -> Ariel query with placeholders, see queries.json.
+            history (CheckpointStore): Rows per minute observed on previous days, the windows
+                are planned from it if given, see utils/windows.py.
+            batch_clients (bool): Run one search per BATCH_CLIENTS_MAX clients of an event
+                processor instead of one search per client.
+        """
         self.queries = queries
-        self.new_queries = {}
+        self.history = history
+        self.batch_clients = batch_clients
+
+    def client_groups(self, clients):
+        """Yields (client, clients) for every search needed to cover the clients of an EP."""
+        if not self.batch_clients:
+            for client in clients:
+                yield client, None
+            return
+        for index in range(0, len(clients), BATCH_CLIENTS_MAX):
+            group = clients[index : index + BATCH_CLIENTS_MAX]
+            if len(group) == 1:
+                yield group[0], None
+            else:
+                yield batch_label(group), group
+
+    def window_duration(self, client, query_name, day):
+        """Minutes of the windows the query is triggered with for the client on the given day."""
+        if query_name in SHORT_DURATION_QUERIES:
+            duration = SHORT_SEARCH_DURATION
+        else:
+            duration = LONG_SEARCH_DURATION
+        if self.history is None:
+            return duration
+        return plan_duration(
+            duration, self.history.rows_per_minute(client, query_name, day)
+        )
 
-    def query_creator(self, event_processor, clients):
-        """_summary_
+    def create_tasks(self, ep_client_list):
+        """Flattens every (event processor, client, query, time window) into one SearchTask.
+
+        With batch_clients, the clients of an event processor share their searches.
+        Tasks are interleaved round-robin across event processors so that an EP with many
+        clients doesn't hog the head of the work queue.
 
         Args:
-            event_processor (_type_): _description_
-            clients (_type_): _description_
+            ep_client_list (dict): Event processor ID -> list of client (domain) names.
+
+        Returns:
+            list[SearchTask]: One task per Ariel search.
         """
-        stop = datetime.fromisoformat((date.today()).isoformat())
-        initial = datetime.fromisoformat(
-            (stop - timedelta(days=1)).isoformat(timespec="seconds")
-        )
-        try:
-            for client in clients:
-                SetupLogging().setup_logging(
-                    event_processor=event_processor, client=client
-                )
-                client_start = time.perf_counter()
-                for query_name, query_expression in self.queries.items():
-                    start = initial
-
-                    while start <= stop:
-                        if query_name in SHORT_DURATION_QUERIES:
-                            query_duration, start = get_query_duration(
-                                start, SHORT_SEARCH_DURATION
-                            )
-                        else:
-                            query_duration, start = get_query_duration(
-                                start, LONG_SEARCH_DURATION
-                            )
-                        start_perf_counter = time.perf_counter()
-                        # - ##### for processorId
-                        # - @@@@@ for DOMAINNAME(domainId)
-                        # - !!!!! for start
-                        # - $$$$$ for stop
-                        new_query_expression = (
-                            query_expression.replace(
-                                "#####", f"{event_processor}"
-                            )
-                            .replace("@@@@@", f"'{client}'")
-                            .replace("!!!!!", f"{query_duration.get('start')}")
-                            .replace("$$$$$", f"{query_duration.get('stop')}")
-                        )
-                        # We can only modify the client here because:
-                        # 1.  In the above for loop we are creating a new query expression that will be POSTed
-                        #     to QRadar API endpoint.
-                        #     So the client name needs to be in the original format recognised by QRadar.
-                        # 2.  We will use the client variable as the database name
-                        #     in MongoDB and MongoDB doesn't accept " " and "." in database names.
-                        _response_header = initiate.initiate_producerconsumer(
-                            query_expression=new_query_expression,
-                            query_name=query_name,
-                            client=client,
-                            event_processor=event_processor,
-                            query_start_time=start_perf_counter,
-                            query_duration_start=query_duration.get("start"),
-                            query_duration_stop=query_duration.get("stop"),
-                        )
-                    # Exiting the inner queries loop into the clients loop.
-                    client_stop = time.perf_counter()
-                    logging.info(
-                        msg="Completed Data Fetching for Client",
-                        extra={
-                            "Log Time": datetime.utcnow(),
-                            "Event Processor": f"{event_processor}",
-                            "Client": f"{client}",
-                            "Query Start": f"{query_duration.get('start')}",
-                            "Query Stop": f"{query_duration.get('stop')}",
-                            "Time to Complete (in minutes)": (
-                                client_stop - client_start
-                            )
-                            / 60,
-                        },
+        day = date.today() - timedelta(days=1)
+        tasks_per_ep = []
+        for event_processor, clients in ep_client_list.items():
+            tasks_per_ep.append(
+                [
+                    SearchTask(
+                        event_processor=event_processor,
+                        client=client,
+                        clients=group,
+                        query_name=query_name,
+                        # The client name needs to be in the original format recognised by
+                        # QRadar here, it is only normalised later when used as the database name.
+                        query_expression=build_query_expression(
+                            query_expression,
+                            event_processor,
+                            group or client,
+                            query_duration,
+                        ),
+                        query_template=query_expression,
+                        query_duration_start=query_duration.get("start"),
+                        query_duration_stop=query_duration.get("stop"),
                     )
-        except Exception as my_generic_exp:
-            logging.exception(
-                "Error Type: {} - Error Message: {}  ".format(
-                    type(my_generic_exp).__name__, my_generic_exp
-                )
+                    for client, group in self.client_groups(clients)
+                    for query_name, query_expression in self.queries.items()
+                    for query_duration in get_query_windows(
+                        query_name,
+                        self.window_duration(client, query_name, day),
+                    )
+                ]
             )
+        return [
+            task
+            for tasks in zip_longest(*tasks_per_ep)
+            for task in tasks
+            if task is not None
+        ]
+
+
+def get_query_windows(query_name, duration=None):
+    """Yields the search windows covering yesterday for the given query.
+
+    Args:
+        query_name (str): Name of the query from queries.json
+        duration (int): Minutes per window, by default SHORT_SEARCH_DURATION for
+            SHORT_DURATION_QUERIES and LONG_SEARCH_DURATION for other queries.
+
+    Yields:
+        dict: Quoted "start" and "stop" values ready for the Ariel START/STOP clause.
+    """
+    stop = datetime.fromisoformat((date.today()).isoformat())
+    start = datetime.fromisoformat(
+        (stop - timedelta(days=1)).isoformat(timespec="seconds")
+    )
+    if duration is None:
+        if query_name in SHORT_DURATION_QUERIES:
+            duration = SHORT_SEARCH_DURATION
+        else:
+            duration = LONG_SEARCH_DURATION
+    while start < stop:
+        query_duration, start = get_query_duration(start, duration)
+        yield query_duration
+
+
+def batch_label(clients):
+    """Name of a batched search in logs and checkpoints, stable for the same clients."""
+    digest = hashlib.blake2b("|".join(clients).encode(), digest_size=4).hexdigest()
+    return f"{clients[0]}+{len(clients) - 1}-{digest}"
+
+
+def build_query_expression(
+    query_expression, event_processor, client, query_duration
+):
+    # - ##### for processorId
+    # - @@@@@ for DOMAINNAME(domainId)
+    # - !!!!! for start
+    # - $$$$$ for stop
+    # A list of clients turns "= @@@@@" into an IN list.
+    if isinstance(client, list):
+        domains = ", ".join(f"'{domain}'" for domain in client)
+        query_expression = re.sub(
+            r"=\s*@@@@@", lambda _match: f"IN ({domains})", query_expression
+        )
+    return (
+        query_expression.replace("#####", f"{event_processor}")
+        .replace("@@@@@", f"'{client}'")
+        .replace("!!!!!", f"{query_duration.get('start')}")
+        .replace("$$$$$", f"{query_duration.get('stop')}")
+    )
 
 
 def get_query_duration(start, duration):
@@ -103,9 +188,62 @@ def get_query_duration(start, duration):
         "start": start.strftime("'%Y-%m-%d %H:%M:%S'"),
         "stop": "",
     }
-    if duration == SHORT_SEARCH_DURATION:
-        start = start + timedelta(minutes=SHORT_SEARCH_DURATION)
-    elif duration == LONG_SEARCH_DURATION:
-        start = start + timedelta(minutes=LONG_SEARCH_DURATION)
+    start = start + timedelta(minutes=duration)
     query_duration["stop"] = start.strftime("'%Y-%m-%d %H:%M:%S'")
     return query_duration, start
+
+
+def split_task(task):
+    """Splits the window of a SearchTask in two halves.
+
+    Returns:
+        list[SearchTask]: The two halves, empty if the window is too short to be split.
+    """
+    windows = split_window(task.query_duration_start, task.query_duration_stop)
+    return [
+        SearchTask(
+            event_processor=task.event_processor,
+            client=task.client,
+            clients=task.clients,
+            query_name=task.query_name,
+            query_expression=build_query_expression(
+                task.query_template,
+                task.event_processor,
+                task.clients or task.client,
+                window,
+            ),
+            query_template=task.query_template,
+            query_duration_start=window.get("start"),
+            query_duration_stop=window.get("stop"),
+        )
+        for window in windows or []
+    ]
+
+
+def pending_tasks(tasks):
+    """Drops the tasks whose search a previous run already finished.
+
+    Tasks whose window a previous run split are replaced by the pending halves.
+    """
+    checkpoint = get_checkpoint_store()
+    pending = list(_pending(checkpoint, tasks))
+    if len(pending) != len(tasks):
+        logging.info(
+            msg="Resuming searches of a previous run",
+            extra={
+                "Searches Planned": f"{len(tasks)}",
+                "Searches Pending": f"{len(pending)}",
+            },
+        )
+    return pending
+
+
+def _pending(checkpoint, tasks):
+    for task in tasks:
+        state = checkpoint.get(task_checkpoint_key(task))
+        if state is None:
+            yield task
+        elif state["state"] == SPLIT:
+            yield from _pending(checkpoint, split_task(task))
+        elif state["state"] != DONE:
+            yield task
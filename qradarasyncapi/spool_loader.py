@@ -0,0 +1,149 @@
+"""Bulk-loads the segments spooled with SPOOL_RESULTS into MongoDB, see utils/spool.py.
+
+    python spool_loader.py [--reload] [--processes N] [spool folder]
+
+Segments are loaded SPOOL_LOAD_PROCESSES at a time, each through a BulkWriter with
+INSERT_CONCURRENCY inserts in flight, and marked as loaded once all their events are stored.
+--reload loads the marked ones again, with IDEMPOTENT_INSERTS that doesn't duplicate them.
+The collections are provisioned before loading, see utils/provisioning.py.
+"""
+
+import argparse
+import logging
+import multiprocessing as mp
+import time
+from datetime import datetime
+from multiprocessing.util import Finalize
+from mongoclient import close_shared_client, database_name, get_shared_client
+from utils.bulk_writer import BulkWriter, RoutedBulkWriter
+from utils.document_ids import DocumentIds
+from utils.enrichment import add_dates
+from utils.logger import SetupLogging
+from utils.provisioning import build_deferred_indexes, provision_collections
+from utils.spool import (
+    mark_loaded,
+    pending_segments,
+    read_manifest,
+    read_segment,
+    segment_path,
+)
+from utils.constants import (
+    IDEMPOTENT_INSERTS,
+    INSERT_BATCH_SIZE,
+    SPOOL_DIR,
+    SPOOL_LOAD_PROCESSES,
+)
+
+
+def load_segment(path):
+    """Pool worker: inserts the segment of the manifest at path.
+
+    Returns:
+        int: Number of events stored, inserted or skipped as duplicates.
+    """
+    manifest = read_manifest(path)
+    SetupLogging().setup_logging(
+        event_processor=manifest["event_processor"], client=manifest["client"]
+    )
+    query_name = manifest["query_name"]
+    chunk = (manifest["start"], manifest["stop"])
+    extra = {
+        "Log Time": datetime.utcnow(),
+        "Search ID": f"{manifest['cursor_id']}",
+        "Event Processor": manifest["event_processor"],
+        "Client": f"{manifest['client']}",
+        "Query": f"{query_name}",
+        "Query Duration Start": f"{manifest['query_duration_start']}",
+        "Query Duration Stop": f"{manifest['query_duration_stop']}",
+        "Range": f"{chunk[0]}-{chunk[1]}",
+        "Spool Segment": path,
+    }
+    mongo_client = get_shared_client()
+    if manifest["clients"]:
+        writer = RoutedBulkWriter(
+            lambda client: mongo_client.get_database(database_name(client)),
+            query_name,
+            extra=extra,
+        )
+    else:
+        writer = BulkWriter(
+            mongo_client.get_database(database_name(manifest["client"])).get_collection(
+                query_name
+            ),
+            extra=extra,
+        )
+    document_ids = (
+        DocumentIds(
+            query_name,
+            manifest["query_duration_start"],
+            manifest["query_duration_stop"],
+        )
+        if IDEMPOTENT_INSERTS
+        else None
+    )
+    try:
+        for logs in read_segment(segment_path(path), INSERT_BATCH_SIZE):
+            if document_ids:
+                document_ids.assign(logs, chunk)
+            writer.submit(add_dates(logs))
+    except (OSError, ValueError) as spool_error:
+        logging.exception(msg=f"Failed Reading Spool Segment: {spool_error}", extra=extra)
+    finally:
+        writer.close()
+    stored = writer.stats.inserted + writer.stats.duplicates
+    if stored == manifest["rows"]:
+        mark_loaded(path)
+        logging.info(msg="Loaded Spool Segment", extra={**extra, **writer.stats.to_dict()})
+    else:
+        logging.error(
+            msg="Spool Segment not fully loaded",
+            extra={
+                **extra,
+                "Records Found": f"{manifest['rows']}",
+                **writer.stats.to_dict(),
+            },
+        )
+    return stored
+
+
+def segment_targets(segments):
+    """(database, collection) of every collection the segments are loaded into."""
+    targets = set()
+    for path in segments:
+        manifest = read_manifest(path)
+        for client in manifest["clients"] or [manifest["client"]]:
+            targets.add((database_name(client), manifest["query_name"]))
+    return sorted(targets)
+
+
+def init_loader_worker():
+    """Pool initializer: closes this worker's MongoDB client on exit."""
+    SetupLogging().setup_logging()
+    Finalize(None, close_shared_client, exitpriority=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default=SPOOL_DIR)
+    parser.add_argument("--reload", action="store_true", help="load loaded segments again")
+    parser.add_argument("--processes", type=int, default=SPOOL_LOAD_PROCESSES)
+    args = parser.parse_args()
+
+    SetupLogging().setup_logging()
+    start = time.perf_counter()
+    segments = pending_segments(args.directory, reload=args.reload)
+    targets = segment_targets(segments)
+    provision_collections(targets)
+    with mp.Pool(processes=args.processes, initializer=init_loader_worker) as pool:
+        stored = sum(pool.imap_unordered(load_segment, segments, chunksize=1))
+        # Let the workers exit on their own so that their finalizers close the clients.
+        pool.close()
+        pool.join()
+    build_deferred_indexes(targets)
+    logging.info(
+        msg=f"Loaded {len(segments)} spool segments, {stored} records in {time.perf_counter() - start:.0f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main()
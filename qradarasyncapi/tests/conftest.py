@@ -0,0 +1,67 @@
+"""Fixtures running the engines against the stand-ins of the benchmarks, see
+benchmarks/end_to_end.py. Run from the qradarasyncapi folder:
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+os.environ.setdefault("MONGODB_SEC_TOKEN", "test")
+os.environ.setdefault("QRADAR_CONSOLE_ID", "mock-console")
+
+import httpx
+import pytest
+import mongoclient
+from benchmarks.end_to_end import QUERY
+from benchmarks.memory_mongo import MemoryMongoClient
+from benchmarks.mock_ariel import MockAriel
+from query_executor import QueryExecutor
+from utils import checkpoint, http_client, limiter, logger
+
+
+@pytest.fixture(autouse=True)
+def log_folder(tmp_path, monkeypatch):
+    """Keeps the log files of the engines out of the working tree."""
+    monkeypatch.setattr(logger, "LOG_FOLDER", tmp_path / "logs")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = checkpoint.CheckpointStore(str(tmp_path / "searches.sqlite3"))
+    monkeypatch.setattr(checkpoint, "_store", store)
+    monkeypatch.setattr(checkpoint, "_store_pid", os.getpid())
+    return store
+
+
+@pytest.fixture
+def sync_engine(store, monkeypatch):
+    """Installs MockAriel and MemoryMongoClient as the clients of the sync engine.
+
+    Returns:
+        function: Takes the rows of the mock searches and optionally a subclass of
+        MockAriel, returns (mock, mongo).
+    """
+
+    def install(rows, mock_class=MockAriel):
+        mock = mock_class(rows=rows, search_seconds=0.1)
+        mongo = MemoryMongoClient()
+        monkeypatch.setattr(mongoclient, "_shared_client", mongo)
+        monkeypatch.setattr(mongoclient, "_shared_client_pid", os.getpid())
+        monkeypatch.setattr(
+            http_client, "_client", httpx.Client(transport=mock.transport())
+        )
+        monkeypatch.setattr(http_client, "_client_pid", os.getpid())
+        monkeypatch.setattr(limiter, "_shared_limiter", limiter.SharedConsoleLimiter())
+        return mock, mongo
+
+    return install
+
+
+@pytest.fixture
+def task():
+    """The search of one client and query."""
+    tasks = QueryExecutor({"Query0": QUERY}).create_tasks({"100": ["domainName0"]})
+    return tasks[0]
@@ -0,0 +1,40 @@
+import asyncio
+import pytest
+import async_initiate
+from benchmarks.end_to_end import QUERY
+from utils.attributes import Attributes
+from work_scheduler import WorkScheduler
+
+
+class Closing:
+    def __init__(self):
+        self.closed = False
+
+    def get_async_client(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+def test_async_starter_closes_its_clients_when_the_run_fails(store, monkeypatch):
+    async def fail(self, tasks, handler):
+        raise RuntimeError("scheduler failed")
+
+    mongo_client, exporter = Closing(), Closing()
+    monkeypatch.setattr(
+        async_initiate.attributes,
+        "get_attributes",
+        lambda: Attributes(
+            ep_client_list={"100": ["domainName0"]}, queries={"Query0": QUERY}
+        ),
+    )
+    monkeypatch.setattr(async_initiate, "provision_collections", lambda targets: None)
+    monkeypatch.setattr(async_initiate, "MongoDBConnection", lambda: mongo_client)
+    monkeypatch.setattr(async_initiate, "start_exporter", lambda: exporter)
+    monkeypatch.setattr(WorkScheduler, "run", fail)
+
+    with pytest.raises(RuntimeError, match="scheduler failed"):
+        asyncio.run(async_initiate.async_starter())
+
+    assert mongo_client.closed and exporter.closed
@@ -0,0 +1,31 @@
+import asyncio
+from utils.batch_queue import AsyncBatchQueue, BatchQueue, get_memory_budget
+
+
+def test_close_releases_queued_bytes():
+    budget = get_memory_budget()
+    held = budget.bytes
+    queue = BatchQueue(spill=True)
+    queue.put([{}], 60)
+    queue.put([{}], 30)
+    assert budget.bytes == held + 90
+
+    queue.close()
+
+    assert budget.bytes == held
+    assert queue.qsize() == 0
+
+
+def test_async_close_releases_queued_bytes():
+    budget = get_memory_budget()
+    held = budget.bytes
+    queue = AsyncBatchQueue(spill=True)
+
+    async def fill():
+        await queue.put([{}], 60)
+        await queue.put([{}], 30)
+
+    asyncio.run(fill())
+    queue.close()
+
+    assert budget.bytes == held
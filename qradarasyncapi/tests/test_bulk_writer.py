@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from bson.errors import InvalidDocument
+from benchmarks.memory_mongo import AsyncMemoryCollection, MemoryCollection
+from utils.bulk_writer import AsyncBulkWriter, BulkWriter
+
+
+class InvalidCollection(MemoryCollection):
+    def insert_many(self, logs, ordered=True):
+        raise InvalidDocument("cannot encode object")
+
+
+def test_non_mongo_errors_count_as_failed_rows():
+    writer = BulkWriter(InvalidCollection("raw_Query0"))
+    writer.submit([{"a": 1}, {"a": 2}])
+    writer.close()
+
+    assert writer.stats.failed == 2
+    assert writer.inserted == 0
+
+
+def test_callback_errors_are_logged(caplog):
+    def on_inserted(rows):
+        raise KeyError(rows)
+
+    writer = BulkWriter(MemoryCollection("raw_Query0"))
+    with caplog.at_level(logging.ERROR):
+        writer.submit([{"a": 1}], on_inserted)
+        writer.close()
+
+    assert writer.inserted == 1
+    assert "Failed Completing Batch: KeyError(1)" in caplog.messages
+
+
+def test_async_callback_errors_are_logged(caplog):
+    def on_inserted(rows):
+        raise KeyError(rows)
+
+    async def write():
+        writer = AsyncBulkWriter(AsyncMemoryCollection("raw_Query0"))
+        await writer.submit([{"a": 1}], on_inserted)
+        await writer.close()
+        return writer
+
+    with caplog.at_level(logging.ERROR):
+        writer = asyncio.run(write())
+
+    assert writer.inserted == 1
+    assert "Failed Completing Batch: KeyError(1)" in caplog.messages
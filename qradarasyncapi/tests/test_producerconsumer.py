@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from queue import Full
+import httpx
+import pytest
+import initiate
+import producerconsumer
+from async_producerconsumer import AsyncProducerConsumer
+from benchmarks.memory_mongo import AsyncMemoryMongoClient
+from benchmarks.mock_ariel import EventStream, MockAriel, MockSearch
+from producerconsumer import ProducerConsumer
+from query_executor import pending_tasks
+from utils.checkpoint import DONE, task_checkpoint_key
+from utils.constants import RESULT_CHUNK_SIZE
+from utils.limiter import ConsoleLimiter
+from utils.spool import Spool, pending_segments, read_manifest
+
+
+class TruncatedStream(EventStream):
+    """Results body cut off after its first chunks."""
+
+    def __iter__(self):
+        for index, data in enumerate(super().__iter__()):
+            if index == 3:
+                return
+            yield data
+
+
+class FlakyResults(MockAriel):
+    """Streams cut off results, the downloads after that fail once with a 503."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.streamed = False
+        self.failed = False
+
+    def results(self, request, search):
+        if "Range" not in request.headers and not self.streamed:
+            self.streamed = True
+            return httpx.Response(
+                200,
+                stream=TruncatedStream(
+                    search, 0, search.record_count - 1, self.chunk_rows
+                ),
+            )
+        if not self.failed:
+            self.failed = True
+            return httpx.Response(503, json={"message": "Service Unavailable"})
+        return super().results(request, search)
+
+
+class FailingSearches(MockAriel):
+    """Every search fails straight away."""
+
+    def status(self, search):
+        return {
+            **super().status(search),
+            "completed": False,
+            "status": "ERROR",
+            "error_messages": [{"code": "mock", "message": "Search failed"}],
+        }
+
+
+def test_single_stream_search_is_checkpointed(sync_engine, store, task):
+    """Results of up to RESULT_CHUNK_SIZE rows are downloaded in one stream."""
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock, mongo = sync_engine(rows)
+
+    assert initiate.run_search_task(task) == []
+
+    assert sum(mongo.documents().values()) == rows
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+    assert pending_tasks([task]) == []
+    # The stored search was deleted from the console.
+    assert mock.searches == {}
+
+
+def test_running_search_is_reused_and_kept(sync_engine, store, task):
+    """A search of the same query started elsewhere is reused, but it isn't ours to delete."""
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock, mongo = sync_engine(rows)
+    search = MockSearch("analyst", task.query_expression, rows, 300, False)
+    mock.searches[search.cursor_id] = search
+
+    initiate.run_search_task(task)
+
+    assert mock.triggers == 0
+    assert sum(mongo.documents().values()) == rows
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+    assert list(mock.searches) == ["analyst"]
+
+
+def test_single_stream_search_with_idempotent_inserts(
+    sync_engine, store, task, monkeypatch
+):
+    monkeypatch.setattr(producerconsumer, "IDEMPOTENT_INSERTS", "skip")
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock, mongo = sync_engine(rows)
+
+    initiate.run_search_task(task)
+
+    assert sum(mongo.documents().values()) == rows
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+
+
+def test_single_stream_search_is_spooled(
+    sync_engine, store, task, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(initiate, "SPOOL_RESULTS", True)
+    monkeypatch.setattr(producerconsumer, "Spool", partial(Spool, directory=tmp_path))
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock, mongo = sync_engine(rows)
+
+    initiate.run_search_task(task)
+
+    manifests = pending_segments(directory=tmp_path)
+    assert len(manifests) == 1
+    manifest = read_manifest(manifests[0])
+    assert (manifest["start"], manifest["stop"]) == (0, rows - 1)
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+
+
+def test_failed_ranges_are_logged(sync_engine, task, monkeypatch, caplog):
+    def queue_full(self, batch, nbytes, chunk):
+        raise Full
+
+    monkeypatch.setattr(ProducerConsumer, "queue_writer", queue_full)
+    mock, mongo = sync_engine(200)
+    search = MockSearch("cursor", task.query_expression, 200, 300, False)
+    search.started -= 10
+    mock.searches[search.cursor_id] = search
+    producer_consumer = ProducerConsumer(
+        query_expression=task.query_expression,
+        query_name=task.query_name,
+        client=task.client,
+        event_processor=task.event_processor,
+        query_start_time=time.perf_counter(),
+        query_duration_start=task.query_duration_start,
+        query_duration_stop=task.query_duration_stop,
+    )
+
+    with caplog.at_level(logging.ERROR):
+        producer_consumer.enqueue_ranges("cursor", [(0, 99), (100, 199)])
+
+    failed = [
+        record
+        for record in caplog.records
+        if record.msg == "Failed Fetching Range: Full()"
+    ]
+    assert sorted(record.Range for record in failed) == ["0-99", "100-199"]
+
+
+def test_failed_stream_resumes_with_the_missing_rows(
+    sync_engine, store, task, monkeypatch
+):
+    monkeypatch.setattr("utils.retry.RETRY_BASE_DELAY", 0)
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock, mongo = sync_engine(rows, mock_class=FlakyResults)
+
+    initiate.run_search_task(task)
+
+    assert mock.streamed and mock.failed
+    assert sum(mongo.documents().values()) == rows
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+
+
+def test_failed_async_stream_resumes_with_the_missing_rows(
+    store, task, monkeypatch
+):
+    monkeypatch.setattr("utils.retry.RETRY_BASE_DELAY", 0)
+    rows = min(3000, RESULT_CHUNK_SIZE)
+    mock = FlakyResults(rows=rows, search_seconds=0.1)
+    mongo = AsyncMemoryMongoClient()
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=mock.transport(asynchronous=True)
+        ) as client:
+            await AsyncProducerConsumer(
+                query_expression=task.query_expression,
+                query_name=task.query_name,
+                client=task.client,
+                event_processor=task.event_processor,
+                query_start_time=time.perf_counter(),
+                query_duration_start=task.query_duration_start,
+                query_duration_stop=task.query_duration_stop,
+                http_client=client,
+                mongo_client=mongo,
+                limiter=ConsoleLimiter(),
+            ).run()
+
+    asyncio.run(run())
+
+    assert mock.streamed and mock.failed
+    assert sum(mongo.documents().values()) == rows
+    assert store.get(task_checkpoint_key(task))["state"] == DONE
+
+
+def test_failed_searches_are_retriggered_up_to_max_attempts(sync_engine, task):
+    mock, mongo = sync_engine(100, mock_class=FailingSearches)
+
+    initiate.run_search_task(task)
+
+    # max_attempts of ProducerConsumer.
+    assert mock.triggers == 10
+    assert mock.searches == {}
+
+
+def test_async_run_returns_when_the_consumer_fails(store, task, monkeypatch):
+    async def fail(self, response_header, ranges=None):
+        raise RuntimeError("consumer failed")
+
+    async def blocked(self, batch, nbytes, chunk):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(AsyncProducerConsumer, "dequeue", fail)
+    monkeypatch.setattr(AsyncProducerConsumer, "queue_writer", blocked)
+    mock = MockAriel(rows=100, search_seconds=0.1)
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=mock.transport(asynchronous=True)
+        ) as client:
+            await AsyncProducerConsumer(
+                query_expression=task.query_expression,
+                query_name=task.query_name,
+                client=task.client,
+                event_processor=task.event_processor,
+                query_start_time=time.perf_counter(),
+                query_duration_start=task.query_duration_start,
+                query_duration_stop=task.query_duration_stop,
+                http_client=client,
+                mongo_client=AsyncMemoryMongoClient(),
+                limiter=ConsoleLimiter(),
+            ).run()
+
+    with pytest.raises(RuntimeError, match="consumer failed"):
+        asyncio.run(asyncio.wait_for(run(), timeout=30))
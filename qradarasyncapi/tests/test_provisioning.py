@@ -0,0 +1,15 @@
+import pytest
+from utils import provisioning
+
+
+def test_idempotent_inserts_are_refused_for_buckets(monkeypatch):
+    monkeypatch.setattr(provisioning, "IDEMPOTENT_INSERTS", "skip")
+    specs = {"Query0": {"type": "buckets"}}
+    targets = [("client_db", "raw_Query0"), ("client_db", "raw_Query1")]
+
+    with pytest.raises(ValueError, match="raw_Query0"):
+        provisioning.check_specs(specs, targets)
+
+    provisioning.check_specs(specs, targets[1:])
+    monkeypatch.setattr(provisioning, "IDEMPOTENT_INSERTS", None)
+    provisioning.check_specs(specs, targets)
@@ -0,0 +1,16 @@
+from query_executor import pending_tasks, split_task
+from utils.checkpoint import task_checkpoint_key
+
+
+def test_pending_tasks_expands_split_windows(store, task):
+    store.split(task_checkpoint_key(task))
+    halves = split_task(task)
+
+    assert len(halves) == 2
+    assert pending_tasks([task]) == halves
+
+
+def test_pending_tasks_drops_finished_searches(store, task):
+    store.finished(task_checkpoint_key(task))
+
+    assert pending_tasks([task]) == []
@@ -0,0 +1,248 @@
+"""Queues handing batches of parsed events from the fetch stage to the insert stage.
+
+The queues are bounded by the bytes of the results they hold rather than by the number of
+items, so the memory used by a search doesn't depend on how wide its events are. A batch
+bigger than the whole budget is still accepted when nothing is held in memory.
+
+Besides its own QUEUE_MAX_BYTES, every queue of a process draws from the PROCESS_MAX_BYTES
+MemoryBudget they share. With SPILL_TO_DISK a batch that doesn't fit in either budget is
+written to a temporary spill file and read back when the insert stage gets to it, so a slow
+MongoDB never stalls the download and memory stays flat however big the results are. The
+spill file is truncated whenever everything spilled was read back. Without SPILL_TO_DISK the
+download waits for the insert stage to make room, as before, and only the queue budget applies.
+"""
+
+import asyncio
+import os
+import pickle
+import tempfile
+import threading
+from collections import deque
+from queue import Empty, Full
+from utils.constants import (
+    PROCESS_MAX_BYTES,
+    QUEUE_MAX_BYTES,
+    SPILL_DIR,
+    SPILL_TO_DISK,
+)
+
+
+class MemoryBudget:
+    """Bytes of results held in memory by all queues of a process."""
+
+    def __init__(self, max_bytes=PROCESS_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, nbytes):
+        with self.lock:
+            if self.bytes and self.bytes + nbytes > self.max_bytes:
+                return False
+            self.bytes += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.lock:
+            self.bytes -= nbytes
+
+
+_budget = None
+_budget_pid = None
+
+
+def get_memory_budget() -> MemoryBudget:
+    """Returns this process' budget, creating it on first use."""
+    global _budget, _budget_pid
+    if _budget is None or _budget_pid != os.getpid():
+        _budget = MemoryBudget()
+        _budget_pid = os.getpid()
+    return _budget
+
+
+class Spilled:
+    """Position of a batch in the spill file."""
+
+    __slots__ = ("offset", "length")
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+
+class SpillFile:
+    """Temporary file of the batches a queue spilled, created on the first one."""
+
+    def __init__(self, directory=SPILL_DIR):
+        self.directory = directory
+        self.file = None
+        self.lock = threading.Lock()
+        # Batches written and not read back yet.
+        self.pending = 0
+        self.batches = 0
+        self.bytes = 0
+
+    def write(self, item) -> Spilled:
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(
+                    prefix="qradar-spill-", dir=self.directory
+                )
+            self.file.seek(0, os.SEEK_END)
+            spilled = Spilled(self.file.tell(), len(data))
+            self.file.write(data)
+            self.pending += 1
+            self.batches += 1
+            self.bytes += len(data)
+        return spilled
+
+    def read(self, spilled: Spilled):
+        with self.lock:
+            self.file.seek(spilled.offset)
+            data = self.file.read(spilled.length)
+            self.pending -= 1
+            if not self.pending:
+                self.file.seek(0)
+                self.file.truncate()
+        return pickle.loads(data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def stats(self):
+        return {
+            "Batches Spilled to Disk": f"{self.batches}",
+            "Bytes Spilled to Disk": f"{self.bytes}",
+        }
+
+
+class BatchQueue:
+    """Thread-safe byte-bounded queue of event batches."""
+
+    def __init__(self, max_bytes=QUEUE_MAX_BYTES, spill=SPILL_TO_DISK):
+        self.max_bytes = max_bytes
+        # Bytes of the batches held in memory, spilled ones don't count.
+        self.bytes = 0
+        self.batches = deque()
+        self.condition = threading.Condition()
+        self.budget = get_memory_budget() if spill else None
+        self.spill_file = SpillFile() if spill else None
+
+    def fits(self, nbytes):
+        return self.bytes == 0 or self.bytes + nbytes <= self.max_bytes
+
+    def admit(self, nbytes):
+        """Whether a batch fits in memory, taking its bytes from the process budget if so."""
+        return self.fits(nbytes) and self.budget.try_acquire(nbytes)
+
+    def put(self, batch, nbytes, timeout=None):
+        """Adds a batch of events whose raw size was nbytes.
+
+        Returns:
+            bool: True if the batch was spilled to disk.
+
+        Raises:
+            queue.Full: Spilling is disabled and the batch didn't fit within timeout.
+        """
+        with self.condition:
+            if self.spill_file is None:
+                if not self.condition.wait_for(lambda: self.fits(nbytes), timeout):
+                    raise Full
+            if self.spill_file is None or self.admit(nbytes):
+                self.batches.append((batch, nbytes))
+                self.bytes += nbytes
+                self.condition.notify_all()
+                return False
+        # Written outside the lock so that the insert stage keeps dequeuing meanwhile.
+        spilled = self.spill_file.write(batch)
+        with self.condition:
+            self.batches.append((spilled, nbytes))
+            self.condition.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """Removes and returns the oldest batch, raises queue.Empty on timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.batches, timeout):
+                raise Empty
+            batch, nbytes = self.batches.popleft()
+            if not isinstance(batch, Spilled):
+                self.release(nbytes)
+            self.condition.notify_all()
+        if isinstance(batch, Spilled):
+            return self.spill_file.read(batch)
+        return batch
+
+    def release(self, nbytes):
+        self.bytes -= nbytes
+        if self.budget is not None:
+            self.budget.release(nbytes)
+
+    def qsize(self):
+        return len(self.batches)
+
+    def discard(self):
+        """Drops the batches still queued, returning their memory to the process budget."""
+        while self.batches:
+            batch, nbytes = self.batches.popleft()
+            if not isinstance(batch, Spilled):
+                self.release(nbytes)
+
+    def close(self):
+        """Drops the batches a failed or timed out consumer left and removes the spill file."""
+        with self.condition:
+            self.discard()
+            self.condition.notify_all()
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def stats(self):
+        return self.spill_file.stats() if self.spill_file is not None else {}
+
+
+class AsyncBatchQueue(BatchQueue):
+    """Asyncio byte-bounded queue of event batches, wrap calls in asyncio.wait_for for timeouts.
+
+    Spill files are written and read in a thread to keep the event loop free.
+    """
+
+    def __init__(self, max_bytes=QUEUE_MAX_BYTES, spill=SPILL_TO_DISK):
+        super().__init__(max_bytes, spill)
+        self.condition = asyncio.Condition()
+
+    async def put(self, batch, nbytes):
+        """Adds a batch of events whose raw size was nbytes, returns True if it was spilled."""
+        async with self.condition:
+            if self.spill_file is None:
+                await self.condition.wait_for(lambda: self.fits(nbytes))
+            if self.spill_file is None or self.admit(nbytes):
+                self.batches.append((batch, nbytes))
+                self.bytes += nbytes
+                self.condition.notify_all()
+                return False
+        spilled = await asyncio.to_thread(self.spill_file.write, batch)
+        async with self.condition:
+            self.batches.append((spilled, nbytes))
+            self.condition.notify_all()
+        return True
+
+    async def get(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.batches)
+            batch, nbytes = self.batches.popleft()
+            if not isinstance(batch, Spilled):
+                self.release(nbytes)
+            self.condition.notify_all()
+        if isinstance(batch, Spilled):
+            return await asyncio.to_thread(self.spill_file.read, batch)
+        return batch
+
+    def close(self):
+        # Runs on the event loop without awaiting, nothing else touches the batches meanwhile.
+        self.discard()
+        if self.spill_file is not None:
+            self.spill_file.close()
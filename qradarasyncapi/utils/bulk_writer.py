@@ -0,0 +1,404 @@
+"""Pipelined bulk inserts into MongoDB.
+
+The insert stage hands every batch to a writer and goes back to the queue straight away
+instead of waiting for MongoDB to acknowledge it. Up to INSERT_CONCURRENCY insert_many calls
+per collection are in flight at once, unordered so that one bad document doesn't stop the
+rest of the batch, with the write concern configured in utils/constants.py.
+
+With IDEMPOTENT_INSERTS = "skip" documents carrying a deterministic _id (see
+utils/document_ids.py) that are already stored fail with a duplicate key error, which is
+counted as a skipped duplicate instead of a failure. With "upsert" they are replaced instead.
+
+Batched searches cover several clients, their writers route every event into the database of
+its client by the domainName column.
+
+Batches are mapped to the fields of their query (see utils/schema.py) and shaped into the
+documents of their collection's layout, e.g. time-series measurements or buckets of events (see
+utils/layouts.py), in the insert threads. Counters are kept in events rather than documents
+either way.
+
+The latency and size of every batch are recorded in the metrics of its search, see
+utils/metrics.py.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReplaceOne, WriteConcern
+from pymongo.errors import BulkWriteError
+from utils.layouts import get_layout
+from utils.schema import get_schema
+from utils.constants import (
+    IDEMPOTENT_INSERTS,
+    INSERT_CONCURRENCY,
+    MONGO_WRITE_CONCERN_W,
+    MONGO_WRITE_CONCERN_J,
+)
+
+
+def get_write_concern() -> WriteConcern:
+    return WriteConcern(w=MONGO_WRITE_CONCERN_W, j=MONGO_WRITE_CONCERN_J)
+
+
+class InsertStats:
+    """Insert counters of one collection, used to measure its throughput."""
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.started = time.perf_counter()
+        self.batches = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.insert_seconds = 0.0
+
+    def record(self, inserted, duplicates, failed, seconds):
+        self.batches += 1
+        self.inserted += inserted
+        self.duplicates += duplicates
+        self.failed += failed
+        self.insert_seconds += seconds
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "Collection": self.collection_name,
+            "Insert Batches": f"{self.batches}",
+            "Records Inserted": f"{self.inserted}",
+            "Records Skipped as Duplicates": f"{self.duplicates}",
+            "Records Failed": f"{self.failed}",
+            "Average Insert Latency (in seconds)": f"{self.insert_seconds / max(self.batches, 1):.3f}",
+            "Insert Throughput (records/s)": f"{self.inserted / max(elapsed, 1e-9):.0f}",
+        }
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _log_insert_error(exp, extra):
+    if isinstance(exp, BulkWriteError):
+        write_errors = [
+            error
+            for error in exp.details.get("writeErrors", [])
+            if error.get("code") != DUPLICATE_KEY_ERROR
+        ]
+        if not write_errors:
+            return
+        logging.error(
+            msg="Bulk Write Error",
+            extra={
+                **extra,
+                "Write Errors": f"{len(write_errors)}",
+                "First Write Error": f"{write_errors[0].get('errmsg') if write_errors else None}",
+            },
+        )
+    else:
+        logging.exception(msg=f"Generic Exception: {exp}", extra=extra)
+
+
+def _log_failed_batch(exp, extra):
+    """Logs an error raised after a batch was written, e.g. by its on_inserted callback."""
+    logging.error(
+        msg=f"Failed Completing Batch: {exp!r}",
+        extra=extra,
+        exc_info=(type(exp), exp, exp.__traceback__),
+    )
+
+
+def _events(weights, indexes):
+    """Events held by the documents at indexes, weights is the number of events per document
+    or None if there is one per document."""
+    if weights is None:
+        return len(indexes)
+    return sum(weights[index] for index in indexes)
+
+
+def _write_counts(exp, total, weights=None, upserts=False):
+    """(inserted, duplicates) events of a batch of total events that raised exp.
+
+    Duplicates are events that were already stored: duplicate key errors of inserts and
+    documents matched by upserts.
+    """
+    if not isinstance(exp, BulkWriteError):
+        return 0, 0
+    details = exp.details
+    errors = details.get("writeErrors", [])
+    failed = _events(
+        weights,
+        [error["index"] for error in errors if error.get("code") != DUPLICATE_KEY_ERROR],
+    )
+    if upserts:
+        inserted = _events(
+            weights, [upserted["index"] for upserted in details.get("upserted", [])]
+        )
+        return inserted, total - inserted - failed
+    duplicates = _events(
+        weights,
+        [error["index"] for error in errors if error.get("code") == DUPLICATE_KEY_ERROR],
+    )
+    return total - failed - duplicates, duplicates
+
+
+def _upserted_counts(result, total, weights):
+    """(inserted, duplicates) events of a batch of total events written by bulk_write."""
+    if weights is None:
+        return result.upserted_count, result.matched_count
+    inserted = _events(weights, list(result.upserted_ids))
+    return inserted, total - inserted
+
+
+def _upserts(logs):
+    return [ReplaceOne({"_id": log["_id"]}, log, upsert=True) for log in logs]
+
+
+class BulkWriter:
+    """Thread pool based writer for pymongo collections.
+
+    Without a collection, every batch is submitted with its own collection, whose name is
+    collection_name.
+    """
+
+    def __init__(
+        self,
+        collection=None,
+        extra=None,
+        concurrency=INSERT_CONCURRENCY,
+        idempotent=IDEMPOTENT_INSERTS,
+        metrics=None,
+        layout=None,
+        collection_name=None,
+    ):
+        collection_name = collection_name or collection.name
+        self.collection = (
+            collection.with_options(write_concern=get_write_concern())
+            if collection is not None
+            else None
+        )
+        self.extra = extra or {}
+        self.layout = layout or get_layout(collection_name)
+        self.schema = get_schema(collection_name)
+        self.idempotent = idempotent if self.layout.upserts else None
+        self.metrics = metrics
+        self.stats = InsertStats(collection_name)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @property
+    def inserted(self):
+        return self.stats.inserted
+
+    def submit(self, logs, on_inserted=None, collection=None):
+        """Queues a batch for insertion, blocking while INSERT_CONCURRENCY batches are in flight.
+
+        on_inserted is called with the number of documents stored, inserted or skipped as
+        duplicates, once the batch is acknowledged.
+        """
+        self.slots.acquire()
+        future = self.executor.submit(self.insert, logs, on_inserted, collection)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            _log_failed_batch(future.exception(), self.extra)
+
+    def insert(self, logs, on_inserted=None, collection=None):
+        if collection is None:
+            collection = self.collection
+        start = time.perf_counter()
+        weights = None
+        try:
+            if self.schema:
+                logs = self.schema.apply(logs)
+            documents, weights = self.layout.documents(logs)
+            if self.idempotent == "upsert":
+                result = collection.bulk_write(_upserts(documents), ordered=False)
+                inserted, duplicates = _upserted_counts(result, len(logs), weights)
+            else:
+                collection.insert_many(documents, ordered=False)
+                inserted, duplicates = len(logs), 0
+        except Exception as exp:
+            # Besides MongoDB errors e.g. bson's InvalidDocument, the batch counts as failed.
+            _log_insert_error(exp, self.extra)
+            inserted, duplicates = _write_counts(
+                exp, len(logs), weights, self.idempotent == "upsert"
+            )
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.stats.record(
+                inserted, duplicates, len(logs) - inserted - duplicates, seconds
+            )
+        if self.metrics:
+            self.metrics.inserted(len(logs), inserted + duplicates, seconds)
+        if on_inserted:
+            on_inserted(inserted + duplicates)
+
+    def close(self):
+        """Waits for the batches in flight."""
+        self.executor.shutdown(wait=True)
+
+
+class AsyncBulkWriter:
+    """Asyncio writer for Motor collections.
+
+    Without a collection, every batch is submitted with its own collection, whose name is
+    collection_name.
+    """
+
+    def __init__(
+        self,
+        collection=None,
+        extra=None,
+        concurrency=INSERT_CONCURRENCY,
+        idempotent=IDEMPOTENT_INSERTS,
+        metrics=None,
+        layout=None,
+        collection_name=None,
+    ):
+        collection_name = collection_name or collection.name
+        self.collection = (
+            collection.with_options(write_concern=get_write_concern())
+            if collection is not None
+            else None
+        )
+        self.extra = extra or {}
+        self.layout = layout or get_layout(collection_name)
+        self.schema = get_schema(collection_name)
+        self.idempotent = idempotent if self.layout.upserts else None
+        self.metrics = metrics
+        self.stats = InsertStats(collection_name)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+
+    @property
+    def inserted(self):
+        return self.stats.inserted
+
+    async def submit(self, logs, on_inserted=None, collection=None):
+        """Schedules a batch for insertion, waiting while INSERT_CONCURRENCY batches are in flight.
+
+        on_inserted is called with the number of documents stored, inserted or skipped as
+        duplicates, once the batch is acknowledged.
+        """
+        await self.slots.acquire()
+        task = asyncio.create_task(self.insert(logs, on_inserted, collection))
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+
+    def done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            _log_failed_batch(task.exception(), self.extra)
+
+    async def insert(self, logs, on_inserted=None, collection=None):
+        if collection is None:
+            collection = self.collection
+        start = time.perf_counter()
+        weights = None
+        try:
+            if self.schema:
+                logs = self.schema.apply(logs)
+            documents, weights = self.layout.documents(logs)
+            if self.idempotent == "upsert":
+                result = await collection.bulk_write(
+                    _upserts(documents), ordered=False
+                )
+                inserted, duplicates = _upserted_counts(result, len(logs), weights)
+            else:
+                await collection.insert_many(documents, ordered=False)
+                inserted, duplicates = len(logs), 0
+        except Exception as exp:
+            # Besides MongoDB errors e.g. bson's InvalidDocument, the batch counts as failed.
+            _log_insert_error(exp, self.extra)
+            inserted, duplicates = _write_counts(
+                exp, len(logs), weights, self.idempotent == "upsert"
+            )
+        finally:
+            self.slots.release()
+        seconds = time.perf_counter() - start
+        self.stats.record(
+            inserted, duplicates, len(logs) - inserted - duplicates, seconds
+        )
+        if self.metrics:
+            self.metrics.inserted(len(logs), inserted + duplicates, seconds)
+        if on_inserted:
+            on_inserted(inserted + duplicates)
+
+    async def close(self):
+        """Waits for the batches in flight, their errors are logged by done."""
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class ClientRouter:
+    """Routes the events of a batched search to the collection of their client.
+
+    Args:
+        database_for (Callable): Client (domain) name -> its database.
+        collection_name (str): Name of the collection in every client database.
+    """
+
+    def __init__(self, database_for, collection_name, extra=None):
+        self.database_for = database_for
+        self.collection_name = collection_name
+        self.extra = extra or {}
+        self.collections = {}
+
+    def collection_for(self, client):
+        if client not in self.collections:
+            self.collections[client] = (
+                self.database_for(client)
+                .get_collection(self.collection_name)
+                .with_options(write_concern=get_write_concern())
+            )
+        return self.collections[client]
+
+    def route(self, logs):
+        """Returns (collection, events) per client of the batch and the unroutable events."""
+        per_client = defaultdict(list)
+        for line_json in logs:
+            per_client[line_json.get("domainName")].append(line_json)
+        unrouted = per_client.pop(None, [])
+        if unrouted:
+            logging.error(
+                msg="Events without domainName",
+                extra={**self.extra, "Records Failed": f"{len(unrouted)}"},
+            )
+        return [
+            (self.collection_for(client), events)
+            for client, events in per_client.items()
+        ], unrouted
+
+
+class RoutedBulkWriter(BulkWriter):
+    """BulkWriter of a batched search, sharing its insert threads between all clients."""
+
+    def __init__(self, database_for, collection_name, extra=None, **options):
+        super().__init__(extra=extra, collection_name=collection_name, **options)
+        self.router = ClientRouter(database_for, collection_name, extra)
+
+    def submit(self, logs, on_inserted=None):
+        routed, unrouted = self.router.route(logs)
+        if unrouted:
+            with self.lock:
+                self.stats.record(0, 0, len(unrouted), 0.0)
+        for collection, events in routed:
+            super().submit(events, on_inserted, collection)
+
+
+class AsyncRoutedBulkWriter(AsyncBulkWriter):
+    """AsyncBulkWriter of a batched search, sharing its insert slots between all clients."""
+
+    def __init__(self, database_for, collection_name, extra=None, **options):
+        super().__init__(extra=extra, collection_name=collection_name, **options)
+        self.router = ClientRouter(database_for, collection_name, extra)
+
+    async def submit(self, logs, on_inserted=None):
+        routed, unrouted = self.router.route(logs)
+        if unrouted:
+            self.stats.record(0, 0, len(unrouted), 0.0)
+        for collection, events in routed:
+            await super().submit(events, on_inserted, collection)
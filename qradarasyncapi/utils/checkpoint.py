@@ -0,0 +1,283 @@
+"""Crash-safe checkpoints of the searches of a run.
+
+Every (event processor, client, query, window) search is tracked in a local SQLite database:
+the cursor_id it was triggered with, its record_count once completed, which result ranges
+have been inserted into MongoDB and whether it is done. A restarted run skips done searches,
+re-attaches to the cursor_id of searches that were still running instead of triggering them
+again and only downloads the result ranges that weren't inserted yet.
+
+It also keeps the record_count of every completed window, from which the windows of the
+next runs are planned, see utils/windows.py.
+
+The database is opened in WAL mode so that all worker processes can share it.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from utils.constants import (
+    CHECKPOINT_ENABLED,
+    CHECKPOINT_PATH,
+    WINDOW_HISTORY_DAYS,
+)
+from utils.windows import parse_window_time, window_minutes
+
+TRIGGERED = "triggered"
+COMPLETED = "completed"
+DONE = "done"
+# The search was cancelled and its window split in two, see query_executor.split_task.
+SPLIT = "split"
+
+
+def checkpoint_key(
+    event_processor, client, query_name, query_duration_start, query_duration_stop
+):
+    return f"{event_processor}|{client}|{query_name}|{query_duration_start}|{query_duration_stop}"
+
+
+class CheckpointStore:
+    def __init__(self, path=CHECKPOINT_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Shared by the insert threads of a search, hence the lock.
+        self.connection = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS searches (
+                    key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    cursor_id TEXT,
+                    record_count INTEGER,
+                    rows_inserted INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS ranges (
+                    key TEXT NOT NULL,
+                    cursor_id TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    stop INTEGER NOT NULL,
+                    PRIMARY KEY (key, cursor_id, start)
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS windows (
+                    client TEXT NOT NULL,
+                    query_name TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    stop TEXT NOT NULL,
+                    minutes REAL NOT NULL,
+                    record_count INTEGER NOT NULL,
+                    PRIMARY KEY (client, query_name, start, stop)
+                )"""
+            )
+
+    def get(self, key):
+        """Returns the checkpoint of a search as a dict, None if it was never triggered."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT state, cursor_id, record_count, rows_inserted FROM searches WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(
+            zip(("state", "cursor_id", "record_count", "rows_inserted"), row)
+        )
+
+    def is_done(self, key):
+        checkpoint = self.get(key)
+        return checkpoint is not None and checkpoint["state"] == DONE
+
+    def triggered(self, key, cursor_id):
+        """Records a newly triggered search, forgetting the progress of any previous cursor."""
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO searches (key, state, cursor_id, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, cursor_id = excluded.cursor_id,
+                record_count = NULL, rows_inserted = 0, updated_at = excluded.updated_at""",
+                (key, TRIGGERED, cursor_id, datetime.utcnow().isoformat()),
+            )
+
+    def completed(self, key, cursor_id, record_count):
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO searches (key, state, cursor_id, record_count, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, cursor_id = excluded.cursor_id,
+                record_count = excluded.record_count, updated_at = excluded.updated_at""",
+                (
+                    key,
+                    COMPLETED,
+                    cursor_id,
+                    record_count,
+                    datetime.utcnow().isoformat(),
+                ),
+            )
+
+    def range_done(self, key, cursor_id, start, stop):
+        """Records that rows start to stop (inclusive) of the cursor are stored in MongoDB."""
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.execute(
+                "INSERT OR IGNORE INTO ranges (key, cursor_id, start, stop) VALUES (?, ?, ?, ?)",
+                (key, cursor_id, start, stop),
+            )
+            self.connection.execute(
+                "UPDATE searches SET rows_inserted = rows_inserted + ?, updated_at = ? WHERE key = ?",
+                (stop - start + 1, datetime.utcnow().isoformat(), key),
+            )
+            self.connection.execute("COMMIT")
+
+    def done_ranges(self, key, cursor_id):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start, stop FROM ranges WHERE key = ? AND cursor_id = ?",
+                (key, cursor_id),
+            ).fetchall()
+        return {(start, stop) for start, stop in rows}
+
+    def finished(self, key):
+        self.set_state(key, DONE)
+
+    def split(self, key):
+        self.set_state(key, SPLIT)
+
+    def set_state(self, key, state):
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO searches (key, state, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at""",
+                (key, state, datetime.utcnow().isoformat()),
+            )
+
+    def observed(
+        self, client, query_name, query_duration_start, query_duration_stop, record_count
+    ):
+        """Records the record_count of a completed window."""
+        start = parse_window_time(query_duration_start)
+        stop = parse_window_time(query_duration_stop)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    client,
+                    query_name,
+                    start.isoformat(),
+                    stop.isoformat(),
+                    window_minutes(query_duration_start, query_duration_stop),
+                    record_count,
+                ),
+            )
+
+    def rows_per_minute(self, client, query_name, day):
+        """Rows per minute of the windows completed over the WINDOW_HISTORY_DAYS before day.
+
+        Only earlier days are taken into account, so a re-run of a day plans the same windows
+        and finds their checkpoints. Returns None if nothing was observed.
+        """
+        with self.lock:
+            minutes, record_count = self.connection.execute(
+                """SELECT SUM(minutes), SUM(record_count) FROM windows
+                WHERE client = ? AND query_name = ? AND start >= ? AND start < ?""",
+                (
+                    client,
+                    query_name,
+                    (day - timedelta(days=WINDOW_HISTORY_DAYS)).isoformat(),
+                    day.isoformat(),
+                ),
+            ).fetchone()
+        if not minutes:
+            return None
+        return record_count / minutes
+
+
+class RangeTracker:
+    """Counts the rows of every result range inserted into MongoDB and checkpoints complete ranges.
+
+    Rows that failed to insert keep their range pending, so it is downloaded again on restart.
+    """
+
+    def __init__(self, store, key, cursor_id, ranges):
+        self.store = store
+        self.key = key
+        self.cursor_id = cursor_id
+        self.pending = {chunk: chunk[1] - chunk[0] + 1 for chunk in ranges}
+        self.lock = threading.Lock()
+
+    def inserted(self, chunk, rows):
+        with self.lock:
+            self.pending[chunk] -= rows
+            done = self.pending[chunk] == 0
+            if done:
+                del self.pending[chunk]
+        if done:
+            self.store.range_done(self.key, self.cursor_id, *chunk)
+
+    def complete(self):
+        return not self.pending
+
+
+class NullCheckpointStore:
+    """Used when CHECKPOINT_ENABLED is False: remembers nothing."""
+
+    def get(self, key):
+        return None
+
+    def is_done(self, key):
+        return False
+
+    def triggered(self, key, cursor_id):
+        pass
+
+    def completed(self, key, cursor_id, record_count):
+        pass
+
+    def range_done(self, key, cursor_id, start, stop):
+        pass
+
+    def done_ranges(self, key, cursor_id):
+        return set()
+
+    def finished(self, key):
+        pass
+
+    def split(self, key):
+        pass
+
+    def observed(
+        self, client, query_name, query_duration_start, query_duration_stop, record_count
+    ):
+        pass
+
+    def rows_per_minute(self, client, query_name, day):
+        return None
+
+
+_store = None
+_store_pid = None
+
+
+def get_checkpoint_store():
+    """Returns this process' checkpoint store, SQLite connections can't cross a fork."""
+    global _store, _store_pid
+    if _store is None or _store_pid != os.getpid():
+        _store = CheckpointStore() if CHECKPOINT_ENABLED else NullCheckpointStore()
+        _store_pid = os.getpid()
+    return _store
+
+
+def task_checkpoint_key(task):
+    return checkpoint_key(
+        task.event_processor,
+        task.client,
+        task.query_name,
+        task.query_duration_start,
+        task.query_duration_stop,
+    )
+
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 # Values below represent the number of minutes
 # 1440 minutes in one day
 
@@ -19,3 +21,167 @@ SHORT_DURATION_QUERIES = [
     "Query1",
     "Query2",
 ]
+
+# Asyncio engine (async_main.py)
+# Number of Ariel searches the event loop keeps in flight at the same time.
+MAX_CONCURRENT_SEARCHES = 200
+# Upper bound on concurrent searches against a single event processor.
+MAX_SEARCHES_PER_EP = 20
+
+# Synchronous engine (main.py)
+# Number of worker processes draining the search queue.
+SEARCH_PROCESSES = 8
+
+# Console limits shared by every worker (utils/limiter.py)
+# Ariel searches allowed to run on the console at the same time.
+MAX_INFLIGHT_SEARCHES = 20
+# Budget for POST/GET calls against the QRadar API.
+REQUESTS_PER_SECOND = 10
+
+# Polling of running searches (utils/polling.py), values in seconds
+POLL_INITIAL_INTERVAL = 2
+POLL_BACKOFF_FACTOR = 2
+# Random +/- fraction applied to every interval.
+POLL_JITTER = 0.2
+# Upper bound of the polling interval, previously the fixed polling interval.
+SHORT_POLL_MAX_INTERVAL = 90
+LONG_POLL_MAX_INTERVAL = 180
+# Give up on a search that hasn't completed after this long.
+POLL_TIMEOUT = 3600
+
+# Connection pool of the QRadar API client (utils/http_client.py)
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+# Seconds an idle connection is kept open.
+HTTP_KEEPALIVE_EXPIRY = 60
+
+# Ranged download of search results (Range: items=x-y)
+# Searches with more rows than RESULT_CHUNK_SIZE are fetched in chunks of that many rows.
+RESULT_CHUNK_SIZE = 20000
+# Number of chunks downloaded at the same time for one search.
+RESULT_CHUNK_PARALLELISM = 4
+# Attempts per chunk before it is given up.
+RESULT_CHUNK_ATTEMPTS = 3
+
+# Retries of failed QRadar API calls (utils/retry.py), values in seconds
+# Backoff before the first retry, doubled for every consecutive failure up to RETRY_MAX_DELAY.
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 120
+# Random +/- fraction applied to every backoff.
+RETRY_JITTER = 0.5
+# Consecutive failures of a call before it is given up.
+RETRY_MAX_ATTEMPTS = 8
+# No retry or re-trigger is scheduled later than this after a search task started.
+RETRY_DEADLINE = 2 * 3600
+
+# Lifecycle of the Ariel searches the connector owns (utils/cursors.py)
+# Deletes a search from the console once its results are stored.
+DELETE_COMPLETED_SEARCHES = True
+# Before triggering a search, reuses a search of the console running the same query.
+REUSE_SEARCHES = True
+# Searches of the console looked at for reuse.
+REUSE_LOOKUP_MAX = 50
+
+# Bytes of downloaded results buffered in memory between the fetch and insert stage of one search.
+QUEUE_MAX_BYTES = 64 * 1024 * 1024
+# Bytes of downloaded results the queues of all searches of a process hold in memory together.
+PROCESS_MAX_BYTES = 512 * 1024 * 1024
+# Batches that don't fit in either budget are spilled to a temporary file and read back by the
+# insert stage, instead of stalling the download while MongoDB catches up (utils/batch_queue.py).
+SPILL_TO_DISK = True
+# Folder of the spill files, None for the system's temporary folder.
+SPILL_DIR = None
+
+# Inserts into MongoDB (utils/bulk_writer.py)
+# A batch is sent to insert_many once it holds INSERT_BATCH_SIZE documents or
+# INSERT_BATCH_BYTES of downloaded results, whichever comes first.
+INSERT_BATCH_SIZE = 1000
+INSERT_BATCH_BYTES = 4 * 1024 * 1024
+# insert_many calls in flight per collection.
+INSERT_CONCURRENCY = 4
+# Write concern of the inserts, e.g. w=1 and j=False trade durability for throughput.
+MONGO_WRITE_CONCERN_W = "majority"
+MONGO_WRITE_CONCERN_J = None
+# Deterministic _id for every event (utils/document_ids.py) so that re-triggered searches,
+# retried ranges and re-runs don't insert duplicates:
+# None keeps MongoDB's ObjectIds, "skip" leaves documents that are already stored untouched,
+# "upsert" replaces them.
+IDEMPOTENT_INSERTS = None
+
+# Collections and indexes of the raw_* collections (utils/provisioning.py)
+# Creates the collections and indexes declared in COLLECTION_SPEC_PATH before a run. Off by
+# default: the first run with it builds the indexes of the existing collections, which blocks
+# the run for as long as the builds take on big collections (see BUILD_INDEXES_AFTER_LOAD).
+# The timeseries and clustered types of the spec need it, MongoDB creates the collections as
+# regular ones otherwise.
+PROVISION_COLLECTIONS = False
+COLLECTION_SPEC_PATH = str(Path(__file__).parent.parent / "input" / "collections.json")
+# Only creates the collections before a run and builds their indexes once all results are
+# stored, a single index build is much faster than maintaining the indexes during a backfill.
+BUILD_INDEXES_AFTER_LOAD = False
+
+# MongoDB client options (mongoclient.py)
+MONGO_MAX_POOL_SIZE = 100
+# Wire protocol compression, e.g. "zstd,zlib" once the zstandard module is installed.
+MONGO_COMPRESSORS = "zlib"
+MONGO_CONNECT_TIMEOUT_MS = 20000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 30000
+MONGO_SOCKET_TIMEOUT_MS = 300000
+
+# Checkpoints of the searches of a run (utils/checkpoint.py)
+# A restarted run skips the searches a previous run finished and resumes the others.
+CHECKPOINT_ENABLED = True
+CHECKPOINT_PATH = str(
+    Path(__file__).parent.parent.parent / "checkpoints" / "searches.sqlite3"
+)
+
+# Adaptive search windows (utils/windows.py)
+# Instead of SHORT_SEARCH_DURATION / LONG_SEARCH_DURATION, the window of every (client, query)
+# is planned from the rows per minute it returned on the last WINDOW_HISTORY_DAYS days,
+# aiming at TARGET_SEARCH_ROWS rows per search. Needs CHECKPOINT_ENABLED.
+ADAPTIVE_WINDOWS = True
+TARGET_SEARCH_ROWS = 200000
+WINDOW_HISTORY_DAYS = 7
+# Window lengths in minutes a search can be planned with, each of them divides a day.
+SEARCH_DURATIONS = [15, 30, 60, 90, 180, 360, 720, 1440]
+# A running search is cancelled and its window split in half once it reports more than
+# SPLIT_RECORD_COUNT rows, or runs for more than SPLIT_SEARCH_SECONDS while less than half done.
+# Windows are never split below MIN_SEARCH_DURATION minutes.
+SPLIT_RECORD_COUNT = 4 * TARGET_SEARCH_ROWS
+SPLIT_SEARCH_SECONDS = 1800
+MIN_SEARCH_DURATION = 15
+
+# Batched multi-client searches (query_executor.py)
+# Runs one search per event processor, query and window for up to BATCH_CLIENTS_MAX clients of
+# the EP, filtered with DOMAINNAME(domainId) IN (...), instead of one search per client. The
+# rows are routed to the database of their client by their domainName column, which the
+# queries must select.
+BATCH_CLIENTS = False
+BATCH_CLIENTS_MAX = 50
+
+# Per-stage metrics (utils/metrics.py)
+# Port of the Prometheus /metrics endpoint served by the main process, None to disable it.
+METRICS_PORT = None
+METRICS_ADDRESS = "127.0.0.1"
+# Text file rewritten every METRICS_FLUSH_SECONDS for node_exporter's textfile collector,
+# None to disable it.
+METRICS_TEXTFILE = str(Path(__file__).parent.parent.parent / "metrics" / "qradar.prom")
+# Folder the worker processes of the synchronous engine publish their metrics in.
+METRICS_DIR = str(Path(__file__).parent.parent.parent / "metrics" / "workers")
+METRICS_FLUSH_SECONDS = 15
+
+# Local spool (utils/spool.py)
+# Writes the results to compressed NDJSON segments under SPOOL_DIR instead of inserting them,
+# for when MongoDB is unavailable or slow. spool_loader.py loads the segments afterwards.
+SPOOL_RESULTS = False
+SPOOL_DIR = str(Path(__file__).parent.parent.parent / "spool")
+# "gzip", or "zstd" once the zstandard module is installed.
+SPOOL_COMPRESSION = "gzip"
+# Low levels keep up with the download, gzip's default of 9 doesn't.
+SPOOL_COMPRESSION_LEVEL = 3
+# Worker processes of spool_loader.py, each loading one segment at a time.
+SPOOL_LOAD_PROCESSES = 8
+
+# Logging (utils/logger.py)
+# Log files of clients kept open at the same time, the least recently used one is closed first.
+LOG_MAX_OPEN_FILES = 256
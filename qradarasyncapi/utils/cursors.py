@@ -0,0 +1,32 @@
+"""Lifecycle of the Ariel searches (cursors) the connector triggers.
+
+A completed search keeps its results on the console, using Ariel disk and counting against
+the concurrent searches, until it expires. A task owns the searches it triggered itself, and
+with DELETE_COMPLETED_SEARCHES deletes them as soon as all their results are stored, or once
+they failed and are triggered again. Searches it reused or re-attached to from its checkpoint
+may have been started by another run or by an analyst, they are left to expire. Searches whose
+results were only partly stored are kept, so the next run can re-attach to them.
+
+Before a search is triggered, the searches on the console are looked up with REUSE_SEARCHES
+and one running the same query expression is reused rather than triggering a duplicate, e.g.
+one left running by a crashed run or whose trigger timed out on our side but reached the
+console.
+"""
+
+# Statuses of searches that are running or completed without errors.
+REUSABLE_STATUSES = {"WAIT", "EXECUTE", "SORTING", "COMPLETED"}
+
+
+def normalize_expression(query_expression):
+    """The console may return the query with its whitespace collapsed."""
+    return " ".join(query_expression.split())
+
+
+def is_reusable(status, query_expression):
+    """Whether the search with the given status can be reused for query_expression."""
+    return (
+        not status.get("error_messages")
+        and status.get("status") in REUSABLE_STATUSES
+        and normalize_expression(status.get("query_string") or "")
+        == normalize_expression(query_expression)
+    )
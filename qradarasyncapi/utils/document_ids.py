@@ -0,0 +1,42 @@
+"""Deterministic _id of the events inserted into MongoDB.
+
+With IDEMPOTENT_INSERTS enabled every event gets an _id derived from a hash of its fields,
+the query and the search window instead of the ObjectId MongoDB would generate, so inserting
+the same event twice, from a re-triggered search, a retried range or a re-run of the day,
+hits the _id index instead of creating a duplicate document.
+
+Ariel can return identical rows, e.g. for aggregated queries. These are kept apart by their
+ordinal among the identical rows of the same result range.
+"""
+
+import hashlib
+from collections import Counter, defaultdict
+import orjson
+
+
+class DocumentIds:
+    """Assigns the _id of the events of one search."""
+
+    def __init__(self, query_name, query_duration_start, query_duration_stop):
+        self.prefix = f"{query_name}|{query_duration_start}|{query_duration_stop}|".encode()
+        # Hashes seen so far per result range, dropped once the whole range went through.
+        self.seen = defaultdict(Counter)
+
+    def assign(self, logs, chunk):
+        """Sets the _id of a batch of events of the given result range in place.
+
+        Must be called before any field is added to the events, see utils/enrichment.py.
+        """
+        start, stop = chunk
+        seen = self.seen[chunk]
+        for line_json in logs:
+            digest = hashlib.blake2b(
+                self.prefix + orjson.dumps(line_json, option=orjson.OPT_SORT_KEYS),
+                digest_size=16,
+            ).hexdigest()
+            ordinal = seen[digest]
+            seen[digest] += 1
+            line_json["_id"] = f"{digest}-{ordinal}" if ordinal else digest
+        if seen.total() >= stop - start + 1:
+            del self.seen[chunk]
+        return logs
@@ -0,0 +1,46 @@
+"""Date fields added to every Ariel event before it is inserted into MongoDB"""
+
+from datetime import datetime
+from functools import lru_cache
+from dateutil.relativedelta import relativedelta, SA
+
+# ReportDate and WeekFrom only depend on the local day of the event. Every UTC offset in use
+# is a multiple of 15 minutes, so all events of a 15 minute bucket share the same local day.
+_BUCKET_SECONDS = 900
+
+
+@lru_cache(maxsize=4096)
+def _report_dates(bucket):
+    """Returns the ReportDate and WeekFrom (previous Saturday) strings for a 15 minute bucket."""
+    local_time = datetime.fromtimestamp(bucket * _BUCKET_SECONDS)
+    report_date = local_time.strftime("%d/%m/%Y")
+    prev_saturday = (local_time + relativedelta(weekday=SA(-1))).strftime(
+        "%d/%m/%Y"
+    )
+    return report_date, prev_saturday
+
+
+def add_dates(logs):
+    """Adds Start Time ISO, WeekFrom, ReportDate and createdAt to a batch of events in place.
+
+    createdAt is the same for the whole batch.
+    """
+    created_at = datetime.utcnow()
+    for line_json in logs:
+        query_date_epoch = line_json.get("Start Time")
+        if query_date_epoch is not None:
+            query_timestamp = query_date_epoch // 1000
+            report_date, prev_saturday = _report_dates(
+                query_timestamp // _BUCKET_SECONDS
+            )
+            line_json["Start Time ISO"] = datetime.utcfromtimestamp(
+                query_timestamp
+            )
+            line_json["WeekFrom"] = prev_saturday
+            line_json["ReportDate"] = report_date
+        line_json["createdAt"] = created_at
+    return logs
+
+
+def add_date(line_json):
+    return add_dates([line_json])[0]
@@ -0,0 +1,49 @@
+"""Pooled HTTP/2 clients for the QRadar API.
+
+Every trigger, poll and results call of a worker goes through the same client, so the TCP
+and TLS handshakes with the console are paid once per connection instead of once per call,
+and concurrent calls are multiplexed over HTTP/2.
+"""
+
+import os
+import httpx
+from utils.constants import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+)
+
+_client = None
+_client_pid = None
+
+
+def get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_client() -> httpx.Client:
+    """Returns this process' shared client, creating it on first use.
+
+    The client is recreated after a fork as pooled connections can't be shared between processes.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = httpx.Client(http2=True, verify=False, limits=get_limits())
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns a new pooled client for the asyncio engine, to be closed by the caller."""
+    return httpx.AsyncClient(http2=True, verify=False, limits=get_limits())
+
+
+def close_client():
+    global _client
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+    _client = None
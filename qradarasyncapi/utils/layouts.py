@@ -0,0 +1,115 @@
+"""Shapes of the documents the events of a query are stored as, by the type of its collection.
+
+    regular, clustered  One document per event.
+    timeseries          One measurement per event in a MongoDB time-series collection. The
+                        meta_fields of the event, its domain and log source by default, are moved
+                        to its meta subdocument, the metaField, and MongoDB packs the measurements
+                        of the same meta into compressed buckets itself.
+    buckets             Up to bucket_size events of the same meta_fields packed into one
+                        document of a regular collection:
+
+        {"meta": {...}, "start": <first Start Time ISO>, "stop": <last Start Time ISO>,
+         "count": <events>, "createdAt": ..., "events": [<events without the meta fields>]}
+
+Both store the meta fields once per bucket rather than once per event and index buckets
+instead of events, which cuts storage and index size several-fold and makes inserts cost per
+byte rather than per document. See utils/provisioning.py for the collection spec.
+
+Time-series collections don't support replacing measurements and which events share a bucket
+depends on where the batches of a download end, so the writers of both always insert.
+IDEMPOTENT_INSERTS is refused for bucket collections, see provisioning.check_specs.
+"""
+
+from collections import defaultdict
+from functools import lru_cache
+from utils.provisioning import (
+    META_FIELD,
+    TIME_FIELD,
+    TTL_FIELD,
+    collection_spec,
+    load_specs,
+)
+
+
+def split_meta(line_json, meta_fields):
+    """Removes the meta fields from an event and returns them."""
+    return {field: line_json.pop(field, None) for field in meta_fields}
+
+
+class Documents:
+    """One document per event, as it was enriched."""
+
+    upserts = True
+
+    def documents(self, logs):
+        """Returns the documents storing the events and the number of events in each of
+        them, None if there is one per document."""
+        return logs, None
+
+
+class Measurements:
+    """One measurement per event in a time-series collection."""
+
+    upserts = False
+
+    def __init__(self, meta_fields):
+        self.meta_fields = meta_fields
+
+    def documents(self, logs):
+        if self.meta_fields:
+            for line_json in logs:
+                line_json[META_FIELD] = split_meta(line_json, self.meta_fields)
+        return logs, None
+
+
+class Buckets:
+    """bucket_size events with the same meta fields per document."""
+
+    upserts = False
+
+    def __init__(self, meta_fields, bucket_size):
+        self.meta_fields = meta_fields
+        self.bucket_size = bucket_size
+
+    def documents(self, logs):
+        groups = defaultdict(list)
+        for line_json in logs:
+            meta = split_meta(line_json, self.meta_fields)
+            groups[tuple(meta.values())].append(line_json)
+        buckets = [
+            self.bucket(
+                dict(zip(self.meta_fields, key)),
+                events[index : index + self.bucket_size],
+            )
+            for key, events in groups.items()
+            for index in range(0, len(events), self.bucket_size)
+        ]
+        return buckets, [bucket["count"] for bucket in buckets]
+
+    def bucket(self, meta, events):
+        times = [
+            line_json[TIME_FIELD] for line_json in events if TIME_FIELD in line_json
+        ]
+        bucket = {
+            META_FIELD: meta,
+            "start": min(times, default=None),
+            "stop": max(times, default=None),
+            "count": len(events),
+            # All events of a batch share their createdAt, see utils/enrichment.py.
+            TTL_FIELD: events[0].get(TTL_FIELD),
+            "events": events,
+        }
+        for line_json in events:
+            line_json.pop(TTL_FIELD, None)
+        return bucket
+
+
+@lru_cache(maxsize=None)
+def get_layout(collection_name):
+    """Layout of the documents of a raw_<query> collection, from its collection spec."""
+    spec = collection_spec(load_specs(), collection_name)
+    if spec["type"] == "timeseries":
+        return Measurements(spec["meta_fields"])
+    if spec["type"] == "buckets":
+        return Buckets(spec["meta_fields"], spec["bucket_size"])
+    return Documents()
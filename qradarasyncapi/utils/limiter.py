@@ -0,0 +1,108 @@
+"""Limits on how hard the connector drives the QRadar console.
+
+QRadar caps the number of concurrent Ariel searches and starts answering 503 when it is
+flooded with API calls. Every search holds a search slot from trigger until it completes and
+every API call takes a token from a token bucket refilled at requests_per_second.
+
+ConsoleLimiter is shared by all tasks of the asyncio engine, SharedConsoleLimiter by all
+worker processes of the synchronous engine (handed to them through the Pool initializer).
+"""
+
+import asyncio
+import multiprocessing as mp
+import time
+from utils.constants import MAX_INFLIGHT_SEARCHES, REQUESTS_PER_SECOND
+
+
+class TokenBucket:
+    """Asyncio token bucket allowing rate calls per second with bursts of up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ConsoleLimiter:
+    def __init__(
+        self,
+        max_searches=MAX_INFLIGHT_SEARCHES,
+        requests_per_second=REQUESTS_PER_SECOND,
+    ):
+        self.searches = asyncio.Semaphore(max_searches)
+        self.requests = TokenBucket(requests_per_second)
+
+    def search_slot(self):
+        """Async context manager held while a search is running on the console."""
+        return self.searches
+
+    async def throttle(self):
+        """Waits until the next API call fits in the requests per second budget."""
+        await self.requests.acquire()
+
+
+class SharedConsoleLimiter:
+    """Process-safe equivalent of ConsoleLimiter built on multiprocessing primitives."""
+
+    def __init__(
+        self,
+        max_searches=MAX_INFLIGHT_SEARCHES,
+        requests_per_second=REQUESTS_PER_SECOND,
+    ):
+        self.searches = mp.BoundedSemaphore(max_searches)
+        self.rate = requests_per_second
+        self.lock = mp.Lock()
+        self.tokens = mp.RawValue("d", requests_per_second)
+        self.updated = mp.RawValue("d", time.monotonic())
+
+    def search_slot(self):
+        """Context manager held while a search is running on the console."""
+        return self.searches
+
+    def throttle(self):
+        """Blocks until the next API call fits in the requests per second budget."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens.value = min(
+                    self.rate,
+                    self.tokens.value + (now - self.updated.value) * self.rate,
+                )
+                self.updated.value = now
+                if self.tokens.value >= 1:
+                    self.tokens.value -= 1
+                    return
+                wait = (1 - self.tokens.value) / self.rate
+            time.sleep(wait)
+
+
+_shared_limiter = None
+
+
+def init_worker(limiter):
+    """Pool initializer installing the limiter created by the parent process."""
+    global _shared_limiter
+    _shared_limiter = limiter
+
+
+def get_shared_limiter():
+    """Returns this process' SharedConsoleLimiter, creating a private one if none was installed."""
+    global _shared_limiter
+    if _shared_limiter is None:
+        _shared_limiter = SharedConsoleLimiter()
+    return _shared_limiter
@@ -1,9 +1,117 @@
-"""Module to setup logging"""
+"""Module to setup logging
 
+Logging is configured once per process from config/logging_config.yaml. The handlers it
+declares don't run on the threads that log: the root logger only has a QueueHandler, and a
+QueueListener thread formats the records as JSON and writes them, so a search never waits on
+the disk or the console.
+
+Records go to new_logs/<event processor>/pymongologs_<client>.json. The client is the one of
+the current asyncio task or thread if set_log_context was called there, otherwise the one the
+process last passed to setup_logging (a worker of the synchronous engine runs one search at a
+time). At most LOG_MAX_OPEN_FILES client files are kept open.
+"""
+
+import contextvars
 import logging.config
+import logging.handlers
 import os
+import queue
+from collections import OrderedDict
+from multiprocessing.util import Finalize
 from pathlib import Path
 import yaml
+from utils.constants import LOG_MAX_OPEN_FILES
+
+LOG_FOLDER = Path(__file__).parent.parent.parent / "new_logs"
+DEFAULT_ROUTE = ("default", "client")
+
+# (event processor, client) of the current asyncio task or thread, see set_log_context.
+_route = contextvars.ContextVar("log_route", default=None)
+# (event processor, client) of the process, see SetupLogging.setup_logging.
+_process_route = DEFAULT_ROUTE
+_listener = None
+_listener_pid = None
+
+
+def set_log_context(event_processor, client):
+    """Routes the records of the current asyncio task or thread to the log file of client."""
+    _route.set((event_processor, client))
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queues every record with the (event processor, client) it was logged for.
+
+    The queue stays in the process, so records are passed as they are instead of being
+    formatted for pickling on the calling thread.
+    """
+
+    def prepare(self, record):
+        return _route.get() or _process_route, record
+
+
+class RoutingQueueListener(logging.handlers.QueueListener):
+    """Hands the route of every record to the ClientFileHandlers before they handle it."""
+
+    def prepare(self, item):
+        route, record = item
+        for handler in self.handlers:
+            if isinstance(handler, ClientFileHandler):
+                handler.route = route
+        return record
+
+
+class ClientFileHandler(logging.Handler):
+    """Writes every record to the TimedRotatingFileHandler of its (event processor, client).
+
+    Only used from the listener thread, which sets route before every record.
+
+    Args:
+        filename (str): Ignored, the file names are derived from the route.
+        **kwargs: Options of the TimedRotatingFileHandler of every client.
+    """
+
+    def __init__(self, filename=None, max_open_files=LOG_MAX_OPEN_FILES, **kwargs):
+        super().__init__()
+        self.options = kwargs
+        self.max_open_files = max_open_files
+        self.route = DEFAULT_ROUTE
+        self.files = OrderedDict()
+
+    def file_for(self, route):
+        handler = self.files.get(route)
+        if handler is not None:
+            self.files.move_to_end(route)
+            return handler
+        event_processor, client = route
+        path_to_folder = LOG_FOLDER / f"{event_processor}"
+        os.makedirs(path_to_folder, exist_ok=True)
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path_to_folder / f"pymongologs_{client}.json", **self.options
+        )
+        handler.setFormatter(self.formatter)
+        self.files[route] = handler
+        if len(self.files) > self.max_open_files:
+            self.files.popitem(last=False)[1].close()
+        return handler
+
+    def emit(self, record):
+        self.file_for(self.route).handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        self.files.clear()
+        super().close()
+
+
+def stop_logging():
+    """Writes the queued records and stops the listener of this process."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
 
 
 class SetupLogging:
@@ -20,27 +128,41 @@ class SetupLogging:
         client="client",
         default_level=logging.DEBUG,
     ):
+        """Configures logging on the first call of a process, every call routes the records of
+        the process to the log file of event_processor and client."""
+        global _process_route
+        _process_route = (event_processor, client)
+        if _listener is not None and _listener_pid == os.getpid():
+            return
         try:
             path = self.default_config
-            path_to_folder = (
-                Path(__file__).parent.parent.parent
-                / "new_logs"
-                / f"{event_processor}"
-            )
-            path_to_file = path_to_folder / f"pymongologs_{client}.json"
             if os.path.exists(path):
-                if not os.path.exists(path_to_folder):
-                    print("Creating logging directory")
-                    os.makedirs(path_to_folder)
-
                 with open(path, "r", encoding="utf-8") as log_file:
                     config = yaml.safe_load(log_file.read())
-                    config["handlers"]["filehandler"][
-                        "filename"
-                    ] = path_to_file
-                    logging.config.dictConfig(config)
-                    logging.captureWarnings(False)
+                filehandler = config["handlers"]["filehandler"]
+                filehandler["()"] = ClientFileHandler
+                filehandler.pop("class")
+                logging.config.dictConfig(config)
+                logging.captureWarnings(False)
+                self.start_listener()
             else:
                 logging.basicConfig(level=default_level)
         except TypeError as te:
             logging.exception("Error occured while setting up logging...", te)
+
+    def start_listener(self):
+        """Moves the configured root handlers behind a queue and its listener thread."""
+        global _listener, _listener_pid
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        for handler in handlers:
+            root.removeHandler(handler)
+        log_queue = queue.SimpleQueue()
+        root.addHandler(ContextQueueHandler(log_queue))
+        _listener = RoutingQueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        _listener_pid = os.getpid()
+        _listener.start()
+        # Runs after the finalizers closing the clients, which may still log.
+        Finalize(None, stop_logging, exitpriority=0)
@@ -0,0 +1,31 @@
+"""Memory used by the connector's process.
+
+Measured with memory_profiler when it is installed, otherwise read from /proc or, where that
+doesn't exist, approximated by the peak resident size.
+"""
+
+import os
+import resource
+import sys
+
+try:
+    from memory_profiler import memory_usage
+except ImportError:
+    memory_usage = None
+
+
+def resident_bytes():
+    """Resident set size of this process in bytes."""
+    if memory_usage is not None:
+        return int(max(memory_usage(-1, interval=0)) * 1024 * 1024)
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_stats():
+    return {"Resident Memory (in MB)": f"{resident_bytes() / 1024 / 1024:.0f}"}
@@ -0,0 +1,424 @@
+"""Per-stage metrics of the searches in the Prometheus text exposition format.
+
+Every stage of a search records into the registry of its process, labelled by event
+processor, client and query:
+
+    search   time waiting for a console search slot, polls, trigger to completion
+    fetch    bytes received and the time spent receiving them, rows parsed and the time
+             spent parsing them, time blocked on a full queue
+    queue    batches and bytes waiting between the fetch and the insert stage, bytes spilled
+             to disk
+    insert   latency and size of every insert batch, documents stored
+    total    task start until the results are stored
+
+The resident memory of every process and the bytes its queues hold in memory are labelled by
+pid instead.
+
+Rates are derived by Prometheus, e.g. download bytes/s of a client is
+rate(qradar_download_bytes_total[5m]) / rate(qradar_download_seconds_total[5m]).
+
+MetricsExporter runs in the main process. It serves /metrics on METRICS_PORT and rewrites
+METRICS_TEXTFILE every METRICS_FLUSH_SECONDS for node_exporter's textfile collector. The
+worker processes of the synchronous engine publish their registry as a snapshot in
+METRICS_DIR, which the exporter sums with its own.
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import orjson
+from utils.batch_queue import get_memory_budget
+from utils.memory import resident_bytes
+from utils.constants import (
+    METRICS_ADDRESS,
+    METRICS_DIR,
+    METRICS_FLUSH_SECONDS,
+    METRICS_PORT,
+    METRICS_TEXTFILE,
+)
+
+LABELS = ("ep", "client", "query")
+PROCESS_LABELS = ("pid",)
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+DOCUMENTS_BUCKETS = (1, 10, 100, 250, 500, 1000, 2500, 5000, 10000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name: (type, help, histogram buckets)
+DEFINITIONS = {
+    "qradar_search_queue_seconds": (
+        "histogram",
+        "Time from the start of the task until its search was triggered.",
+        SECONDS_BUCKETS,
+    ),
+    "qradar_search_polls_total": ("counter", "Status polls of running searches.", None),
+    "qradar_search_seconds": (
+        "histogram",
+        "Time from the trigger until the search completed on the console.",
+        SECONDS_BUCKETS,
+    ),
+    "qradar_download_bytes_total": ("counter", "Bytes of search results received.", None),
+    "qradar_download_seconds_total": (
+        "counter",
+        "Time spent receiving search results.",
+        None,
+    ),
+    "qradar_parsed_rows_total": ("counter", "Rows parsed from search results.", None),
+    "qradar_parse_seconds_total": (
+        "counter",
+        "Time spent parsing search results.",
+        None,
+    ),
+    "qradar_queue_wait_seconds_total": (
+        "counter",
+        "Time the fetch stage was blocked on a full queue.",
+        None,
+    ),
+    "qradar_queue_batches": (
+        "gauge",
+        "Batches queued between the fetch and the insert stage.",
+        None,
+    ),
+    "qradar_queue_bytes": (
+        "gauge",
+        "Bytes of results queued between the fetch and the insert stage.",
+        None,
+    ),
+    "qradar_spilled_bytes_total": (
+        "counter",
+        "Bytes of results spilled to disk because the queue or process budget was used up.",
+        None,
+    ),
+    "qradar_insert_seconds": (
+        "histogram",
+        "Latency of the insert batches.",
+        SECONDS_BUCKETS,
+    ),
+    "qradar_insert_batch_documents": (
+        "histogram",
+        "Documents per insert batch.",
+        DOCUMENTS_BUCKETS,
+    ),
+    "qradar_inserted_documents_total": (
+        "counter",
+        "Documents stored, inserted or skipped as duplicates.",
+        None,
+    ),
+    "qradar_search_total_seconds": (
+        "histogram",
+        "Time from the start of the task until its results were stored.",
+        SECONDS_BUCKETS,
+    ),
+    "qradar_process_resident_bytes": (
+        "gauge",
+        "Resident memory of the process.",
+        None,
+    ),
+    "qradar_process_queued_bytes": (
+        "gauge",
+        "Bytes of results the queues of the process hold in memory.",
+        None,
+    ),
+}
+PROCESS_METRICS = {"qradar_process_resident_bytes", "qradar_process_queued_bytes"}
+
+
+class Registry:
+    """Metric values of one process.
+
+    Counters and gauges are floats, histograms lists of per-bucket counts followed by their
+    sum and count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: {} for name in DEFINITIONS}
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + amount
+        publish()
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.values[name][labels] = value
+        publish()
+
+    def observe(self, name, labels, value):
+        buckets = DEFINITIONS[name][2]
+        with self.lock:
+            values = self.values[name]
+            if labels not in values:
+                values[labels] = [0] * len(buckets) + [0.0, 0]
+            histogram = values[labels]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+        publish()
+
+    def record_process(self):
+        """Updates the memory gauges of this process."""
+        pid = (str(os.getpid()),)
+        resident, queued = resident_bytes(), get_memory_budget().bytes
+        with self.lock:
+            self.values["qradar_process_resident_bytes"][pid] = resident
+            self.values["qradar_process_queued_bytes"][pid] = queued
+
+    def snapshot(self):
+        """{name: [[labels, value], ...]}, what worker processes publish."""
+        with self.lock:
+            return {
+                name: [
+                    [list(labels), list(value) if isinstance(value, list) else value]
+                    for labels, value in values.items()
+                ]
+                for name, values in self.values.items()
+            }
+
+
+def merge(snapshots):
+    """Sums snapshots of several processes into {name: {labels: value}}."""
+    merged = {name: {} for name in DEFINITIONS}
+    for snapshot in snapshots:
+        for name, samples in snapshot.items():
+            if name not in merged:
+                continue
+            values = merged[name]
+            for labels, value in samples:
+                labels = tuple(labels)
+                if labels not in values:
+                    values[labels] = value
+                elif isinstance(value, list):
+                    values[labels] = [a + b for a, b in zip(values[labels], value)]
+                else:
+                    values[labels] += value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, labels, **extra):
+    pairs = [*zip(names, labels), *extra.items()]
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def render(merged):
+    """Prometheus text exposition of merged metric values."""
+    lines = []
+    for name, (kind, documentation, buckets) in DEFINITIONS.items():
+        names = PROCESS_LABELS if name in PROCESS_METRICS else LABELS
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(merged[name].items()):
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(names, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{_labels(names, labels, le=bound)} {cumulative}"
+                )
+            lines.append(f'{name}_bucket{_labels(names, labels, le="+Inf")} {value[-1]}')
+            lines.append(f"{name}_sum{_labels(names, labels)} {value[-2]}")
+            lines.append(f"{name}_count{_labels(names, labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+# Snapshot file of a worker process, set by init_worker_metrics.
+_publish_path = None
+_published = 0.0
+_publish_lock = threading.Lock()
+
+
+def exporting():
+    return bool(METRICS_PORT or METRICS_TEXTFILE)
+
+
+def _write_atomically(path, data):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def publish(force=False):
+    """Writes the snapshot of a worker process, at most every METRICS_FLUSH_SECONDS unless forced."""
+    global _published
+    if _publish_path is None:
+        return
+    if not force and time.monotonic() - _published < METRICS_FLUSH_SECONDS:
+        return
+    if not _publish_lock.acquire(blocking=force):
+        return
+    try:
+        _published = time.monotonic()
+        registry.record_process()
+        _write_atomically(_publish_path, orjson.dumps(registry.snapshot()))
+    except OSError:
+        logging.exception(msg="Failed Publishing Metrics")
+    finally:
+        _publish_lock.release()
+
+
+def init_worker_metrics(directory=METRICS_DIR):
+    """Pool initializer: starts from an empty registry published into directory."""
+    global registry, _publish_path, _publish_lock
+    registry = Registry()
+    _publish_lock = threading.Lock()
+    if exporting():
+        _publish_path = os.path.join(directory, f"{os.getpid()}.json")
+
+
+class SearchMetrics:
+    """Records the metrics of one search under its (ep, client, query) labels."""
+
+    def __init__(self, event_processor, client, query_name):
+        self.labels = (event_processor, client, query_name)
+
+    def queued(self, seconds):
+        registry.observe("qradar_search_queue_seconds", self.labels, seconds)
+
+    def polled(self):
+        registry.inc("qradar_search_polls_total", self.labels)
+
+    def completed(self, seconds):
+        registry.observe("qradar_search_seconds", self.labels, seconds)
+
+    def downloaded(self, nbytes, seconds):
+        registry.inc("qradar_download_bytes_total", self.labels, nbytes)
+        registry.inc("qradar_download_seconds_total", self.labels, seconds)
+
+    def parsed(self, rows, seconds):
+        registry.inc("qradar_parsed_rows_total", self.labels, rows)
+        registry.inc("qradar_parse_seconds_total", self.labels, seconds)
+
+    def queue_waited(self, seconds):
+        registry.inc("qradar_queue_wait_seconds_total", self.labels, seconds)
+
+    def spilled(self, nbytes):
+        registry.inc("qradar_spilled_bytes_total", self.labels, nbytes)
+
+    def queue_depth(self, queue):
+        registry.set("qradar_queue_batches", self.labels, queue.qsize())
+        registry.set("qradar_queue_bytes", self.labels, queue.bytes)
+
+    def inserted(self, documents, stored, seconds):
+        registry.observe("qradar_insert_seconds", self.labels, seconds)
+        registry.observe("qradar_insert_batch_documents", self.labels, documents)
+        registry.inc("qradar_inserted_documents_total", self.labels, stored)
+
+    def finished(self, seconds):
+        registry.observe("qradar_search_total_seconds", self.labels, seconds)
+
+
+class MetricsExporter:
+    """Serves and writes the metrics of this process and its workers, see the module docstring."""
+
+    def __init__(
+        self,
+        port=METRICS_PORT,
+        address=METRICS_ADDRESS,
+        textfile=METRICS_TEXTFILE,
+        directory=METRICS_DIR,
+        interval=METRICS_FLUSH_SECONDS,
+    ):
+        self.port = port
+        self.address = address
+        self.textfile = textfile
+        self.directory = directory
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+        self.writer = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Snapshots of the workers of a previous run.
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            os.remove(path)
+        if self.port:
+            try:
+                self.server = ThreadingHTTPServer(
+                    (self.address, self.port), self.handler()
+                )
+            except OSError:
+                logging.exception(
+                    msg=f"Failed Serving Metrics on {self.address}:{self.port}"
+                )
+            else:
+                threading.Thread(
+                    target=self.server.serve_forever, daemon=True
+                ).start()
+        if self.textfile:
+            os.makedirs(os.path.dirname(self.textfile), exist_ok=True)
+            self.writer = threading.Thread(target=self.write_periodically, daemon=True)
+            self.writer.start()
+        return self
+
+    def collect(self):
+        registry.record_process()
+        snapshots = [registry.snapshot()]
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, "rb") as file:
+                    snapshots.append(orjson.loads(file.read()))
+            except (OSError, orjson.JSONDecodeError):
+                logging.warning(msg=f"Unreadable Metrics Snapshot {path}")
+        return render(merge(snapshots))
+
+    def handler(self):
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.collect().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def write_textfile(self):
+        try:
+            _write_atomically(self.textfile, self.collect().encode())
+        except OSError:
+            logging.exception(msg="Failed Writing Metrics")
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write_textfile()
+
+    def close(self):
+        """Writes the final textfile and stops serving."""
+        self.stopped.set()
+        if self.writer:
+            self.writer.join()
+            self.write_textfile()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def start_exporter():
+    """Starts the exporter of the main process, None if neither METRICS_PORT nor METRICS_TEXTFILE is set."""
+    if not exporting():
+        return None
+    return MetricsExporter().start()
@@ -0,0 +1,64 @@
+"""Adaptive polling schedule for running Ariel searches"""
+
+import random
+import time
+from utils.constants import (
+    POLL_INITIAL_INTERVAL,
+    POLL_BACKOFF_FACTOR,
+    POLL_JITTER,
+    POLL_TIMEOUT,
+)
+
+
+class PollSchedule:
+    """Decides how long to wait before polling a search again.
+
+    Intervals start at POLL_INITIAL_INTERVAL and grow by POLL_BACKOFF_FACTOR per poll up to
+    max_interval. Once QRadar reports progress, the remaining time is extrapolated from the
+    elapsed time and the next poll is never scheduled later than that estimate, so small
+    searches are picked up within seconds while big ones are polled rarely. Every interval is
+    jittered so that searches triggered together don't poll in lockstep.
+    """
+
+    def __init__(self, max_interval, timeout=POLL_TIMEOUT):
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.polls = 0
+        self.completed_at = None
+
+    @property
+    def elapsed(self):
+        return (self.completed_at or time.monotonic()) - self.started
+
+    def expired(self):
+        return self.elapsed > self.timeout
+
+    def estimated_remaining(self, progress):
+        """Seconds left extrapolated from progress (0-100), None while there's no progress yet."""
+        if not progress or progress <= 0:
+            return None
+        return self.elapsed * (100 - min(progress, 100)) / progress
+
+    def next_interval(self, progress=None):
+        """Registers a poll that found the search still running and returns the seconds to wait."""
+        self.polls += 1
+        interval = min(
+            self.max_interval,
+            POLL_INITIAL_INTERVAL * POLL_BACKOFF_FACTOR ** (self.polls - 1),
+        )
+        remaining = self.estimated_remaining(progress)
+        if remaining is not None:
+            interval = min(interval, max(remaining, POLL_INITIAL_INTERVAL))
+        return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def complete(self):
+        """Registers the poll that found the search completed."""
+        self.polls += 1
+        self.completed_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "Poll Count": f"{self.polls}",
+            "Search Latency (in seconds)": f"{self.elapsed:.1f}",
+        }
@@ -0,0 +1,208 @@
+"""Creates the raw_* collections and their indexes from a declarative spec before a run.
+
+Reports on the stored events filter on Start Time ISO, ReportDate, WeekFrom and createdAt (see
+utils/enrichment.py). Without indexes on them every report scans whole collections, and adding
+them once the collections hold billions of documents is a long build, so they are created
+before the first event is inserted.
+
+The spec is read from COLLECTION_SPEC_PATH, a JSON object of query name -> spec. The "default"
+spec applies to every query and the keys of a query's own spec replace those of the default:
+
+    {
+        "default": {"ttl_days": null},
+        "Query1": {"type": "timeseries", "ttl_days": 30},
+        "Query2": {"type": "buckets", "bucket_size": 200}
+    }
+
+    type         "regular", "clustered", "timeseries" or "buckets", see utils/layouts.py.
+    indexes      List of index keys, each an object of field -> 1 or -1. By default the date
+                 fields, and the meta fields and time range of buckets.
+    ttl_days     Documents are deleted this many days after their createdAt, null keeps them.
+    meta_fields  Fields of the events a timeseries collection uses as metaField and the events
+                 of a bucket share.
+    granularity  granularity of a timeseries collection.
+    bucket_size  Events per bucket document.
+    fields       Column -> field mapping of the stored documents, see utils/schema.py.
+
+Clustered collections store their documents in _id order, MongoDB doesn't allow any other
+clustering key. Timeseries collections use Start Time ISO as timeField and expire on it rather
+than on createdAt, and they don't enforce unique _ids, so IDEMPOTENT_INSERTS can't detect
+duplicates there. Buckets don't have a deterministic _id either, IDEMPOTENT_INSERTS is refused
+for them. Existing collections are never converted to another type.
+
+With BUILD_INDEXES_AFTER_LOAD only the collections are created before the run and the indexes
+are built once all results are stored. Nothing is provisioned unless PROVISION_COLLECTIONS is
+set, building indexes on existing big collections holds up the run that turns it on.
+"""
+
+import json
+import logging
+from datetime import timedelta
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+from mongoclient import MongoDBConnection, database_name
+from utils.constants import (
+    BUILD_INDEXES_AFTER_LOAD,
+    COLLECTION_SPEC_PATH,
+    IDEMPOTENT_INSERTS,
+    PROVISION_COLLECTIONS,
+)
+
+TIME_FIELD = "Start Time ISO"
+TTL_FIELD = "createdAt"
+# Subdocument holding the meta_fields of timeseries measurements and buckets.
+META_FIELD = "meta"
+DEFAULT_SPEC = {
+    "type": "regular",
+    "indexes": None,
+    "ttl_days": None,
+    "meta_fields": ["domainName", "Log Source"],
+    "granularity": "minutes",
+    "bucket_size": 100,
+    "fields": None,
+}
+
+
+def load_specs(path=COLLECTION_SPEC_PATH):
+    """Query name -> spec as declared in path, empty if there is no such file."""
+    try:
+        with open(path, "r", encoding="utf-8") as spec_file:
+            return json.load(spec_file)
+    except FileNotFoundError:
+        return {}
+
+
+def collection_spec(specs, collection_name):
+    """Spec of a raw_<query> collection with the defaults filled in."""
+    query_name = collection_name.removeprefix("raw_")
+    return {**DEFAULT_SPEC, **specs.get("default", {}), **specs.get(query_name, {})}
+
+
+def collection_targets(ep_client_list, queries):
+    """(database, collection) of every collection the searches of a run store results in."""
+    return sorted(
+        {
+            (database_name(client), f"raw_{query_name}")
+            for clients in ep_client_list.values()
+            for client in clients
+            for query_name in queries
+        }
+    )
+
+
+def default_indexes(spec):
+    if spec["type"] == "buckets":
+        return [
+            *({f"{META_FIELD}.{field}": 1, "start": 1} for field in spec["meta_fields"]),
+            {"start": 1},
+            {TTL_FIELD: 1},
+        ]
+    return [{TIME_FIELD: 1}, {"ReportDate": 1}, {"WeekFrom": 1}, {TTL_FIELD: 1}]
+
+
+def ttl_seconds(spec):
+    return int(timedelta(days=spec["ttl_days"]).total_seconds())
+
+
+def create_options(spec):
+    """Options of create_collection for the type of the spec."""
+    if spec["type"] == "timeseries":
+        timeseries = {"timeField": TIME_FIELD, "granularity": spec["granularity"]}
+        if spec["meta_fields"]:
+            timeseries["metaField"] = META_FIELD
+        options = {"timeseries": timeseries}
+        if spec["ttl_days"]:
+            options["expireAfterSeconds"] = ttl_seconds(spec)
+        return options
+    if spec["type"] == "clustered":
+        return {"clusteredIndex": {"key": {"_id": 1}, "unique": True}}
+    return {}
+
+
+def index_models(spec):
+    """Indexes of the spec, with the TTL on the createdAt index if it has one."""
+    ttl = spec["ttl_days"] and spec["type"] != "timeseries"
+    indexes = spec["indexes"] or default_indexes(spec)
+    if ttl and {TTL_FIELD: 1} not in indexes:
+        indexes = [*indexes, {TTL_FIELD: 1}]
+    models = []
+    for keys in indexes:
+        options = {}
+        if ttl and keys == {TTL_FIELD: 1}:
+            options["expireAfterSeconds"] = ttl_seconds(spec)
+        models.append(IndexModel(list(keys.items()), **options))
+    return models
+
+
+def provision(mongo_client, targets, specs, indexes=True):
+    """Creates the missing collections of targets and, if indexes, their indexes.
+
+    Args:
+        mongo_client (MongoClient): Client used for the provisioning.
+        targets (list[tuple[str, str]]): (database, collection) pairs, see collection_targets.
+        specs (dict): Query name -> spec, see load_specs.
+
+    Returns:
+        int: Number of collections created.
+    """
+    created = 0
+    existing = {}
+    for database, collection_name in targets:
+        spec = collection_spec(specs, collection_name)
+        extra = {
+            "Database": database,
+            "Collection": collection_name,
+            "Collection Type": spec["type"],
+        }
+        db = mongo_client.get_database(database)
+        try:
+            if database not in existing:
+                existing[database] = set(db.list_collection_names())
+            if collection_name not in existing[database]:
+                db.create_collection(collection_name, **create_options(spec))
+                existing[database].add(collection_name)
+                created += 1
+                logging.info(msg="Created Collection", extra=extra)
+            if indexes:
+                names = db.get_collection(collection_name).create_indexes(
+                    index_models(spec)
+                )
+                logging.info(
+                    msg="Created Indexes", extra={**extra, "Indexes": f"{names}"}
+                )
+        except PyMongoError as exp:
+            logging.warning(msg=f"Failed Provisioning Collection: {exp}", extra=extra)
+    return created
+
+
+def provision_with_own_client(targets, indexes):
+    # Index builds on big collections outlast the socket timeout of the search clients.
+    mongo_client = MongoDBConnection().get_client(socketTimeoutMS=None)
+    try:
+        return provision(mongo_client, targets, load_specs(), indexes=indexes)
+    finally:
+        mongo_client.close()
+
+
+def check_specs(specs, targets):
+    """Raises ValueError for a spec of targets the inserts can't honour."""
+    for _, collection_name in targets:
+        spec = collection_spec(specs, collection_name)
+        if IDEMPOTENT_INSERTS and spec["type"] == "buckets":
+            raise ValueError(
+                f"IDEMPOTENT_INSERTS can't be used with the buckets of {collection_name}"
+            )
+
+
+def provision_collections(targets):
+    """Run before any result is stored: checks the specs, creates the collections, and their
+    indexes unless BUILD_INDEXES_AFTER_LOAD."""
+    check_specs(load_specs(), targets)
+    if PROVISION_COLLECTIONS and targets:
+        provision_with_own_client(targets, indexes=not BUILD_INDEXES_AFTER_LOAD)
+
+
+def build_deferred_indexes(targets):
+    """Run once all results are stored: builds the indexes left out with BUILD_INDEXES_AFTER_LOAD."""
+    if PROVISION_COLLECTIONS and BUILD_INDEXES_AFTER_LOAD and targets:
+        provision_with_own_client(targets, indexes=True)
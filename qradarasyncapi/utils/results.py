@@ -0,0 +1,131 @@
+"""Helpers for downloading and parsing Ariel search results"""
+
+import re
+from json import JSONDecoder, JSONDecodeError
+import orjson
+from utils.constants import INSERT_BATCH_SIZE, INSERT_BATCH_BYTES
+
+# Whitespace and the commas separating the events inside the array.
+_SEPARATORS = re.compile(rb"[\s,]*")
+_TEXT_SEPARATORS = re.compile(r"[\s,]*")
+# Number of "}" tried as the end of the last complete event before scanning event by event.
+_FAST_PATH_ATTEMPTS = 3
+
+
+class EventStreamParser:
+    """Incremental parser for the {"events": [{...}, {...}]} results body.
+
+    Bytes are fed as they arrive from the network and every complete event is returned as a
+    dict straight away. Nothing depends on the whitespace QRadar puts between events.
+
+    All complete events of a chunk are decoded with a single orjson call by closing the array
+    at the last "}" of the chunk. If that "}" belongs to a string or a nested object of an
+    incomplete event the slice isn't valid JSON, the previous "}" is tried and eventually the
+    events are scanned one by one with the json module.
+    """
+
+    def __init__(self):
+        self.decoder = JSONDecoder()
+        self.buffer = b""
+        self.in_array = False
+        self.finished = False
+        self.events = 0
+
+    def feed(self, chunk: bytes) -> list[dict]:
+        """Adds the next chunk of the body and returns the events it completed."""
+        buffer = self.buffer + chunk
+        events = []
+        position = 0
+        if not self.in_array:
+            position = buffer.find(b"[")
+            if position == -1:
+                self.buffer = buffer
+                return events
+            position += 1
+            self.in_array = True
+        last = buffer.rfind(b"}")
+        for _ in range(_FAST_PATH_ATTEMPTS):
+            if last < position:
+                break
+            try:
+                events = orjson.loads(b"[" + buffer[position : last + 1] + b"]")
+                position = last + 1
+                break
+            except orjson.JSONDecodeError:
+                last = buffer.rfind(b"}", position, last)
+        else:
+            events, position = self.scan(buffer, position)
+        position = _SEPARATORS.match(buffer, position).end()
+        if buffer[position : position + 1] == b"]":
+            self.finished = True
+        self.buffer = buffer[position:]
+        self.events += len(events)
+        return events
+
+    def scan(self, buffer: bytes, position: int):
+        """Decodes events one by one from position, returns them and the position after the last one."""
+        text = buffer[position:].decode("utf-8", "surrogateescape")
+        events = []
+        text_position = 0
+        while True:
+            text_position = _TEXT_SEPARATORS.match(text, text_position).end()
+            if text[text_position : text_position + 1] in ("", "]"):
+                break
+            try:
+                event, text_position = self.decoder.raw_decode(
+                    text, text_position
+                )
+            except JSONDecodeError:
+                # The event continues in the next chunk.
+                break
+            events.append(event)
+        consumed = text[:text_position].encode("utf-8", "surrogateescape")
+        return events, position + len(consumed)
+
+    def close(self):
+        """Checks the whole array was received, raises ValueError for a truncated body."""
+        if not self.finished:
+            raise ValueError(
+                f"Results ended after {self.events} events without closing the events array: {self.buffer[:200]!r}"
+            )
+
+
+def parse_events(content: bytes) -> list[dict]:
+    """Parses a complete results body."""
+    parser = EventStreamParser()
+    events = parser.feed(content)
+    parser.close()
+    return events
+
+
+def get_ranges(record_count, chunk_size):
+    """Splits record_count rows into inclusive (start, stop) item ranges for the Range header.
+
+    Args:
+        record_count (int): Number of rows in the search results.
+        chunk_size (int): Maximum number of rows per range.
+
+    Returns:
+        list[tuple[int, int]]: e.g. [(0, 999), (1000, 1499)] for 1500 rows and chunks of 1000.
+    """
+    return [
+        (start, min(start + chunk_size, record_count) - 1)
+        for start in range(0, record_count, chunk_size)
+    ]
+
+
+def batch_is_full(batch, nbytes):
+    return len(batch) >= INSERT_BATCH_SIZE or nbytes >= INSERT_BATCH_BYTES
+
+
+def split_batches(events, nbytes):
+    """Splits events parsed from nbytes of results into insert batches.
+
+    Yields:
+        tuple[list[dict], int]: A batch and its share of nbytes.
+    """
+    event_bytes = max(nbytes // max(len(events), 1), 1)
+    batch_size = max(min(INSERT_BATCH_SIZE, INSERT_BATCH_BYTES // event_bytes), 1)
+    for index in range(0, len(events), batch_size):
+        batch = events[index : index + batch_size]
+        yield batch, event_bytes * len(batch)
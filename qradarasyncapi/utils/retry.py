@@ -0,0 +1,164 @@
+"""Retry policy for the QRadar API calls of a search.
+
+Every failed call is classified as one of:
+
+    RETRY        Connection errors, timeouts, 429 and 5xx, the same call is retried.
+    RETRY_AFTER  429 or 503 with a Retry-After header, retried once the console said so.
+    RETRIGGER    404 of a search that expired or was deleted, it needs to be triggered again.
+    FATAL        Other errors such as an invalid query (422), retrying wouldn't help.
+
+Retries wait RETRY_BASE_DELAY seconds doubled for every consecutive failure, capped at
+RETRY_MAX_DELAY and jittered so that searches failing together don't retry in lockstep. A call
+is given up after RETRY_MAX_ATTEMPTS consecutive failures, and no retry is scheduled past the
+deadline of its search task.
+"""
+
+import random
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import httpx
+from utils.constants import (
+    RETRY_BASE_DELAY,
+    RETRY_DEADLINE,
+    RETRY_JITTER,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_MAX_DELAY,
+)
+
+RETRY = "retry"
+RETRY_AFTER = "retry after"
+RETRIGGER = "retrigger"
+FATAL = "fatal"
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_after(response):
+    """Seconds the Retry-After header of response asks to wait, None without a valid one."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def classify(error):
+    """Returns (action, seconds the console asked to wait or None) for a failed call."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        if status_code in (429, 503):
+            wait = retry_after(error.response)
+            if wait is not None:
+                return RETRY_AFTER, wait
+        if status_code in RETRYABLE_STATUS_CODES:
+            return RETRY, None
+        if status_code == 404:
+            return RETRIGGER, None
+        return FATAL, None
+    if isinstance(error, (httpx.TransportError, ValueError)):
+        # Connection errors, timeouts and truncated or invalid responses.
+        return RETRY, None
+    return FATAL, None
+
+
+def error_message(error):
+    """Short description of a failed call for the log message."""
+    if isinstance(error, httpx.HTTPStatusError):
+        if error.response.status_code >= 500:
+            return "Server Error"
+        return "Client Error"
+    if isinstance(error, httpx.ConnectError):
+        return "Connection Refused"
+    if isinstance(error, httpx.TimeoutException):
+        return "Read timed out"
+    return "Request Failed"
+
+
+def error_details(error):
+    """Log fields of a failed call, the QRadar error is only read when there is a response."""
+    if not isinstance(error, httpx.HTTPStatusError):
+        return {"Error": f"{error!r}"}
+    response = error.response
+    details = {"Status Code": f"{response.status_code}"}
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if isinstance(body, dict):
+        http_response = body.get("http_response") or {}
+        details["QRadar Error Code"] = f"{http_response.get('code', response.status_code)}"
+        details["QRadar Error Message"] = (
+            f"{http_response.get('message')} - {body.get('message')}"
+        )
+    else:
+        details["QRadar Error Message"] = response.text[:500]
+    return details
+
+
+class RetryPolicy:
+    """Decides whether and when the failed calls of a search task are retried.
+
+    Args:
+        max_attempts (int): Consecutive failures before a call is given up.
+        deadline (float): time.monotonic() after which nothing is retried any more, by
+            default RETRY_DEADLINE seconds from now. Pass the deadline of the task to share it.
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, deadline=None):
+        self.max_attempts = max_attempts
+        self.deadline = deadline or time.monotonic() + RETRY_DEADLINE
+        # Consecutive failures of the current call.
+        self.failures = 0
+        self.retries = 0
+        # Action of the last failure, None once a call succeeded.
+        self.action = None
+        self.given_up = False
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def backoff(self):
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.failures - 1))
+        return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+    def next_delay(self, error):
+        """Registers a failed call and returns the seconds to wait before retrying it.
+
+        Returns:
+            float: None if the call is given up, action tells why.
+        """
+        self.failures += 1
+        self.action, wait = classify(error)
+        if self.action == RETRY:
+            wait = self.backoff()
+        if (
+            self.action in (RETRIGGER, FATAL)
+            or self.failures >= self.max_attempts
+            or wait > self.remaining()
+        ):
+            self.given_up = True
+            return None
+        self.retries += 1
+        return wait
+
+    def succeeded(self):
+        """Registers a successful call, the next failure starts over from the base delay."""
+        self.failures = 0
+        self.action = None
+        self.given_up = False
+
+    def stats(self):
+        return {"Retries": f"{self.retries}"}
@@ -0,0 +1,107 @@
+"""Per-query mapping of the columns of the events to the fields of the stored documents.
+
+The column aliases of queries.json end up as field names repeated in every document, and IPs
+and epochs are stored the way Ariel returns them. The "fields" of a query's collection spec
+(see utils/provisioning.py) map columns to short names, drop the ones nobody reads and convert
+values to compact types:
+
+    "Query1": {
+        "fields": {
+            "Log Source": "ls",
+            "Source IP": {"name": "sip", "type": "ip"},
+            "Desitnation IP": {"name": "dip", "type": "ip"},
+            "Start Time": null
+        }
+    }
+
+A column mapped to a name is renamed, to null is dropped, and with a type its value converted:
+
+    ip    IPv4 addresses to integers, IPv6 addresses to 16 bytes of BSON binary.
+    date  Epochs in milliseconds to BSON dates.
+    int   Numbers sent as strings to integers.
+
+Columns that aren't mapped are stored as they are. The mapping is applied by the writers right
+before the events are shaped into documents (see utils/layouts.py), after _ids, dates and the
+routing of batched searches, so meta_fields and indexes refer to the mapped names. Values that
+can't be converted are stored unchanged.
+"""
+
+import ipaddress
+from datetime import datetime
+from functools import lru_cache
+from utils.provisioning import collection_spec, load_specs
+
+
+def to_ip(value):
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return value
+    if address.version == 4:
+        return int(address)
+    return address.packed
+
+
+def to_date(value):
+    try:
+        return datetime.utcfromtimestamp(int(value) / 1000)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return value
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+CONVERTERS = {"ip": to_ip, "date": to_date, "int": to_int}
+
+
+class Schema:
+    """Compiled field mapping of one query.
+
+    Args:
+        fields (dict): Column -> new name, None to drop it, or {"name": ..., "type": ...}.
+    """
+
+    def __init__(self, fields):
+        # Column -> (name, converter), None for dropped columns.
+        self.fields = {}
+        for column, field in fields.items():
+            if field is None:
+                self.fields[column] = None
+            elif isinstance(field, str):
+                self.fields[column] = (field, None)
+            else:
+                self.fields[column] = (
+                    field.get("name", column),
+                    CONVERTERS[field["type"]] if field.get("type") else None,
+                )
+
+    def map_event(self, line_json):
+        document = {}
+        for column, value in line_json.items():
+            if column not in self.fields:
+                document[column] = value
+                continue
+            field = self.fields[column]
+            if field is None:
+                continue
+            name, convert = field
+            if convert is not None and value is not None:
+                value = convert(value)
+            document[name] = value
+        return document
+
+    def apply(self, logs):
+        """Returns the documents of a batch of events."""
+        return [self.map_event(line_json) for line_json in logs]
+
+
+@lru_cache(maxsize=None)
+def get_schema(collection_name):
+    """Schema of a raw_<query> collection, None if its spec maps no fields."""
+    fields = collection_spec(load_specs(), collection_name)["fields"]
+    return Schema(fields) if fields else None
@@ -0,0 +1,200 @@
+"""Local spool of search results, used instead of MongoDB when SPOOL_RESULTS is enabled.
+
+The insert stage writes the events of every result range to a compressed NDJSON segment
+under SPOOL_DIR, as fast as the download goes, so searches can run while MongoDB is slow or
+down without their cursors expiring. spool_loader.py bulk-loads the segments into MongoDB
+later, as often as needed, without querying QRadar again.
+
+    SPOOL_DIR/<query>/<client>/<ep>_<window start>_<window stop>_<first row>-<last row>.ndjson.gz
+
+Every segment has a .json manifest next to it with the search it belongs to. Both only appear
+once the whole range was written, a range that didn't complete stays pending in the checkpoint
+and is downloaded again. Loaded segments get a .loaded marker. Events are spooled as Ariel
+returned them, _ids and dates are added by the loader.
+"""
+
+import glob
+import gzip
+import logging
+import os
+import orjson
+from utils.windows import parse_window_time
+from utils.constants import (
+    SPOOL_COMPRESSION,
+    SPOOL_COMPRESSION_LEVEL,
+    SPOOL_DIR,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {"gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+
+
+def get_compression():
+    if SPOOL_COMPRESSION == "zstd" and zstandard is None:
+        logging.warning(msg="zstandard is not installed, spooling with gzip instead")
+        return "gzip"
+    return SPOOL_COMPRESSION
+
+
+def open_segment(path, mode, level=SPOOL_COMPRESSION_LEVEL):
+    """Opens a segment file for binary reading ("rb") or writing ("wb")."""
+    if EXTENSIONS["zstd"] in path:
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {path}")
+        if mode == "wb":
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level))
+        return zstandard.open(path, mode)
+    return gzip.open(path, mode, compresslevel=level)
+
+
+def _window_name(value):
+    return parse_window_time(value).strftime("%Y%m%dT%H%M%S")
+
+
+class SegmentWriter:
+    """Writes one result range, published with its manifest once all its rows are in."""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.rows = 0
+        self.file = open_segment(f"{path}.part", "wb")
+
+    def write(self, logs):
+        self.file.write(b"".join(orjson.dumps(line_json) + b"\n" for line_json in logs))
+        self.rows += len(logs)
+
+    def publish(self):
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
+        with open(manifest_path(self.path), "wb") as manifest:
+            manifest.write(orjson.dumps({**self.manifest, "rows": self.rows}))
+        return os.path.getsize(self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(f"{self.path}.part")
+
+
+def manifest_path(segment_path):
+    for extension in EXTENSIONS.values():
+        if segment_path.endswith(extension):
+            return segment_path.removesuffix(extension) + ".json"
+    raise ValueError(f"Not a spool segment: {segment_path}")
+
+
+class Spool:
+    """Segments of one search, one per result range.
+
+    Args:
+        ranges (list[tuple[int, int]]): Result ranges the search downloads.
+        clients (list): Clients of a batched search, see QueryExecutor.client_groups.
+    """
+
+    def __init__(
+        self,
+        event_processor,
+        client,
+        query_name,
+        query_duration_start,
+        query_duration_stop,
+        cursor_id,
+        ranges,
+        clients=None,
+        directory=SPOOL_DIR,
+    ):
+        self.folder = os.path.join(directory, query_name, client)
+        os.makedirs(self.folder, exist_ok=True)
+        self.prefix = (
+            f"{event_processor}_{_window_name(query_duration_start)}"
+            f"_{_window_name(query_duration_stop)}"
+        )
+        self.extension = EXTENSIONS[get_compression()]
+        self.manifest = {
+            "event_processor": event_processor,
+            "client": client,
+            "clients": clients,
+            "query_name": query_name,
+            "query_duration_start": query_duration_start,
+            "query_duration_stop": query_duration_stop,
+            "cursor_id": cursor_id,
+        }
+        self.sizes = {chunk: chunk[1] - chunk[0] + 1 for chunk in ranges}
+        self.segments = {}
+        self.published = 0
+        self.bytes = 0
+
+    def write(self, chunk, logs):
+        """Appends a batch of events of the result range chunk to its segment."""
+        segment = self.segments.get(chunk)
+        if segment is None:
+            start, stop = chunk
+            segment = self.segments[chunk] = SegmentWriter(
+                os.path.join(self.folder, f"{self.prefix}_{start}-{stop}{self.extension}"),
+                {**self.manifest, "start": start, "stop": stop},
+            )
+        segment.write(logs)
+        if segment.rows >= self.sizes[chunk]:
+            self.bytes += segment.publish()
+            self.published += 1
+            del self.segments[chunk]
+
+    def close(self):
+        """Discards the segments of ranges that didn't complete."""
+        for segment in self.segments.values():
+            segment.discard()
+        self.segments = {}
+
+    def stats(self):
+        return {
+            "Segments Spooled": f"{self.published}",
+            "Bytes Spooled": f"{self.bytes}",
+        }
+
+
+def pending_segments(directory=SPOOL_DIR, reload=False):
+    """Manifests of the spooled segments, only those not loaded yet unless reload."""
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(directory, "**", "*.json"), recursive=True)
+        if reload or not os.path.exists(loaded_marker(path))
+    )
+
+
+def read_manifest(path):
+    with open(path, "rb") as manifest:
+        return orjson.loads(manifest.read())
+
+
+def segment_path(manifest_path):
+    base = manifest_path.removesuffix(".json")
+    for extension in EXTENSIONS.values():
+        if os.path.exists(base + extension):
+            return base + extension
+    raise FileNotFoundError(f"No segment for {manifest_path}")
+
+
+def read_segment(path, batch_size):
+    """Yields the events of a segment in batches of batch_size."""
+    batch = []
+    with open_segment(path, "rb") as segment:
+        for line in segment:
+            batch.append(orjson.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def loaded_marker(manifest_path):
+    return manifest_path.removesuffix(".json") + ".loaded"
+
+
+def mark_loaded(manifest_path):
+    with open(loaded_marker(manifest_path), "wb"):
+        pass
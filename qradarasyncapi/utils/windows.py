@@ -0,0 +1,87 @@
+"""Sizing of the time windows searches are triggered for.
+
+The planner keeps every search close to TARGET_SEARCH_ROWS rows: from the rows per minute
+observed for a (client, query) on the previous days it picks the longest window of
+SEARCH_DURATIONS that should stay below the target, so noisy clients get several short
+searches and quiet clients one search for the whole day. A search that still turns out too
+big, reporting more than SPLIT_RECORD_COUNT rows or running for more than
+SPLIT_SEARCH_SECONDS while far from complete, is cancelled and its window split in half.
+"""
+
+from datetime import datetime, timedelta
+from utils.constants import (
+    MIN_SEARCH_DURATION,
+    SEARCH_DURATIONS,
+    SPLIT_RECORD_COUNT,
+    SPLIT_SEARCH_SECONDS,
+    TARGET_SEARCH_ROWS,
+)
+
+# Format of the quoted START/STOP values of the Ariel queries.
+WINDOW_FORMAT = "'%Y-%m-%d %H:%M:%S'"
+
+
+def parse_window_time(value):
+    return datetime.strptime(value, WINDOW_FORMAT)
+
+
+def format_window_time(value):
+    return value.strftime(WINDOW_FORMAT)
+
+
+def window_minutes(query_duration_start, query_duration_stop):
+    return (
+        parse_window_time(query_duration_stop) - parse_window_time(query_duration_start)
+    ).total_seconds() / 60
+
+
+def plan_duration(default, rows_per_minute):
+    """Window length in minutes for a (client, query) given its observed rows per minute.
+
+    Args:
+        default (int): Duration used when nothing was observed yet.
+        rows_per_minute (float): None if nothing was observed yet.
+    """
+    if rows_per_minute is None:
+        return default
+    if rows_per_minute <= 0:
+        return SEARCH_DURATIONS[-1]
+    ideal = TARGET_SEARCH_ROWS / rows_per_minute
+    return max(
+        (duration for duration in SEARCH_DURATIONS if duration <= ideal),
+        default=SEARCH_DURATIONS[0],
+    )
+
+
+def split_window(query_duration_start, query_duration_stop):
+    """Splits a window in two halves, returns None if the halves would be too short."""
+    start = parse_window_time(query_duration_start)
+    stop = parse_window_time(query_duration_stop)
+    if (stop - start) / 2 < timedelta(minutes=MIN_SEARCH_DURATION):
+        return None
+    middle = format_window_time(start + (stop - start) / 2)
+    return [
+        {"start": query_duration_start, "stop": middle},
+        {"start": middle, "stop": query_duration_stop},
+    ]
+
+
+def should_split(
+    schedule, record_count, progress, query_duration_start, query_duration_stop
+):
+    """Whether a running search is too big for its window and should be split.
+
+    Args:
+        schedule (PollSchedule): Polling schedule of the search.
+        record_count (int): Rows the search reported so far.
+        progress (int): Progress the search reported so far (0-100).
+    """
+    if split_window(query_duration_start, query_duration_stop) is None:
+        return False
+    if record_count and record_count > SPLIT_RECORD_COUNT:
+        return True
+    if schedule.elapsed > SPLIT_SEARCH_SECONDS:
+        # Only when less than half done, cancelling a nearly complete search wastes its work.
+        remaining = schedule.estimated_remaining(progress)
+        return remaining is None or remaining > schedule.elapsed
+    return False
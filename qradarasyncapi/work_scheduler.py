@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from collections import defaultdict
+from utils.constants import MAX_CONCURRENT_SEARCHES, MAX_SEARCHES_PER_EP
+
+
+class WorkScheduler:
+    """Drains a shared queue of SearchTasks with bounded concurrency per EP and per console.
+
+    max_concurrent workers pull from one queue. A worker that picks up a task for an event
+    processor that is already running max_per_ep searches puts it back and takes the next
+    one, so a busy EP never blocks work for the others. Tasks returned by the handler, e.g.
+    the halves of a split search, are queued as well.
+    """
+
+    def __init__(
+        self,
+        max_concurrent=MAX_CONCURRENT_SEARCHES,
+        max_per_ep=MAX_SEARCHES_PER_EP,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_ep = max_per_ep
+        self.queue = asyncio.Queue()
+        self.running_per_ep = defaultdict(int)
+        self.completed = 0
+
+    async def worker(self, handler):
+        while True:
+            task = await self.queue.get()
+            try:
+                if self.running_per_ep[task.event_processor] >= self.max_per_ep:
+                    self.queue.put_nowait(task)
+                    # Every queued task may belong to a saturated EP, don't spin.
+                    await asyncio.sleep(1)
+                    continue
+                self.running_per_ep[task.event_processor] += 1
+                try:
+                    for follow_up in await handler(task) or []:
+                        self.queue.put_nowait(follow_up)
+                except Exception as my_generic_exp:
+                    logging.exception(
+                        msg=f"Generic Exception: {my_generic_exp}",
+                        extra={
+                            "Event Processor": f"{task.event_processor}",
+                            "Client": f"{task.client}",
+                            "Query": f"{task.query_name}",
+                            "Query Duration Start": f"{task.query_duration_start}",
+                            "Query Duration Stop": f"{task.query_duration_stop}",
+                        },
+                    )
+                finally:
+                    self.running_per_ep[task.event_processor] -= 1
+                    self.completed += 1
+            finally:
+                self.queue.task_done()
+
+    async def run(self, tasks, handler):
+        """Runs handler(task) for every task and returns when all of them have finished.
+
+        Args:
+            tasks (list[SearchTask]): Tasks to run, see QueryExecutor.create_tasks.
+            handler (Callable): Coroutine function executing a single task, returning the
+                tasks to run next if any.
+        """
+        for task in tasks:
+            self.queue.put_nowait(task)
+        workers = [
+            asyncio.create_task(self.worker(handler))
+            for _ in range(min(self.max_concurrent, len(tasks)))
+        ]
+        await self.queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logging.info(
+            msg="Work queue drained",
+            extra={"Searches Completed": f"{self.completed}"},
+        )